@@ -1,12 +1,17 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+import asyncio
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import bcrypt  # Import bcrypt directly for version check
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, get_async_db
 import os
 from dotenv import load_dotenv
 
@@ -17,6 +22,12 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# bcrypt runs in worker processes so a login burst doesn't freeze the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max((os.cpu_count() or 2) // 2, 1))))
+# Hash/verify calls allowed in flight (running or queued) before new ones are shed with a 503
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+PASSWORD_HASH_RETRY_AFTER_SECONDS = int(os.getenv("PASSWORD_HASH_RETRY_AFTER_SECONDS", "2"))
+
 # Print bcrypt version for debugging
 print(f"Using bcrypt version: {bcrypt.__version__}")
 
@@ -68,6 +79,87 @@ def get_password_hash(password: str) -> str:
             print(f"Bcrypt direct hashing error: {str(e2)}")
             raise
 
+def _timed_call(fn, *args):
+    """Run in a worker: returns (result, monotonic start time, seconds spent)"""
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic() - started
+
+class PasswordHasher:
+    """
+    Runs get_password_hash and verify_password in a bounded process pool.
+    At most `max_pending` calls may be running or queued; beyond that the
+    request is shed with 503 and Retry-After instead of queueing behind a
+    login burst. Records queue wait (submit to worker start) and hash time.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_hash_ms = 0.0
+        self.max_hash_ms = 0.0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-ins in progress, please retry shortly",
+                headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER_SECONDS)},
+            )
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending += 1
+        submitted = time.monotonic()
+        try:
+            result, started, seconds = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _timed_call, fn, *args
+            )
+        finally:
+            self.pending -= 1
+        wait_ms = max(started - submitted, 0.0) * 1000
+        hash_ms = seconds * 1000
+        self.completed += 1
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        self.total_hash_ms += hash_ms
+        self.max_hash_ms = max(self.max_hash_ms, hash_ms)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_queue_wait_ms': round(self.total_wait_ms / self.completed, 3) if self.completed else 0.0,
+            'max_queue_wait_ms': round(self.max_wait_ms, 3),
+            'avg_hash_ms': round(self.total_hash_ms / self.completed, 3) if self.completed else 0.0,
+            'max_hash_ms': round(self.max_hash_ms, 3)
+        }
+
+# Shared by the register, signup and login endpoints
+password_hasher = PasswordHasher()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -153,3 +245,56 @@ async def get_current_active_user(current_user: DBUser = Depends(get_current_use
     if not current_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found or inactive")
     return current_user
+
+async def get_current_user_async(
+    auth_credentials: HTTPAuthorizationCredentials = Depends(security),
+    request: Request = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Same checks as get_current_user, but loads the user through the async
+    session so the lookup does not block the event loop.
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    token = auth_credentials.credentials if auth_credentials else None
+    if not token and request:
+        auth_header = request.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            token = auth_header[7:]
+    if not token:
+        raise credentials_exception
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id: str = payload.get("sub")
+        if user_id is None:
+            raise credentials_exception
+
+        user = await db.scalar(select(DBUser).where(DBUser.id == user_id))
+        if user is None:
+            print(f"User not found for id: {user_id}")
+            raise credentials_exception
+        return user
+
+    except HTTPException:
+        raise
+    except JWTError as e:
+        print(f"JWT Error: {str(e)}")
+        raise credentials_exception
+    except Exception as e:
+        print(f"Unexpected error in get_current_user_async: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error processing authentication: {str(e)}",
+        )
+
+async def get_current_active_user_async(current_user: DBUser = Depends(get_current_user_async)):
+    """get_current_active_user for endpoints on the async session"""
+    if not current_user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found or inactive")
+    return current_user
@@ -0,0 +1,238 @@
+"""
+Pub/sub backplane that lets several realtime workers act as one.
+
+Every node keeps its own sockets, outbound queues and subscriptions. What has
+to cross nodes (driver positions, ride channel events, messages for a user
+connected elsewhere) is published as small dict messages. Messages are queued
+and sent in batches, one publish per `batch_ms`, with driver positions
+coalesced so only the latest position per driver goes out in each batch.
+
+Select an implementation with REALTIME_BACKPLANE:
+    unset / ""      single process, no backplane
+    loopback        in-process hub (tests, several managers in one process)
+    redis://...     Redis pub/sub
+"""
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+import asyncio
+import json
+import os
+import uuid
+
+from frame_codec import encode_json
+
+REALTIME_BACKPLANE = os.getenv("REALTIME_BACKPLANE", "")
+REALTIME_BACKPLANE_CHANNEL = os.getenv("REALTIME_BACKPLANE_CHANNEL", "fleet:realtime")
+BACKPLANE_BATCH_MS = int(os.getenv("BACKPLANE_BATCH_MS", "20"))
+BACKPLANE_MAX_BATCH = int(os.getenv("BACKPLANE_MAX_BATCH", "500"))
+
+# Message kinds
+MSG_LOCATION = "location"        # Driver position (and whether they take rides)
+MSG_DRIVER_GONE = "driver_gone"  # Driver disconnected or expired on its node
+MSG_USER = "user"                # Pre-encoded message for one user
+MSG_RIDE = "ride"                # Pre-encoded message for a ride channel
+MSG_ASSIGN = "assign"            # Driver started driving a ride
+MSG_RELEASE = "release"          # Driver's ride finished or was cancelled
+MSG_DEMAND = "demand"            # Ride request opened (with pickup) or closed, for surge zones
+MSG_TRAIL = "trail"              # Start, finish or discard a ride trail on the driver's node
+
+
+class Backplane(ABC):
+    """
+    Base class: batching and delivery. Subclasses implement _send_batch and,
+    if they receive from an external system, start their reader in start().
+
+    Pending messages are kept in one dict in publish order. Plain messages get
+    a sequence number as key; a coalesced message replaces the previous one
+    with its key and moves to the end, so it is sent where its latest version
+    was published. A driver's last position therefore can't overtake the
+    DRIVER_GONE published after it.
+    """
+
+    def __init__(self, batch_ms: int = BACKPLANE_BATCH_MS, max_batch: int = BACKPLANE_MAX_BATCH):
+        self.node_id = uuid.uuid4().hex[:12]
+        self.batch_seconds = batch_ms / 1000
+        self.max_batch = max_batch
+        self.handler: Optional[Callable[[dict], Awaitable[None]]] = None
+        self.pending: Dict[Union[int, str], dict] = {}
+        self._sequence = 0
+        self._flush_now = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.published = 0
+        self.coalesced = 0
+        self.batches_sent = 0
+        self.received = 0
+        self.errors = 0
+
+    def set_handler(self, handler: Callable[[dict], Awaitable[None]]):
+        """Register the coroutine that applies messages from other nodes"""
+        self.handler = handler
+
+    def publish(self, message: dict, coalesce_key: Optional[str] = None):
+        """
+        Queue a message for the next batch. Messages sharing a coalesce_key
+        replace each other until the batch is sent.
+        """
+        self.published += 1
+        if coalesce_key is not None:
+            if self.pending.pop(coalesce_key, None) is not None:
+                self.coalesced += 1
+            self.pending[coalesce_key] = message
+        else:
+            self._sequence += 1
+            self.pending[self._sequence] = message
+        if len(self.pending) >= self.max_batch:
+            self._flush_now.set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f"{type(self).__name__} started (node {self.node_id})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.batch_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error publishing backplane batch: {str(e)}")
+
+    async def flush(self):
+        if not self.pending:
+            return
+        messages = list(self.pending.values())
+        self.pending = {}
+        payload = encode_json({"node": self.node_id, "messages": messages})
+        self.batches_sent += 1
+        await self._send_batch(payload)
+
+    @abstractmethod
+    async def _send_batch(self, payload: str):
+        """Publish one encoded batch to every node"""
+
+    async def _deliver(self, payload):
+        """Apply a batch published by any node, skipping our own"""
+        batch = json.loads(payload)
+        if batch.get("node") == self.node_id or self.handler is None:
+            return
+        for message in batch.get("messages", []):
+            self.received += 1
+            try:
+                await self.handler(message)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error applying backplane message {message.get('kind')}: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            'backend': type(self).__name__,
+            'node_id': self.node_id,
+            'running': self.running,
+            'pending': len(self.pending),
+            'published': self.published,
+            'coalesced': self.coalesced,
+            'batches_sent': self.batches_sent,
+            'received': self.received,
+            'errors': self.errors
+        }
+
+
+class LoopbackHub:
+    """In-process stand-in for the pub/sub server"""
+
+    def __init__(self):
+        self.members: List["LoopbackBackplane"] = []
+
+
+default_hub = LoopbackHub()
+
+
+class LoopbackBackplane(Backplane):
+    """Delivers batches to the other backplanes on the same hub"""
+
+    def __init__(self, hub: Optional[LoopbackHub] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.hub = default_hub if hub is None else hub
+        self.hub.members.append(self)
+
+    async def _send_batch(self, payload: str):
+        for member in list(self.hub.members):
+            if member is not self:
+                await member._deliver(payload)
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub; every node publishes and subscribes on one channel"""
+
+    def __init__(self, url: str, channel: str = REALTIME_BACKPLANE_CHANNEL, **kwargs):
+        super().__init__(**kwargs)
+        import redis.asyncio as aioredis
+        self.url = url
+        self.channel = channel
+        self.redis = aioredis.from_url(url)
+        self._reader: Optional[asyncio.Task] = None
+
+    def start(self):
+        super().start()
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        await super().stop()
+        await self.redis.close()
+
+    async def _send_batch(self, payload: str):
+        await self.redis.publish(self.channel, payload)
+
+    async def _read(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._deliver(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"Backplane subscription to {self.channel} failed: {str(e)}; retrying")
+                await asyncio.sleep(1.0)
+
+
+def create_backplane(spec: str = REALTIME_BACKPLANE) -> Optional[Backplane]:
+    """Build the backplane named by REALTIME_BACKPLANE (None for a single process)"""
+    if not spec:
+        return None
+    if spec == "loopback":
+        return LoopbackBackplane()
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackplane(spec)
+    raise ValueError(f"Unknown REALTIME_BACKPLANE: {spec}")
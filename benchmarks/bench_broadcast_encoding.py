@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Compare per-recipient JSON serialization with the pre-encoded frame path,
+through ConnectionManager and its outbound queues.
+
+Fake sockets are connected to a real ConnectionManager. The per-recipient
+path calls send_to_user for each user (one encode per socket, as send_json
+did); the encode-once path is broadcast_to_users. Both run with the stdlib
+encoder and with orjson, so the encode-once gain and the encoder gain are
+reported separately. "queued" is the time to hand the message to every
+queue; "delivered" lasts until every writer task has sent it.
+
+Usage: python benchmarks/bench_broadcast_encoding.py [--repeat N]
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import frame_codec
+from realtime_service import ConnectionManager
+
+RECIPIENT_COUNTS = [1_000, 10_000, 50_000]
+
+
+class NullSocket:
+    """Stands in for a WebSocket; only counts what is handed to it"""
+
+    def __init__(self, counter: list):
+        self.counter = counter
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        self.counter[0] += 1
+        self.counter[1] += len(text)
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def sample_message() -> dict:
+    return {
+        'type': 'ride_started',
+        'ride_id': '8d3c1e6a-5b2f-4f7e-9a61-2f4b7c9d0e11',
+        'timestamp': '2024-05-01T08:30:00.000000+00:00',
+        'location': {'lat': 31.520370, 'lng': 74.358749},
+        'driver': {
+            'id': 'f1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d',
+            'first_name': 'Ali',
+            'last_name': 'Raza',
+            'vehicle_plate': 'LEA-1234',
+            'average_rating': 4.87
+        }
+    }
+
+
+def per_recipient(manager: ConnectionManager, user_ids, message):
+    for user_id in user_ids:
+        manager.send_to_user(user_id, message)
+
+
+def encode_once(manager: ConnectionManager, user_ids, message):
+    manager.broadcast_to_users(user_ids, message)
+
+
+async def time_path(fn, manager, user_ids, counter, message, repeat: int):
+    """Best (queued ms, delivered ms) over `repeat` runs"""
+    best_queued = best_delivered = float('inf')
+    for _ in range(repeat):
+        counter[0] = 0
+        gc.collect()
+        gc.disable()  # A collection over 50k queues would land on whichever path is running
+        started = time.perf_counter()
+        fn(manager, user_ids, message)
+        queued = time.perf_counter() - started
+        while counter[0] < len(user_ids):
+            await asyncio.sleep(0)
+        delivered = time.perf_counter() - started
+        gc.enable()
+        best_queued = min(best_queued, queued)
+        best_delivered = min(best_delivered, delivered)
+    return best_queued * 1000, best_delivered * 1000
+
+
+async def run(count: int, repeat: int, message: dict) -> dict:
+    counter = [0, 0]
+    manager = ConnectionManager()
+    user_ids = [f"user{i}" for i in range(count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user_id in user_ids:
+            await manager.connect(NullSocket(counter), user_id)
+    results = {}
+    orjson = frame_codec.orjson
+    encoders = [('json', None)] + ([('orjson', orjson)] if orjson is not None else [])
+    try:
+        for name, module in encoders:
+            frame_codec.orjson = module  # encode_json picks the encoder per call
+            for path, fn in (('per-recipient', per_recipient), ('encode-once', encode_once)):
+                results[name, path] = await time_path(fn, manager, user_ids, counter, message, repeat)
+    finally:
+        frame_codec.orjson = orjson
+        with contextlib.redirect_stdout(io.StringIO()):
+            await manager.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case; the best is reported')
+    args = parser.parse_args()
+
+    message = sample_message()
+    if frame_codec.orjson is None:
+        print("orjson not installed: stdlib json only")
+    print(f"{'recipients':>10} {'encoder':>7} {'per-recipient queued/delivered ms':>34} "
+          f"{'encode-once queued/delivered ms':>32} {'encode-once gain':>17}")
+    for count in RECIPIENT_COUNTS:
+        results = asyncio.run(run(count, args.repeat, message))
+        encoders = sorted({name for name, _ in results}, key=['json', 'orjson'].index)
+        for name in encoders:
+            base_q, base_d = results[name, 'per-recipient']
+            once_q, once_d = results[name, 'encode-once']
+            print(f"{count:>10} {name:>7} {base_q:>16.2f} / {base_d:>15.2f} {once_q:>14.2f} / {once_d:>15.2f} "
+                  f"{base_q / once_q:>8.1f}x queued")
+        if 'orjson' in encoders:
+            json_q = results['json', 'per-recipient'][0]
+            orjson_q = results['orjson', 'per-recipient'][0]
+            print(f"{'':>10} orjson vs json, per-recipient encoding alone: {json_q / orjson_q:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Stress ConnectionManager.disconnect with a reconnect-storm sized burst:
+N users, each subscribed to a ride channel, all disconnecting at once.
+Checks that no ride channel or reverse-index entry is left behind, and
+times the old full scan of ride_subscriptions on a smaller burst for
+comparison.
+
+Usage: python benchmarks/bench_disconnect_storm.py [--users N] [--legacy-users N]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from realtime_service import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self, user_id: str):
+        self.client_state = {"user_id": user_id}
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def populate(manager: ConnectionManager, users: int):
+    # Rider and driver share a channel, as after accept_ride
+    for i in range(users):
+        user_id = f"user-{i}"
+        websocket = FakeWebSocket(user_id)
+        await manager.connect(websocket, user_id)
+        await manager.subscribe_to_ride_updates(f"ride_{i // 2}", websocket)
+
+
+def legacy_disconnect(ride_subscriptions: dict, user_id: str):
+    # The cleanup disconnect used to do: scan every ride channel
+    for ride_id, websockets in list(ride_subscriptions.items()):
+        if user_id in [ws.client_state.get("user_id") for ws in websockets]:
+            ride_subscriptions[ride_id] = [
+                ws for ws in websockets if ws.client_state.get("user_id") != user_id
+            ]
+            if not ride_subscriptions[ride_id]:
+                del ride_subscriptions[ride_id]
+
+
+async def storm(users: int) -> float:
+    manager = ConnectionManager()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await populate(manager, users)
+
+        async def drop(user_id: str):
+            manager.disconnect(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(drop(f"user-{i}") for i in range(users)))
+        elapsed = time.perf_counter() - started
+        await manager.shutdown()
+
+    leftovers = (len(manager.ride_subscriptions), len(manager.user_channels),
+                 len(manager.active_connections), len(manager.connection_users))
+    if any(leftovers):
+        raise SystemExit(f"state left behind after disconnect storm: {leftovers}")
+    return elapsed
+
+
+def legacy_storm(users: int) -> float:
+    ride_subscriptions = {}
+    for i in range(users):
+        ride_subscriptions.setdefault(f"ride_{i // 2}", []).append(FakeWebSocket(f"user-{i}"))
+
+    started = time.perf_counter()
+    for i in range(users):
+        legacy_disconnect(ride_subscriptions, f"user-{i}")
+    elapsed = time.perf_counter() - started
+    assert not ride_subscriptions
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--legacy-users', type=int, default=5_000)
+    args = parser.parse_args()
+
+    elapsed = asyncio.run(storm(args.users))
+    print(f"indexed disconnect: {args.users} users in {elapsed * 1000:9.1f} ms "
+          f"({elapsed / args.users * 1e6:6.2f} us/disconnect)")
+
+    legacy = legacy_storm(args.legacy_users)
+    print(f"legacy full scan:   {args.legacy_users} users in {legacy * 1000:9.1f} ms "
+          f"({legacy / args.legacy_users * 1e6:6.2f} us/disconnect)")
+
+
+if __name__ == '__main__':
+    main()
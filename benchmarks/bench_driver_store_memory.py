@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measure memory per driver for the old dict-of-dicts driver_locations layout
+versus DriverLocationStore, and check that slot reuse keeps memory flat
+across disconnect/reconnect churn.
+
+Usage: python benchmarks/bench_driver_store_memory.py [--drivers N]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver_store import DriverLocationStore
+
+
+def random_position(rng: random.Random):
+    return 31.5 + rng.uniform(-0.3, 0.3), 74.3 + rng.uniform(-0.3, 0.3)
+
+
+def build_dict_layout(driver_ids, rng):
+    # The layout ConnectionManager used before: a fresh dict per update
+    locations = {}
+    for driver_id in driver_ids:
+        lat, lng = random_position(rng)
+        locations[driver_id] = {
+            "driver_id": driver_id,
+            "lat": lat,
+            "lng": lng,
+            "heading": rng.uniform(0, 360),
+            "speed": rng.uniform(0, 60),
+            "last_updated": datetime.utcnow().isoformat()
+        }
+    return locations
+
+
+def build_store_layout(driver_ids, rng):
+    store = DriverLocationStore()
+    for driver_id in driver_ids:
+        lat, lng = random_position(rng)
+        store.upsert(driver_id, lat, lng, rng.uniform(0, 360), rng.uniform(0, 60))
+    return store
+
+
+def measure(builder, driver_ids) -> int:
+    gc.collect()
+    tracemalloc.start()
+    result = builder(driver_ids, random.Random(7))
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def churn(store: DriverLocationStore, driver_ids, rounds: int, rng: random.Random):
+    # Half the fleet disconnects and reconnects under new ids each round
+    live = list(driver_ids)
+    for round_no in range(rounds):
+        rng.shuffle(live)
+        leaving, staying = live[:len(live) // 2], live[len(live) // 2:]
+        for driver_id in leaving:
+            store.pop(driver_id)
+        joining = [f"{driver_id}-r{round_no}" for driver_id in leaving]
+        for driver_id in joining:
+            lat, lng = random_position(rng)
+            store.upsert(driver_id, lat, lng)
+        live = staying + joining
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--drivers', type=int, default=50_000)
+    args = parser.parse_args()
+
+    # Driver ids are created outside the measured region; both layouts share them
+    driver_ids = [f"driver-{i:08d}" for i in range(args.drivers)]
+
+    dict_bytes = measure(build_dict_layout, driver_ids)
+    store_bytes = measure(build_store_layout, driver_ids)
+    print(f"drivers: {args.drivers}")
+    print(f"dict-of-dicts:       {dict_bytes / 1024 / 1024:8.2f} MiB  {dict_bytes / args.drivers:7.1f} B/driver")
+    print(f"DriverLocationStore: {store_bytes / 1024 / 1024:8.2f} MiB  {store_bytes / args.drivers:7.1f} B/driver")
+
+    store = build_store_layout(driver_ids, random.Random(7))
+    capacity_before = len(store.lat)
+    churn(store, driver_ids, rounds=10, rng=random.Random(11))
+    print(f"slot capacity before/after 10 churn rounds: {capacity_before} / {len(store.lat)} "
+          f"(high water {store.high_water}, live {len(store)})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Event-loop latency under mixed REST and WebSocket load, with handlers using
+the synchronous Session (as main.py did) versus the AsyncSession.
+
+REST workers replay the hot handlers' queries (login lookup, /api/auth/me,
+ride create/read/update, notifications). WebSocket tasks each expect to run
+every 50 ms, like a driver streaming locations; their lateness is what a
+connected client feels. A probe measures how late a 5 ms sleep wakes up.
+
+Usage: python benchmarks/bench_event_loop_db.py [--rest N] [--sockets M] [--seconds S]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ["DATABASE_PROFILE"] = "bench"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select, update
+
+import database
+from database import AsyncSessionLocal, Base, SessionLocal, async_engine, engine
+from models import Notification, NotificationType, Ride, RideStatus, User, UserType
+
+USERS = 200
+
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    for i in range(USERS):
+        user_id = str(uuid.uuid4())
+        db.add(User(id=user_id, email=f"user{i}@example.com", password_hash="x",
+                    first_name="U", last_name=str(i), user_type=UserType.RIDER))
+        db.add(Notification(user_id=user_id, type=NotificationType.SYSTEM_MESSAGE,
+                            title="Welcome", message="Hello", related_id=None))
+    db.commit()
+    db.close()
+
+
+def sync_request(i: int):
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == f"user{i % USERS}@example.com").first()
+        db.query(User).filter(User.id == user.id).first()
+        ride = Ride(rider_id=user.id, pickup_latitude=31.5, pickup_longitude=74.3,
+                    destination_latitude=31.6, destination_longitude=74.4, fare=250)
+        db.add(ride)
+        db.commit()
+        db.refresh(ride)
+        ride = db.query(Ride).filter(Ride.id == ride.id).first()
+        ride.status = RideStatus.COMPLETED
+        db.commit()
+        db.query(Notification).filter(Notification.user_id == user.id).count()
+    finally:
+        db.close()
+
+
+async def async_request(i: int):
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.email == f"user{i % USERS}@example.com"))
+        await db.scalar(select(User).where(User.id == user.id))
+        ride = Ride(rider_id=user.id, pickup_latitude=31.5, pickup_longitude=74.3,
+                    destination_latitude=31.6, destination_longitude=74.4, fare=250)
+        db.add(ride)
+        await db.commit()
+        await db.refresh(ride)
+        ride = await db.scalar(select(Ride).where(Ride.id == ride.id))
+        ride.status = RideStatus.COMPLETED
+        await db.commit()
+        query = select(Notification).where(Notification.user_id == user.id)
+        await db.scalar(select(func.count()).select_from(query.subquery()))
+
+
+async def run(mode: str, rest_workers: int, sockets: int, seconds: float) -> dict:
+    if mode == "async":
+        await database.report_database_settings()
+    stop_at = time.perf_counter() + seconds
+    requests = 0
+    lateness = []
+    probe = []
+
+    async def rest_worker(w: int):
+        nonlocal requests
+        i = w
+        while time.perf_counter() < stop_at:
+            if mode == "sync":
+                sync_request(i)
+                await asyncio.sleep(0)
+            else:
+                await async_request(i)
+            requests += 1
+            i += rest_workers
+
+    async def socket_client():
+        due = time.perf_counter()
+        while time.perf_counter() < stop_at:
+            due += 0.05
+            await asyncio.sleep(max(due - time.perf_counter(), 0))
+            lateness.append((time.perf_counter() - due) * 1000)
+
+    async def loop_probe():
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            probe.append((time.perf_counter() - started - 0.005) * 1000)
+
+    await asyncio.gather(
+        *(rest_worker(w) for w in range(rest_workers)),
+        *(socket_client() for _ in range(sockets)),
+        loop_probe()
+    )
+    # Pooled aiosqlite connections belong to this event loop
+    await async_engine.dispose()
+    lateness.sort()
+    probe.sort()
+    return {
+        'requests_per_s': requests / seconds,
+        'ws_p50_ms': statistics.median(lateness),
+        'ws_p99_ms': lateness[int(len(lateness) * 0.99) - 1],
+        'loop_p99_ms': probe[int(len(probe) * 0.99) - 1],
+        'loop_max_ms': probe[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rest", type=int, default=16)
+    parser.add_argument("--sockets", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+    seed()
+    print(f"database {database.ASYNC_DATABASE_URL}, {args.rest} REST workers, "
+          f"{args.sockets} sockets, {args.seconds:.0f}s per mode")
+    for mode in ("sync", "async"):
+        result = asyncio.run(run(mode, args.rest, args.sockets, args.seconds))
+        print(f"{mode:>5}: " + ", ".join(f"{k} {v:.1f}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
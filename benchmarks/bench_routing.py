@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Build a synthetic city road grid, contract it, check contraction-hierarchy
+answers against plain Dijkstra on the original graph, and time point-to-point
+and one-to-many (drivers to a pickup) queries.
+
+Usage: python benchmarks/bench_routing.py [--size N] [--queries Q] [--drivers D]
+"""
+import argparse
+import heapq
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routing_engine import RoadRouter, build_graph
+
+
+def grid_city(size: int, rng: random.Random):
+    """size x size intersections ~150 m apart; some one-way streets, faster arterials every 8th road"""
+    step = 0.00135
+    lat = np.array([31.45 + (i // size) * step for i in range(size * size)])
+    lng = np.array([74.25 + (i % size) * step for i in range(size * size)])
+    sources, targets, seconds = [], [], []
+
+    def road(u, w, arterial):
+        speed = 50 if arterial else rng.choice([20, 25, 30])
+        travel = 0.15 / speed * 3600 * rng.uniform(0.9, 1.3)
+        oneway = not arterial and rng.random() < 0.2
+        sources.append(u)
+        targets.append(w)
+        seconds.append(travel)
+        if not oneway:
+            sources.append(w)
+            targets.append(u)
+            seconds.append(travel)
+
+    for r in range(size):
+        for c in range(size):
+            u = r * size + c
+            if c + 1 < size:
+                road(u, u + 1, r % 8 == 0)
+            if r + 1 < size:
+                road(u, u + size, c % 8 == 0)
+    return lat, lng, sources, targets, seconds
+
+
+def dijkstra(n, sources, targets, seconds, start):
+    adjacency = [[] for _ in range(n)]
+    for u, w, c in zip(sources, targets, seconds):
+        adjacency[u].append((w, c))
+    dist = [math.inf] * n
+    dist[start] = 0.0
+    heap = [(0.0, start)]
+    while heap:
+        d, x = heapq.heappop(heap)
+        if d > dist[x]:
+            continue
+        for y, c in adjacency[x]:
+            if d + c < dist[y]:
+                dist[y] = d + c
+                heapq.heappush(heap, (d + c, y))
+    return dist
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=60)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--drivers", type=int, default=50)
+    args = parser.parse_args()
+    rng = random.Random(7)
+
+    lat, lng, sources, targets, seconds = grid_city(args.size, rng)
+    n = len(lat)
+    path = os.path.join(tempfile.mkdtemp(), "city.rgraph")
+    started = time.perf_counter()
+    build_graph(lat, lng, sources, targets, seconds, path)
+    print(f"contracted {n} nodes / {len(sources)} edges in {time.perf_counter() - started:.1f}s "
+          f"({os.path.getsize(path) / 1024:.0f} KiB)")
+
+    router = RoadRouter.load(path)
+
+    # Correctness against Dijkstra on the uncontracted graph
+    for _ in range(5):
+        s = rng.randrange(n)
+        truth = dijkstra(n, sources, targets, seconds, s)
+        for t in rng.sample(range(n), 50):
+            got = router.node_seconds(s, t)
+            assert math.isclose(got, truth[t], rel_tol=1e-4, abs_tol=1e-3), (s, t, got, truth[t])
+    print("matches Dijkstra on 250 random pairs")
+
+    pairs = [(rng.randrange(n), rng.randrange(n)) for _ in range(args.queries)]
+    started = time.perf_counter()
+    for s, t in pairs:
+        router.node_seconds(s, t)
+    per_query = (time.perf_counter() - started) / len(pairs) * 1000
+    print(f"point-to-point: {per_query:.3f} ms/query")
+
+    started = time.perf_counter()
+    for _ in range(100):
+        t = rng.randrange(n)
+        origins = [(float(lat[i]), float(lng[i])) for i in rng.sample(range(n), args.drivers)]
+        router.seconds_to(float(lat[t]), float(lng[t]), origins)
+    per_batch = (time.perf_counter() - started) / 100 * 1000
+    print(f"{args.drivers} drivers to one pickup (incl. snapping): {per_batch:.3f} ms "
+          f"({per_batch / args.drivers:.3f} ms/driver)")
+
+
+if __name__ == "__main__":
+    main()
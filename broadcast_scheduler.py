@@ -0,0 +1,110 @@
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import time
+
+
+class BroadcastScheduler:
+    """
+    Coalesces driver location changes into a dirty set and flushes them once
+    per tick, so outbound volume follows the tick rate rather than the number
+    of drivers reporting.
+
+    The flush callback receives {driver_id: (lat, lng) at the start of the
+    tick} (None if the driver was new this tick) and returns how many
+    envelopes it sent.
+    """
+
+    def __init__(self, flush: Callable[[Dict[str, Optional[Tuple[float, float]]]], Awaitable[int]],
+                 tick_seconds: float = 0.5):
+        self.flush_callback = flush
+        self.tick_seconds = tick_seconds
+        self.dirty: Dict[str, Optional[Tuple[float, float]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        # Metrics
+        self.ticks = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_tick_lag_ms = 0.0
+        self.last_batch_drivers = 0
+        self.last_batch_envelopes = 0
+        self.max_batch_drivers = 0
+        self.total_drivers_flushed = 0
+        self.total_envelopes_sent = 0
+
+    def mark_dirty(self, driver_id: str, prev_position: Optional[Tuple[float, float]]):
+        """Record a change; the earliest previous position within a tick wins"""
+        if driver_id not in self.dirty:
+            self.dirty[driver_id] = prev_position
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f"Driver broadcast scheduler started (tick {self.tick_seconds * 1000:.0f} ms)")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Deliver whatever was collected during the final partial tick
+        await self.flush()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick_seconds
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self.last_tick_lag_ms = max(0.0, (loop.time() - next_tick) * 1000)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing driver broadcasts: {str(e)}")
+            next_tick += self.tick_seconds
+            # Skip ticks we have fallen behind on instead of flushing back-to-back
+            if next_tick < loop.time():
+                next_tick = loop.time() + self.tick_seconds
+
+    async def flush(self) -> int:
+        """Send one batched envelope per affected subscriber"""
+        if not self.dirty:
+            return 0
+        batch, self.dirty = self.dirty, {}
+
+        started = time.perf_counter()
+        envelopes = await self.flush_callback(batch)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.ticks += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.last_batch_drivers = len(batch)
+        self.last_batch_envelopes = envelopes
+        self.max_batch_drivers = max(self.max_batch_drivers, len(batch))
+        self.total_drivers_flushed += len(batch)
+        self.total_envelopes_sent += envelopes
+        return envelopes
+
+    def stats(self) -> dict:
+        return {
+            'tick_ms': self.tick_seconds * 1000,
+            'running': self.running,
+            'pending_drivers': len(self.dirty),
+            'ticks': self.ticks,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'last_tick_lag_ms': round(self.last_tick_lag_ms, 3),
+            'last_batch_drivers': self.last_batch_drivers,
+            'last_batch_envelopes': self.last_batch_envelopes,
+            'max_batch_drivers': self.max_batch_drivers,
+            'avg_batch_drivers': round(self.total_drivers_flushed / self.ticks, 2) if self.ticks else 0,
+            'total_envelopes_sent': self.total_envelopes_sent
+        }
@@ -1,6 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
 from dotenv import load_dotenv
 
@@ -9,21 +12,137 @@ load_dotenv()
 # Use SQLite instead of PostgreSQL for easier setup
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
 
-# Check if using SQLite and add connect_args if needed
-if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+# Engine settings by deployment; pick one with DATABASE_PROFILE
+ENGINE_PROFILES = {
+    # Local development: SQL logging on, small pools
+    "dev": {
+        "echo": True,
+        "sqlite_synchronous": "NORMAL",
+        "sqlite_cache_size_kib": 16 * 1024,
+        "sqlite_mmap_size_mb": 64,
+        "sqlite_busy_timeout_ms": 5000,
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout_seconds": 30,
+        "pool_recycle_seconds": 1800,
+        "pool_pre_ping": True
+    },
+    # Load tests: no logging, larger caches and pools
+    "bench": {
+        "echo": False,
+        "sqlite_synchronous": "NORMAL",
+        "sqlite_cache_size_kib": 64 * 1024,
+        "sqlite_mmap_size_mb": 256,
+        "sqlite_busy_timeout_ms": 10000,
+        "pool_size": 20,
+        "max_overflow": 20,
+        "pool_timeout_seconds": 10,
+        "pool_recycle_seconds": 1800,
+        "pool_pre_ping": False
+    },
+    # Production: no logging, pooled connections checked before use and recycled
+    "prod": {
+        "echo": False,
+        "sqlite_synchronous": "NORMAL",
+        "sqlite_cache_size_kib": 64 * 1024,
+        "sqlite_mmap_size_mb": 256,
+        "sqlite_busy_timeout_ms": 5000,
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout_seconds": 10,
+        "pool_recycle_seconds": 1800,
+        "pool_pre_ping": True
+    }
+}
+
+DATABASE_PROFILE = os.getenv("DATABASE_PROFILE", "dev")
+if DATABASE_PROFILE not in ENGINE_PROFILES:
+    raise ValueError(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}; choose one of {', '.join(ENGINE_PROFILES)}")
+ENGINE_PROFILE = ENGINE_PROFILES[DATABASE_PROFILE]
+
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+# In-memory SQLite lives in one connection, so it keeps SQLAlchemy's single-connection pools
+IS_SQLITE_MEMORY = IS_SQLITE and make_url(SQLALCHEMY_DATABASE_URL).database in (None, "", ":memory:")
+
+def engine_options(profile: dict) -> dict:
+    """create_engine keyword arguments for a profile"""
+    if IS_SQLITE_MEMORY:
+        return {"echo": profile["echo"]}
+    if IS_SQLITE:
+        # Pooled so connections keep their PRAGMAs and page cache between requests;
+        # SQLite connections don't go stale, so no pre-ping or recycling
+        return {
+            "echo": profile["echo"],
+            "pool_size": profile["pool_size"],
+            "max_overflow": profile["max_overflow"],
+            "pool_timeout": profile["pool_timeout_seconds"]
+        }
+    return {
+        "echo": profile["echo"],
+        "pool_size": profile["pool_size"],
+        "max_overflow": profile["max_overflow"],
+        "pool_timeout": profile["pool_timeout_seconds"],
+        "pool_recycle": profile["pool_recycle_seconds"],
+        "pool_pre_ping": profile["pool_pre_ping"]
+    }
+
+def sqlite_pragmas(profile: dict) -> dict:
+    """
+    Applied once per new SQLite connection; pooled connections keep them.
+    WAL lets readers continue while a location flush commits;
+    synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode.
+    """
+    return {
+        "journal_mode": "WAL",
+        "synchronous": profile["sqlite_synchronous"],
+        "cache_size": -profile["sqlite_cache_size_kib"],  # Negative means KiB rather than pages
+        "mmap_size": profile["sqlite_mmap_size_mb"] * 1024 * 1024,
+        "busy_timeout": profile["sqlite_busy_timeout_ms"]
+    }
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas(ENGINE_PROFILE).items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+if IS_SQLITE:
     engine = create_engine(
-        SQLALCHEMY_DATABASE_URL, 
+        SQLALCHEMY_DATABASE_URL,
         connect_args={"check_same_thread": False},
-        echo=True  # Enable SQL logging
+        **engine_options(ENGINE_PROFILE)
     )
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
 else:
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL,
-        echo=True  # Enable SQL logging
-    )
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(ENGINE_PROFILE))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def async_database_url(url: str) -> str:
+    """The same database through an asyncio driver: aiosqlite for SQLite, asyncpg for Postgres"""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith(("postgresql://", "postgresql+psycopg2://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+# Async engine for request handlers and the WebSocket loop, so queries don't block the event loop
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_database_url(SQLALCHEMY_DATABASE_URL))
+if IS_SQLITE and not IS_SQLITE_MEMORY:
+    # aiosqlite defaults to NullPool, which would reconnect (and re-run the PRAGMAs) per request
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, **engine_options(ENGINE_PROFILE)
+    )
+else:
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ENGINE_PROFILE))
+if IS_SQLITE:
+    event.listen(async_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+
+# Objects stay readable after commit; lazy refreshes are not possible on an async session
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -35,4 +154,33 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    """
+    Async counterpart of get_db: one AsyncSession per request or WebSocket,
+    closed when it is done.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def report_database_settings():
+    """
+    Print the profile and the settings the database actually reports, once at
+    startup. Reading them through the async engine also makes its first
+    connection before traffic arrives: concurrent first connects on a pooled
+    async engine can deadlock in SQLAlchemy's one-time dialect setup.
+    """
+    url = make_url(SQLALCHEMY_DATABASE_URL).render_as_string(hide_password=True)
+    print(f"Database profile '{DATABASE_PROFILE}': {url} (echo={ENGINE_PROFILE['echo']})")
+    async with async_engine.connect() as connection:
+        if IS_SQLITE:
+            effective = {
+                name: (await connection.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                for name in sqlite_pragmas(ENGINE_PROFILE)
+            }
+            print("  SQLite " + ", ".join(f"{name}={value}" for name, value in effective.items()))
+    options = {name: value for name, value in engine_options(ENGINE_PROFILE).items() if name != "echo"}
+    print(f"  Pool {type(engine.pool).__name__} " + ", ".join(f"{name}={value}" for name, value in options.items()))
+    print(f"  Async engine: {make_url(ASYNC_DATABASE_URL).render_as_string(hide_password=True)} "
+          f"({type(async_engine.pool).__name__})")
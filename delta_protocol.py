@@ -0,0 +1,142 @@
+from typing import Dict, List, Optional, Tuple
+import time
+
+from frame_codec import EncodedFrame, encode_json, join_json_array
+
+# Frame types sent to map viewers
+KEYFRAME_TYPE = 'driver_locations_keyframe'
+DELTA_TYPE = 'driver_locations_delta'
+
+
+class ViewerFrameState:
+    """Sequence bookkeeping for one client receiving driver location frames"""
+
+    __slots__ = ("seq", "acked_seq", "base_seq", "changes", "frames_since_keyframe",
+                 "last_keyframe_at", "needs_keyframe")
+
+    def __init__(self):
+        self.seq = 0
+        self.acked_seq = 0
+        self.base_seq = 0  # Latest state the client is known to hold: last ack or keyframe
+        # Driver -> (seq of its last change, fragment or None if removed), for changes after base_seq
+        self.changes: Dict[str, Tuple[int, Optional[str]]] = {}
+        self.frames_since_keyframe = 0
+        self.last_keyframe_at = 0.0
+        self.needs_keyframe = True
+
+
+class DeltaFrameProtocol:
+    """
+    Versioned driver location frames. Each viewer gets its own sequence; a
+    keyframe carries everything the viewer can see, and a delta frame carries
+    the latest state of every driver added, moved or removed since
+    `base_seq`: the last frame the client acknowledged, or the last keyframe
+    if that is newer. Deltas are therefore cumulative until acked, so a
+    client holding any frame from base_seq on can apply the next delta, and
+    a lost delta is repaired by the one after it instead of by a keyframe.
+    Frames are assembled from per-driver JSON fragments that the caller
+    encodes once per location change and reuses across viewers.
+
+    A keyframe is sent on subscribe, every `keyframe_interval` frames or
+    `keyframe_seconds`, when the client asks to resync, when a keyframe was
+    dropped before delivery, and when the client has more than
+    `max_unacked_frames` frames outstanding (which also bounds delta size).
+    """
+
+    def __init__(self, keyframe_interval: int = 20, keyframe_seconds: float = 30.0,
+                 max_unacked_frames: int = 10):
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_seconds = keyframe_seconds
+        self.max_unacked_frames = max_unacked_frames
+        self.viewers: Dict[str, ViewerFrameState] = {}
+
+        self.keyframes_sent = 0
+        self.deltas_sent = 0
+
+    def register(self, user_id: str):
+        """Start (or restart) a viewer's frame sequence with a keyframe"""
+        state = self.viewers.get(user_id)
+        if state is None:
+            self.viewers[user_id] = ViewerFrameState()
+        else:
+            state.needs_keyframe = True
+
+    def unregister(self, user_id: str):
+        self.viewers.pop(user_id, None)
+
+    def ack(self, user_id: str, seq: int):
+        state = self.viewers.get(user_id)
+        if state is not None and state.acked_seq < seq <= state.seq:
+            state.acked_seq = seq
+            if seq > state.base_seq:
+                # The client has every change up to seq; later deltas can leave them out
+                state.base_seq = seq
+                state.changes = {
+                    driver_id: change for driver_id, change in state.changes.items() if change[0] > seq
+                }
+
+    def request_keyframe(self, user_id: str):
+        """Force the next frame to a viewer to be a keyframe (resync or lost frame)"""
+        state = self.viewers.get(user_id)
+        if state is not None:
+            state.needs_keyframe = True
+
+    def wants_keyframe(self, user_id: str) -> bool:
+        state = self.viewers.get(user_id)
+        if state is None:
+            return False
+        return (
+            state.needs_keyframe
+            or state.frames_since_keyframe >= self.keyframe_interval
+            or time.monotonic() - state.last_keyframe_at >= self.keyframe_seconds
+            or state.seq - state.acked_seq > self.max_unacked_frames
+        )
+
+    def keyframe(self, user_id: str, driver_fragments: List[str]) -> Optional[EncodedFrame]:
+        state = self.viewers.get(user_id)
+        if state is None:
+            return None
+        state.seq += 1
+        state.frames_since_keyframe = 0
+        state.last_keyframe_at = time.monotonic()
+        state.needs_keyframe = False
+        # A keyframe replaces everything, so outstanding deltas no longer matter
+        state.acked_seq = state.seq - 1
+        state.base_seq = state.seq
+        state.changes = {}
+        self.keyframes_sent += 1
+        text = (
+            f'{{"type":"{KEYFRAME_TYPE}","seq":{state.seq},'
+            f'"drivers":{join_json_array(driver_fragments)}}}'
+        )
+        return EncodedFrame(text, KEYFRAME_TYPE)
+
+    def delta(self, user_id: str, upserts: Dict[str, str], removed: List[str]) -> Optional[EncodedFrame]:
+        """
+        Record this tick's changes (driver -> fragment, and removed drivers)
+        and build a frame with every change the client may not have yet
+        """
+        state = self.viewers.get(user_id)
+        if state is None:
+            return None
+        state.seq += 1
+        state.frames_since_keyframe += 1
+        for driver_id in removed:
+            state.changes[driver_id] = (state.seq, None)
+        for driver_id, fragment in upserts.items():
+            state.changes[driver_id] = (state.seq, fragment)
+        upsert_fragments = [fragment for _seq, fragment in state.changes.values() if fragment is not None]
+        removed_ids = [driver_id for driver_id, (_seq, fragment) in state.changes.items() if fragment is None]
+        self.deltas_sent += 1
+        text = (
+            f'{{"type":"{DELTA_TYPE}","seq":{state.seq},"base_seq":{state.base_seq},'
+            f'"upserts":{join_json_array(upsert_fragments)},"removed":{encode_json(removed_ids)}}}'
+        )
+        return EncodedFrame(text, DELTA_TYPE)
+
+    def stats(self) -> dict:
+        return {
+            'viewers': len(self.viewers),
+            'keyframes_sent': self.keyframes_sent,
+            'deltas_sent': self.deltas_sent
+        }
@@ -0,0 +1,376 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import os
+import time
+import numpy as np
+
+from routing_engine import RoadRouter
+
+# Requests and idle drivers are collected for this long, then assigned in one batch
+DISPATCH_WINDOW_MS = int(os.getenv("DISPATCH_WINDOW_MS", "2000"))
+# Drivers farther than this from a pickup are not considered for it
+DISPATCH_MAX_PICKUP_KM = float(os.getenv("DISPATCH_MAX_PICKUP_KM", "5.0"))
+# Average city speed used to turn pickup distance into an ETA when there is no road route
+DISPATCH_AVG_SPEED_KMH = float(os.getenv("DISPATCH_AVG_SPEED_KMH", "25"))
+# Batches with at most this many requests and drivers are solved optimally
+DISPATCH_OPTIMAL_MAX = int(os.getenv("DISPATCH_OPTIMAL_MAX", "60"))
+# A driver who does not accept an offer within this many seconds loses it
+DISPATCH_OFFER_TIMEOUT_SECONDS = float(os.getenv("DISPATCH_OFFER_TIMEOUT_SECONDS", "20"))
+# Batches with fewer candidate pairs are solved inline; larger ones go to the worker pool
+DISPATCH_INLINE_MAX_PAIRS = int(os.getenv("DISPATCH_INLINE_MAX_PAIRS", "256"))
+# With a road graph each pair costs a route query, so the inline limit is lower
+DISPATCH_INLINE_MAX_ROUTED_PAIRS = int(os.getenv("DISPATCH_INLINE_MAX_ROUTED_PAIRS", "32"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "1"))
+
+METHOD_OPTIMAL = "optimal"
+METHOD_GREEDY = "greedy"
+
+# Cost used for request/driver pairs that are not candidates
+_NO_PAIR = 1e9
+
+# Road graph of a worker process, handed over by the pool initializer
+_worker_router: Optional[RoadRouter] = None
+
+
+def _init_worker(router: Optional[RoadRouter]):
+    global _worker_router
+    _worker_router = router
+
+
+def hungarian(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Minimum-cost assignment for a rows x cols cost matrix with rows <= cols
+    (Kuhn-Munkres with potentials, O(rows^2 * cols)). Returns (row, col) pairs.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # p[j]: row matched to column j (1-based, 0 = free)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            # Reduced costs from row i0 to every free column, vectorized
+            free = ~used[1:]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    return [(int(p[j]) - 1, j - 1) for j in range(1, m + 1) if p[j]]
+
+
+def greedy(pair_req: np.ndarray, pair_drv: np.ndarray, pair_cost: np.ndarray) -> List[int]:
+    """Take candidate pairs cheapest first, skipping requests or drivers already used"""
+    taken_req: Set[int] = set()
+    taken_drv: Set[int] = set()
+    chosen = []
+    for k in np.argsort(pair_cost, kind="stable"):
+        r, d = int(pair_req[k]), int(pair_drv[k])
+        if r in taken_req or d in taken_drv:
+            continue
+        taken_req.add(r)
+        taken_drv.add(d)
+        chosen.append(int(k))
+    return chosen
+
+
+def solve_assignment(pair_req: np.ndarray, pair_drv: np.ndarray, pair_km: np.ndarray,
+                     n_requests: int, n_drivers: int, pair_eta: Optional[np.ndarray] = None,
+                     avg_speed_kmh: float = DISPATCH_AVG_SPEED_KMH,
+                     optimal_max: int = DISPATCH_OPTIMAL_MAX) -> Tuple[str, List[Tuple[int, int, float, float]]]:
+    """
+    Assign at most one driver per request, minimizing pickup ETA. Runs in the
+    worker pool, so it only takes and returns plain arrays and tuples.
+    `pair_eta` holds road ETAs in minutes; without it ETAs are estimated from
+    distance at `avg_speed_kmh`.
+    Returns (method, [(request_idx, driver_idx, eta_minutes, distance_km)]).
+    """
+    if pair_eta is None:
+        pair_eta = pair_km / avg_speed_kmh * 60
+    if n_requests <= optimal_max and n_drivers <= optimal_max:
+        cost = np.full((n_requests, n_drivers), _NO_PAIR)
+        cost[pair_req, pair_drv] = pair_eta
+        transpose = n_requests > n_drivers
+        matched = hungarian(cost.T if transpose else cost)
+        pair_of = {(int(r), int(d)): k for k, (r, d) in enumerate(zip(pair_req, pair_drv))}
+        chosen = []
+        for a, b in matched:
+            r, d = (b, a) if transpose else (a, b)
+            k = pair_of.get((r, d))
+            if k is not None:
+                chosen.append(k)
+        method = METHOD_OPTIMAL
+    else:
+        chosen = greedy(pair_req, pair_drv, pair_eta)
+        method = METHOD_GREEDY
+    return method, [
+        (int(pair_req[k]), int(pair_drv[k]), float(pair_eta[k]), float(pair_km[k]))
+        for k in chosen
+    ]
+
+
+def pair_etas(router: Optional[RoadRouter], pickups: np.ndarray, driver_positions: np.ndarray,
+              pair_req: np.ndarray, pair_drv: np.ndarray, pair_km: np.ndarray,
+              avg_speed_kmh: float = DISPATCH_AVG_SPEED_KMH) -> np.ndarray:
+    """
+    Pickup ETAs in minutes for candidate pairs: one road query per request
+    over all its drivers, and distance at `avg_speed_kmh` for pairs off the
+    graph (or for every pair without a router).
+    """
+    eta = pair_km / avg_speed_kmh * 60
+    if router is None:
+        return eta
+    by_request: Dict[int, List[int]] = {}
+    for k, r in enumerate(pair_req.tolist()):
+        by_request.setdefault(r, []).append(k)
+    for r, ks in by_request.items():
+        origins = [(float(driver_positions[d, 0]), float(driver_positions[d, 1])) for d in pair_drv[ks]]
+        seconds = router.seconds_to(float(pickups[r, 0]), float(pickups[r, 1]), origins)
+        for k, value in zip(ks, seconds):
+            if value is not None:
+                eta[k] = value / 60
+    return eta
+
+
+def solve_routed(pair_req: np.ndarray, pair_drv: np.ndarray, pair_km: np.ndarray,
+                 n_requests: int, n_drivers: int, pickups: np.ndarray,
+                 driver_positions: np.ndarray) -> Tuple[str, List[Tuple[int, int, float, float]]]:
+    """solve_assignment with the ETAs computed in the worker from its road graph"""
+    eta = pair_etas(_worker_router, pickups, driver_positions, pair_req, pair_drv, pair_km)
+    return solve_assignment(pair_req, pair_drv, pair_km, n_requests, n_drivers, eta)
+
+
+class DispatchBatch:
+    """Candidate request/driver pairs gathered for one dispatch window"""
+
+    __slots__ = ("rider_ids", "driver_ids", "pair_req", "pair_drv", "pair_km", "pickups",
+                 "driver_positions", "pair_eta")
+
+    def __init__(self, rider_ids: List[str], driver_ids: List[str],
+                 pair_req: np.ndarray, pair_drv: np.ndarray, pair_km: np.ndarray,
+                 pickups: np.ndarray, driver_positions: np.ndarray,
+                 pair_eta: Optional[np.ndarray] = None):
+        self.rider_ids = rider_ids
+        self.driver_ids = driver_ids
+        self.pair_req = pair_req
+        self.pair_drv = pair_drv
+        self.pair_km = pair_km
+        self.pickups = pickups  # (lat, lng) per request
+        self.driver_positions = driver_positions  # (lat, lng) per driver
+        self.pair_eta = pair_eta  # ETAs in minutes if already known; otherwise computed by the engine
+
+
+class DispatchEngine:
+    """
+    Assigns open ride requests to idle drivers once per window instead of
+    offering each request to every nearby driver. Each request has at most
+    one outstanding offer; if the driver lets it lapse, `on_lapse(driver_id,
+    rider_id)` withdraws it from them and the request goes back into the next
+    window without that driver.
+
+    `build_batch(rider_ids)` returns the candidate pairs for the open
+    requests (the caller owns the spatial indexes and knows which drivers are
+    idle) and `send_offer(driver_id, rider_id, distance_km, eta_minutes)`
+    delivers an offer, returning False if it could not be sent. Large
+    batches are solved in a process pool so the event loop keeps serving
+    sockets; with a road graph the pool also computes the pickup ETAs, which
+    cost far more than the solve.
+    """
+
+    def __init__(self, build_batch: Callable[[List[str]], Optional[DispatchBatch]],
+                 send_offer: Callable[[str, str, float, float], bool],
+                 window_seconds: float = DISPATCH_WINDOW_MS / 1000,
+                 offer_timeout_seconds: float = DISPATCH_OFFER_TIMEOUT_SECONDS,
+                 workers: int = DISPATCH_WORKERS, router: Optional[RoadRouter] = None,
+                 on_lapse: Optional[Callable[[str, str], None]] = None):
+        self.build_batch = build_batch
+        self.send_offer = send_offer
+        self.on_lapse = on_lapse
+        self.window_seconds = window_seconds
+        self.offer_timeout_seconds = offer_timeout_seconds
+        self.workers = workers
+        self.router = router  # Road graph for pickup ETAs; None for distance at average speed
+        self.pending: Set[str] = set()  # Riders waiting for an offer
+        self.offers: Dict[str, Tuple[str, float]] = {}  # Rider -> (driver, deadline)
+        self.offered_drivers: Dict[str, str] = {}  # Driver -> rider they hold an offer for
+        self.passed: Dict[str, Set[str]] = {}  # Rider -> drivers whose offer lapsed
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.windows = 0
+        self.offers_sent = 0
+        self.offers_lapsed = 0
+        self.methods: Dict[str, int] = {}
+        self.last_batch = {'requests': 0, 'drivers': 0, 'pairs': 0, 'assigned': 0}
+        self.last_solve_ms = 0.0
+        self.max_solve_ms = 0.0
+
+    def submit(self, rider_id: str):
+        """Queue a request for the next window"""
+        self.withdraw(rider_id)
+        self.pending.add(rider_id)
+
+    def withdraw(self, rider_id: str):
+        """Forget a request (cancelled, expired or fulfilled)"""
+        self.pending.discard(rider_id)
+        self.passed.pop(rider_id, None)
+        offer = self.offers.pop(rider_id, None)
+        if offer is not None:
+            self.offered_drivers.pop(offer[0], None)
+
+    def is_offered(self, driver_id: str) -> bool:
+        """Whether the driver is holding an offer (and so is not idle)"""
+        return driver_id in self.offered_drivers
+
+    def passed_by(self, rider_id: str) -> Set[str]:
+        return self.passed.get(rider_id, set())
+
+    def fulfil(self, driver_id: str) -> Optional[str]:
+        """The driver took a ride; returns the rider whose offer they held"""
+        rider_id = self.offered_drivers.get(driver_id)
+        if rider_id is not None:
+            self.withdraw(rider_id)
+        return rider_id
+
+    def driver_gone(self, driver_id: str):
+        """Return a disconnected driver's offer to the pool"""
+        rider_id = self.offered_drivers.pop(driver_id, None)
+        if rider_id is not None:
+            self.offers.pop(rider_id, None)
+            self.pending.add(rider_id)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f"Dispatch engine started (window {self.window_seconds * 1000:.0f} ms)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.window_seconds)
+            try:
+                await self.run_window()
+            except Exception as e:
+                print(f"Error running dispatch window: {str(e)}")
+
+    def _lapse_offers(self, now: float):
+        for rider_id, (driver_id, deadline) in list(self.offers.items()):
+            if deadline <= now:
+                del self.offers[rider_id]
+                self.offered_drivers.pop(driver_id, None)
+                self.passed.setdefault(rider_id, set()).add(driver_id)
+                # Withdraw it from the driver before anyone else is offered it
+                if self.on_lapse is not None:
+                    self.on_lapse(driver_id, rider_id)
+                self.pending.add(rider_id)
+                self.offers_lapsed += 1
+
+    async def run_window(self) -> int:
+        """Assign the open requests gathered so far; returns offers sent"""
+        self._lapse_offers(time.monotonic())
+        if not self.pending:
+            return 0
+        batch = self.build_batch(list(self.pending))
+        if batch is None or not len(batch.pair_req):
+            return 0
+
+        started = time.perf_counter()
+        pairs = len(batch.pair_req)
+        routed = self.router is not None and batch.pair_eta is None
+        inline_max = DISPATCH_INLINE_MAX_ROUTED_PAIRS if routed else DISPATCH_INLINE_MAX_PAIRS
+        shape = (batch.pair_req, batch.pair_drv, batch.pair_km, len(batch.rider_ids), len(batch.driver_ids))
+        if pairs <= inline_max:
+            pair_eta = batch.pair_eta
+            if routed:
+                pair_eta = pair_etas(self.router, batch.pickups, batch.driver_positions,
+                                     batch.pair_req, batch.pair_drv, batch.pair_km)
+            method, assignments = solve_assignment(*shape, pair_eta)
+        else:
+            if self._executor is None:
+                # Workers get the road graph once, at start (inherited when processes fork)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker, initargs=(self.router,)
+                )
+            if routed:
+                solve, args = solve_routed, (*shape, batch.pickups, batch.driver_positions)
+            else:
+                solve, args = solve_assignment, (*shape, batch.pair_eta)
+            method, assignments = await asyncio.get_running_loop().run_in_executor(
+                self._executor, solve, *args
+            )
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        # Requests may have been cancelled and drivers taken while solving
+        sent = 0
+        deadline = time.monotonic() + self.offer_timeout_seconds
+        for r, d, eta_minutes, distance_km in assignments:
+            rider_id, driver_id = batch.rider_ids[r], batch.driver_ids[d]
+            if rider_id not in self.pending or driver_id in self.offered_drivers:
+                continue
+            if self.send_offer(driver_id, rider_id, distance_km, eta_minutes):
+                self.pending.discard(rider_id)
+                self.offers[rider_id] = (driver_id, deadline)
+                self.offered_drivers[driver_id] = rider_id
+                sent += 1
+
+        self.windows += 1
+        self.offers_sent += sent
+        self.methods[method] = self.methods.get(method, 0) + 1
+        self.last_batch = {
+            'requests': len(batch.rider_ids),
+            'drivers': len(batch.driver_ids),
+            'pairs': int(len(batch.pair_req)),
+            'assigned': sent
+        }
+        self.last_solve_ms = elapsed_ms
+        self.max_solve_ms = max(self.max_solve_ms, elapsed_ms)
+        return sent
+
+    def stats(self) -> dict:
+        return {
+            'window_ms': self.window_seconds * 1000,
+            'running': self.running,
+            'pending_requests': len(self.pending),
+            'outstanding_offers': len(self.offers),
+            'windows': self.windows,
+            'offers_sent': self.offers_sent,
+            'offers_lapsed': self.offers_lapsed,
+            'methods': dict(self.methods),
+            'last_batch': dict(self.last_batch),
+            'last_solve_ms': round(self.last_solve_ms, 3),
+            'max_solve_ms': round(self.max_solve_ms, 3)
+        }
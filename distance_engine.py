@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+from geo_index import EARTH_RADIUS_KM
+
+# The equirectangular approximation is within ~0.5% of haversine at city
+# scale; the prefilter keeps candidates up to this factor past the radius so
+# nothing near the boundary is dropped before the exact check.
+PREFILTER_SLACK = 1.02
+
+
+def equirectangular_many(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Approximate distances in km from one point to many (cheap prefilter)"""
+    lat_r = np.radians(lat)
+    x = np.radians(lngs - lng) * np.cos((np.radians(lats) + lat_r) / 2)
+    y = np.radians(lats - lat)
+    return EARTH_RADIUS_KM * np.sqrt(x * x + y * y)
+
+
+def haversine_many(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Exact great-circle distances in km from one point to many"""
+    lat_r = np.radians(lat)
+    lats_r = np.radians(lats)
+    dlat = lats_r - lat_r
+    dlng = np.radians(lngs - lng)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat_r) * np.cos(lats_r) * np.sin(dlng / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine_matrix(lats1: np.ndarray, lngs1: np.ndarray,
+                     lats2: np.ndarray, lngs2: np.ndarray) -> np.ndarray:
+    """Great-circle distances in km between every pair, shape (len1, len2)"""
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    dlat = lat2 - lat1
+    dlng = np.radians(np.asarray(lngs2, dtype=np.float64)[None, :] - np.asarray(lngs1, dtype=np.float64)[:, None])
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def within_radius(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray,
+                  radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return (indices, distances_km) of points within radius_km, nearest first.
+    Runs the equirectangular prefilter over all points and the exact
+    haversine only over the survivors.
+    """
+    approx = equirectangular_many(lat, lng, lats, lngs)
+    candidates = np.nonzero(approx <= radius_km * PREFILTER_SLACK)[0]
+    if candidates.size == 0:
+        return candidates, np.empty(0, dtype=np.float64)
+
+    exact = haversine_many(lat, lng, lats[candidates], lngs[candidates])
+    keep = exact <= radius_km
+    indices = candidates[keep]
+    distances = exact[keep]
+    order = np.argsort(distances, kind="stable")
+    return indices[order], distances[order]
+
+
+class CoordinateArrays:
+    """
+    Keyed lat/lng storage in contiguous float64 arrays so distance queries can
+    run as a single vectorized call. Removed slots are recycled, so the arrays
+    only grow with the peak number of live entries.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.lat = np.zeros(capacity, dtype=np.float64)
+        self.lng = np.zeros(capacity, dtype=np.float64)
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.slots: Dict[str, int] = {}
+        self.free_slots: List[int] = []
+        self.high_water = 0  # Slots [0, high_water) have been handed out
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.slots
+
+    def slot_of(self, key: str) -> Optional[int]:
+        return self.slots.get(key)
+
+    def set(self, key: str, lat: float, lng: float) -> int:
+        """Insert or update a key's coordinates and return its slot"""
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._allocate_slot()
+            self.slots[key] = slot
+            self.keys[slot] = key
+        self.lat[slot] = lat
+        self.lng[slot] = lng
+        return slot
+
+    def remove(self, key: str) -> bool:
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return False
+        self.keys[slot] = None
+        self.free_slots.append(slot)
+        return True
+
+    def _allocate_slot(self) -> int:
+        if self.free_slots:
+            return self.free_slots.pop()
+        if self.high_water == len(self.lat):
+            self._grow(len(self.lat) * 2)
+        slot = self.high_water
+        self.high_water += 1
+        return slot
+
+    def _grow(self, capacity: int):
+        self.lat = np.resize(self.lat, capacity)
+        self.lng = np.resize(self.lng, capacity)
+        self.keys.extend([None] * (capacity - len(self.keys)))
+
+    def _live_slots(self) -> np.ndarray:
+        return np.fromiter(self.slots.values(), dtype=np.intp, count=len(self.slots))
+
+    def slots_for(self, keys: Iterable[str]) -> np.ndarray:
+        """Map keys to slots, skipping unknown keys"""
+        slots = self.slots
+        return np.fromiter((slots[k] for k in keys if k in slots), dtype=np.intp)
+
+    def distances(self, lat: float, lng: float, slots: Optional[np.ndarray] = None) -> np.ndarray:
+        """Exact distances in km from a point to the given slots (default: all live)"""
+        if slots is None:
+            slots = self._live_slots()
+        return haversine_many(lat, lng, self.lat[slots], self.lng[slots])
+
+    def query_radius(self, lat: float, lng: float, radius_km: float,
+                     slots: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """Return (key, distance_km) pairs within radius_km, nearest first"""
+        if slots is None:
+            slots = self._live_slots()
+        if len(slots) == 0:
+            return []
+        indices, distances = within_radius(lat, lng, self.lat[slots], self.lng[slots], radius_km)
+        keys = self.keys
+        return [(keys[slot], float(d)) for slot, d in zip(slots[indices].tolist(), distances.tolist())]
+
+    def count_within(self, lat: float, lng: float, radius_km: float,
+                     slots: Optional[np.ndarray] = None) -> int:
+        """Number of slots within radius_km, without building (key, distance) pairs"""
+        if slots is None:
+            slots = self._live_slots()
+        if len(slots) == 0:
+            return 0
+        return int(np.count_nonzero(self.distances(lat, lng, slots) <= radius_km))
+
+    def distance_matrix(self, points: List[Tuple[float, float]],
+                        slots: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Distances in km from many points to many slots, shape (len(points), len(slots))"""
+        if slots is None:
+            slots = self._live_slots()
+        lats = np.fromiter((p[0] for p in points), dtype=np.float64, count=len(points))
+        lngs = np.fromiter((p[1] for p in points), dtype=np.float64, count=len(points))
+        return slots, haversine_matrix(lats, lngs, self.lat[slots], self.lng[slots])
@@ -0,0 +1,96 @@
+from typing import Iterator, Optional, Tuple
+from datetime import datetime, timedelta
+import time
+import numpy as np
+
+from distance_engine import CoordinateArrays
+
+
+class DriverLocationStore(CoordinateArrays):
+    """
+    Latest location per driver, held in parallel arrays indexed by a
+    driver -> slot map instead of a dict per driver per update.
+
+    Timestamps are time.monotonic() floats, so freshness checks are a
+    subtraction rather than an ISO parse. Slots freed on disconnect are reused,
+    so memory stays flat as drivers come and go. Lat/lng live in the inherited
+    contiguous arrays and feed the vectorized distance queries directly.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        super().__init__(capacity)
+        self.heading = np.zeros(capacity, dtype=np.float32)
+        self.speed = np.zeros(capacity, dtype=np.float32)
+        self.updated_at = np.zeros(capacity, dtype=np.float64)
+
+    def _grow(self, capacity: int):
+        super()._grow(capacity)
+        self.heading = np.resize(self.heading, capacity)
+        self.speed = np.resize(self.speed, capacity)
+        self.updated_at = np.resize(self.updated_at, capacity)
+
+    def upsert(self, driver_id: str, lat: float, lng: float, heading: float = 0.0,
+               speed: float = 0.0, now: Optional[float] = None) -> Optional[Tuple[float, float]]:
+        """Record a driver's location; returns the previous (lat, lng) if there was one"""
+        slot = self.slots.get(driver_id)
+        prev = None if slot is None else (float(self.lat[slot]), float(self.lng[slot]))
+        slot = self.set(driver_id, lat, lng)
+        self.heading[slot] = heading
+        self.speed[slot] = speed
+        self.updated_at[slot] = time.monotonic() if now is None else now
+        return prev
+
+    def pop(self, driver_id: str) -> Optional[Tuple[float, float]]:
+        """Remove a driver; returns the last (lat, lng) if it was tracked"""
+        slot = self.slots.get(driver_id)
+        if slot is None:
+            return None
+        position = (float(self.lat[slot]), float(self.lng[slot]))
+        self.remove(driver_id)
+        return position
+
+    def position(self, driver_id: str) -> Optional[Tuple[float, float]]:
+        slot = self.slots.get(driver_id)
+        if slot is None:
+            return None
+        return float(self.lat[slot]), float(self.lng[slot])
+
+    def age(self, driver_id: str, now: Optional[float] = None) -> Optional[float]:
+        """Seconds since the driver's last update"""
+        slot = self.slots.get(driver_id)
+        if slot is None:
+            return None
+        return (time.monotonic() if now is None else now) - float(self.updated_at[slot])
+
+    def is_fresh(self, driver_id: str, ttl_seconds: float, now: Optional[float] = None) -> bool:
+        age = self.age(driver_id, now)
+        return age is not None and age <= ttl_seconds
+
+    def fresh_mask(self, slots: np.ndarray, ttl_seconds: float, now: Optional[float] = None) -> np.ndarray:
+        """Vectorized freshness check for a batch of slots"""
+        now = time.monotonic() if now is None else now
+        return (now - self.updated_at[slots]) <= ttl_seconds
+
+    def driver_ids(self) -> Iterator[str]:
+        return iter(self.slots)
+
+    def last_updated_iso(self, driver_id: str) -> Optional[str]:
+        """Wall-clock (UTC) time of the last update, for clients and logs"""
+        age = self.age(driver_id)
+        if age is None:
+            return None
+        return (datetime.utcnow() - timedelta(seconds=age)).isoformat()
+
+    def snapshot(self, driver_id: str) -> Optional[dict]:
+        """The driver's location in the wire format sent to clients"""
+        slot = self.slots.get(driver_id)
+        if slot is None:
+            return None
+        return {
+            "driver_id": driver_id,
+            "lat": float(self.lat[slot]),
+            "lng": float(self.lng[slot]),
+            "heading": round(float(self.heading[slot]), 2),
+            "speed": round(float(self.speed[slot]), 2),
+            "last_updated": self.last_updated_iso(driver_id)
+        }
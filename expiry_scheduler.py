@@ -0,0 +1,124 @@
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import time
+
+# Kinds of entries ConnectionManager expires
+EXPIRE_DRIVER_LOCATION = "driver_location"
+EXPIRE_RIDE_REQUEST = "ride_request"
+
+
+class ExpiryScheduler:
+    """
+    Evicts entries when their deadline passes, using a min-heap of
+    (deadline, generation, kind, key) with lazy invalidation.
+
+    Refreshing an entry only moves its deadline in `deadlines`; the heap entry
+    stays where it is and is pushed again at the new deadline when it comes
+    due. A driver pinging every second therefore costs a dict write, not a
+    heap push. Cancelled entries are skipped when popped via the generation
+    number. Deadlines are time.monotonic() values.
+    """
+
+    def __init__(self, on_expire: Callable[[str, str], None], max_batch: int = 1000):
+        self.on_expire = on_expire
+        self.max_batch = max_batch
+        self.heap: List[Tuple[float, int, str, str]] = []
+        self.deadlines: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.expired: Dict[str, int] = {}
+        self.errors = 0
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def schedule(self, kind: str, key: str, deadline: float):
+        """Expire (kind, key) at `deadline`, replacing any earlier deadline"""
+        entry = self.deadlines.get((kind, key))
+        if entry is not None:
+            self.deadlines[(kind, key)] = (deadline, entry[1])
+            if deadline >= entry[0]:
+                return
+            # Moving a deadline earlier needs a fresh heap entry
+        self._generation += 1
+        self.deadlines[(kind, key)] = (deadline, self._generation)
+        self._push(deadline, self._generation, kind, key)
+
+    def cancel(self, kind: str, key: str) -> bool:
+        return self.deadlines.pop((kind, key), None) is not None
+
+    def _push(self, deadline: float, generation: int, kind: str, key: str):
+        heapq.heappush(self.heap, (deadline, generation, kind, key))
+        if self.heap[0][1] == generation:
+            self._wakeup.set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print("Expiry scheduler started")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self.heap:
+                await self._wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.run_due()
+            # Let other tasks run between batches of a large expiry wave
+            await asyncio.sleep(0)
+
+    def run_due(self, now: Optional[float] = None) -> int:
+        """Expire up to max_batch due entries; returns how many were expired"""
+        now = time.monotonic() if now is None else now
+        expired = 0
+        while self.heap and self.heap[0][0] <= now and expired < self.max_batch:
+            _deadline, generation, kind, key = heapq.heappop(self.heap)
+            entry = self.deadlines.get((kind, key))
+            if entry is None or entry[1] != generation:
+                continue  # Cancelled or superseded
+            if entry[0] > now:
+                # Refreshed since this heap entry was pushed
+                heapq.heappush(self.heap, (entry[0], generation, kind, key))
+                continue
+            del self.deadlines[(kind, key)]
+            expired += 1
+            self.expired[kind] = self.expired.get(kind, 0) + 1
+            try:
+                self.on_expire(kind, key)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error expiring {kind} {key}: {str(e)}")
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'pending': len(self.deadlines),
+            'heap_size': len(self.heap),
+            'expired': dict(self.expired),
+            'errors': self.errors
+        }
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+import math
+import os
+import time
+import numpy as np
+
+from geo_index import EARTH_RADIUS_KM, KM_PER_DEGREE_LAT
+from routing_engine import RoadRouter
+from surge_engine import SurgeEngine
+from dispatch_engine import DISPATCH_AVG_SPEED_KMH
+
+# Fare model, the same as the booking screen's fare calculator (PKR)
+BASE_FARE = 100
+PER_KM_RATE = 15
+PER_MINUTE_RATE = 2
+MIN_FARE = 150
+
+# Road distance is estimated as straight-line distance times this factor
+FARE_DETOUR_FACTOR = float(os.getenv("FARE_DETOUR_FACTOR", "1.3"))
+# Quotes are cached per pair of cells of this size
+FARE_CELL_KM = float(os.getenv("FARE_CELL_KM", "0.5"))
+FARE_QUOTE_TTL_SECONDS = float(os.getenv("FARE_QUOTE_TTL_SECONDS", "60"))
+FARE_QUOTE_CACHE_SIZE = int(os.getenv("FARE_QUOTE_CACHE_SIZE", "50000"))
+# Client estimates further than this from the server quote are replaced
+FARE_TOLERANCE = float(os.getenv("FARE_TOLERANCE", "0.15"))
+# Most pairs priced by one batch request
+FARE_BATCH_MAX = int(os.getenv("FARE_BATCH_MAX", "1000"))
+# Most cell pairs routed on the road graph per call; routing runs on the event
+# loop, so pairs beyond this use the distance estimate and are not cached
+FARE_INLINE_MAX_ROUTED_PAIRS = int(os.getenv("FARE_INLINE_MAX_ROUTED_PAIRS", "32"))
+
+Cell = Tuple[int, int]
+QuoteKey = Tuple[Cell, Cell, int]
+
+
+def fare_for(distance_km: np.ndarray, duration_minutes: np.ndarray, multiplier: np.ndarray) -> np.ndarray:
+    """calculateFare from the frontend, vectorized: base + distance + time, times surge, floored at MIN_FARE"""
+    total = (BASE_FARE + distance_km * PER_KM_RATE + duration_minutes * PER_MINUTE_RATE) * multiplier
+    # Math.round rounds halves up; np.round would round them to even
+    return np.floor(np.maximum(total, MIN_FARE) + 0.5)
+
+
+def haversine_pairs(lats1: np.ndarray, lngs1: np.ndarray, lats2: np.ndarray, lngs2: np.ndarray) -> np.ndarray:
+    """Great-circle distances in km between matching rows of two point arrays"""
+    lat1, lat2 = np.radians(lats1), np.radians(lats2)
+    dlat = lat2 - lat1
+    dlng = np.radians(lngs2 - lngs1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class FareQuoteEngine:
+    """
+    Server-side fare quotes. Trip distance comes from straight-line distance
+    times FARE_DETOUR_FACTOR, duration from the road graph when one is
+    loaded (otherwise distance at the dispatch average speed), and the
+    multiplier from the pickup zone's surge. At most
+    FARE_INLINE_MAX_ROUTED_PAIRS cell pairs are routed per call, one search
+    per dropoff cell; the rest are priced from the estimate and left out of
+    the cache so a later quote can route them.
+
+    Quotes are cached per (pickup cell, dropoff cell, surge bucket) and
+    priced from the cell centres, so every point in a cell pair gets the same
+    price while the zone's surge holds. Entries expire after `ttl_seconds`;
+    with one TTL for all entries insertion order is expiry order, so expired
+    entries are dropped from the front of an OrderedDict.
+    """
+
+    def __init__(self, surge: SurgeEngine, router: Optional[RoadRouter] = None,
+                 cell_km: float = FARE_CELL_KM, ttl_seconds: float = FARE_QUOTE_TTL_SECONDS,
+                 max_entries: int = FARE_QUOTE_CACHE_SIZE):
+        self.surge = surge
+        self.router = router
+        self.cell_deg = cell_km / KM_PER_DEGREE_LAT
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[QuoteKey, Tuple[float, dict]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.corrected_estimates = 0
+        self.unrouted = 0
+
+    def cell_for(self, lat: float, lng: float) -> Cell:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def cell_centre(self, cell: Cell) -> Tuple[float, float]:
+        return (cell[0] + 0.5) * self.cell_deg, (cell[1] + 0.5) * self.cell_deg
+
+    def _evict(self, now: float):
+        while self.cache:
+            key, (expires_at, _quote) = next(iter(self.cache.items()))
+            if expires_at > now and len(self.cache) <= self.max_entries:
+                break
+            del self.cache[key]
+            self.evicted += 1
+
+    def _durations(self, keys: List[QuoteKey], origins: np.ndarray, destinations: np.ndarray,
+                   distance_km: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Trip minutes per cell pair, and a mask of the pairs that were routed"""
+        minutes = distance_km / DISPATCH_AVG_SPEED_KMH * 60
+        routed = np.zeros(len(keys), dtype=bool)
+        if self.router is None:
+            return minutes, routed
+
+        # seconds_to shares one backward search across every origin bound for the same dropoff
+        by_dropoff: Dict[Cell, List[int]] = {}
+        for k, key in enumerate(keys):
+            by_dropoff.setdefault(key[1], []).append(k)
+        budget = FARE_INLINE_MAX_ROUTED_PAIRS
+        for indices in by_dropoff.values():
+            if budget <= 0:
+                break
+            indices = indices[:budget]
+            budget -= len(indices)
+            lat, lng = destinations[indices[0]]
+            seconds = self.router.seconds_to(lat, lng, [(origins[k, 0], origins[k, 1]) for k in indices])
+            for k, value in zip(indices, seconds):
+                routed[k] = True  # No road path: the estimate is the answer
+                if value is not None:
+                    minutes[k] = value / 60
+        return minutes, routed
+
+    def quote_many(self, pairs: Sequence[Tuple[float, float, float, float]]) -> List[dict]:
+        """
+        Quote (pickup_lat, pickup_lng, dropoff_lat, dropoff_lng) pairs. Cached
+        cell pairs are answered from the cache; the rest are priced together
+        in one vectorized pass.
+        """
+        now = time.monotonic()
+        self._evict(now)
+        results: List[Optional[dict]] = [None] * len(pairs)
+        misses: Dict[QuoteKey, List[int]] = {}
+        for i, (p_lat, p_lng, d_lat, d_lng) in enumerate(pairs):
+            multiplier = self.surge.multiplier(p_lat, p_lng)
+            key = (self.cell_for(p_lat, p_lng), self.cell_for(d_lat, d_lng), int(round(multiplier * 100)))
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.hits += 1
+                results[i] = entry[1]
+            else:
+                self.misses += 1
+                misses.setdefault(key, []).append(i)
+
+        if misses:
+            keys = list(misses)
+            origins = np.array([self.cell_centre(key[0]) for key in keys])
+            destinations = np.array([self.cell_centre(key[1]) for key in keys])
+            multipliers = np.array([key[2] / 100 for key in keys])
+            distance_km = haversine_pairs(origins[:, 0], origins[:, 1],
+                                          destinations[:, 0], destinations[:, 1]) * FARE_DETOUR_FACTOR
+            duration_minutes, routed = self._durations(keys, origins, destinations, distance_km)
+            fares = fare_for(distance_km, duration_minutes, multipliers)
+            expires_at = now + self.ttl_seconds
+            for k, key in enumerate(keys):
+                quote = {
+                    'fare': float(fares[k]),
+                    'distance_km': round(float(distance_km[k]), 2),
+                    'duration_minutes': int(round(duration_minutes[k])),
+                    'surge_multiplier': float(multipliers[k]),
+                    'currency': 'PKR'
+                }
+                if routed[k] or self.router is None:
+                    self.cache[key] = (expires_at, quote)
+                else:
+                    self.unrouted += 1
+                for i in misses[key]:
+                    results[i] = quote
+            self._evict(now)
+        return results
+
+    def quote(self, pickup_lat: float, pickup_lng: float, dropoff_lat: float, dropoff_lng: float) -> dict:
+        return self.quote_many([(pickup_lat, pickup_lng, dropoff_lat, dropoff_lng)])[0]
+
+    def checked_fare(self, client_fare: Optional[float], quote: dict) -> float:
+        """The fare to use for a request: the client's estimate if it is close to the quote, else the quote"""
+        if client_fare and abs(client_fare - quote['fare']) <= FARE_TOLERANCE * quote['fare']:
+            return float(client_fare)
+        if client_fare:
+            self.corrected_estimates += 1
+        return quote['fare']
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'cached_quotes': len(self.cache),
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evicted': self.evicted,
+            'corrected_estimates': self.corrected_estimates,
+            'unrouted': self.unrouted
+        }
@@ -0,0 +1,39 @@
+from typing import Iterable, Optional
+import json
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder
+    orjson = None
+
+
+def encode_json(data) -> str:
+    """Serialize a message to compact JSON text"""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'))
+
+
+def join_json_array(encoded_items: Iterable[str]) -> str:
+    """Build a JSON array from already-encoded items without re-serializing them"""
+    return '[' + ','.join(encoded_items) + ']'
+
+
+class EncodedFrame:
+    """
+    A message serialized once and shared by every recipient. `type` is kept
+    alongside the text so queues can make decisions without re-parsing it.
+    """
+
+    __slots__ = ("text", "type")
+
+    def __init__(self, text: str, type: Optional[str] = None):
+        self.text = text
+        self.type = type
+
+    @classmethod
+    def from_message(cls, data: dict) -> "EncodedFrame":
+        return cls(encode_json(data), data.get('type'))
+
+    def __len__(self) -> int:
+        return len(self.text)
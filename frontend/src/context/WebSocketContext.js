@@ -1,8 +1,37 @@
-import React, { createContext, useContext, useEffect, useState } from 'react';
+import React, { createContext, useCallback, useContext, useEffect, useRef, useState } from 'react';
 import authService from '../services/authService';
 
 const WebSocketContext = createContext(null);
 
+/**
+ * Apply a driver location frame to the current driver map.
+ * Keyframes replace the whole map. A delta holds every change since frame
+ * `base_seq` (the last one we acked), so it applies to any state from
+ * base_seq on, even if frames in between were lost.
+ * Returns the new map, or null if the delta starts after the last applied frame.
+ */
+export const applyDriverFrame = (drivers, lastSeq, frame) => {
+    if (frame.type === 'driver_locations_keyframe') {
+        const next = {};
+        frame.drivers.forEach((driver) => {
+            next[driver.driver_id] = driver;
+        });
+        return next;
+    }
+
+    if (frame.base_seq > lastSeq) {
+        return null;
+    }
+    const next = { ...drivers };
+    frame.removed.forEach((driverId) => {
+        delete next[driverId];
+    });
+    frame.upserts.forEach((driver) => {
+        next[driver.driver_id] = driver;
+    });
+    return next;
+};
+
 export const useWebSocket = () => {
     const context = useContext(WebSocketContext);
     if (!context) {
@@ -14,6 +43,8 @@ export const useWebSocket = () => {
 export const WebSocketProvider = ({ children }) => {
     const [socket, setSocket] = useState(null);
     const [isConnected, setIsConnected] = useState(false);
+    const [driverLocations, setDriverLocations] = useState({});
+    const driverFrameRef = useRef({ drivers: {}, seq: 0, resyncing: false });
 
     useEffect(() => {
         const connectWebSocket = async () => {
@@ -33,6 +64,31 @@ export const WebSocketProvider = ({ children }) => {
                     setIsConnected(false);
                 };
 
+                ws.onmessage = (event) => {
+                    let message;
+                    try {
+                        message = JSON.parse(event.data);
+                    } catch (error) {
+                        return;
+                    }
+
+                    if (message.type === 'driver_locations_keyframe' || message.type === 'driver_locations_delta') {
+                        const current = driverFrameRef.current;
+                        const drivers = applyDriverFrame(current.drivers, current.seq, message);
+                        if (drivers === null) {
+                            // Missed a frame: ask once for a full keyframe
+                            if (!current.resyncing) {
+                                driverFrameRef.current = { ...current, resyncing: true };
+                                ws.send(JSON.stringify({ type: 'driver_locations_resync' }));
+                            }
+                            return;
+                        }
+                        driverFrameRef.current = { drivers, seq: message.seq, resyncing: false };
+                        setDriverLocations(drivers);
+                        ws.send(JSON.stringify({ type: 'ack_driver_locations', seq: message.seq }));
+                    }
+                };
+
                 ws.onerror = (error) => {
                     console.error('WebSocket Error:', error);
                     setIsConnected(false);
@@ -51,9 +107,20 @@ export const WebSocketProvider = ({ children }) => {
         connectWebSocket();
     }, []);
 
+    // viewport: { south, west, north, east } or { center: { lat, lng }, radius_km }
+    const subscribeToDriverLocations = useCallback((viewport) => {
+        if (!socket || socket.readyState !== WebSocket.OPEN) return;
+        const message = viewport.center
+            ? { type: 'subscribe_to_driver_locations', center: viewport.center, radius_km: viewport.radius_km }
+            : { type: 'subscribe_to_driver_locations', viewport };
+        socket.send(JSON.stringify(message));
+    }, [socket]);
+
     const value = {
         socket,
         isConnected,
+        driverLocations,
+        subscribeToDriverLocations,
     };
 
     return (
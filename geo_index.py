@@ -0,0 +1,294 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometers"""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dlat / 2) ** 2 +
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+        math.sin(dlon / 2) ** 2
+    )
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+class SpatialGridIndex:
+    """
+    Fixed-cell grid over lat/lng used to answer radius and k-nearest queries
+    without scanning every entry.
+
+    Cells are square in degrees of latitude. Longitude cells use the same
+    angular size, so at higher latitudes a cell is narrower in km and a
+    radius query simply visits more columns.
+    """
+
+    def __init__(self, cell_size_km: float = 1.0):
+        self.cell_size_km = cell_size_km
+        self.cell_size_deg = cell_size_km / KM_PER_DEGREE_LAT
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.positions: Dict[str, Tuple[float, float]] = {}
+        self.entry_cells: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.positions
+
+    def cell_for(self, lat: float, lng: float) -> Tuple[int, int]:
+        """Return the (row, col) cell containing a point"""
+        return (
+            int(math.floor(lat / self.cell_size_deg)),
+            int(math.floor(lng / self.cell_size_deg))
+        )
+
+    def update(self, key: str, lat: float, lng: float) -> Optional[Tuple[int, int]]:
+        """
+        Insert or move an entry. Returns the previous cell when the entry
+        changed cells, otherwise None.
+        """
+        cell = self.cell_for(lat, lng)
+        prev_cell = self.entry_cells.get(key)
+        self.positions[key] = (lat, lng)
+        if prev_cell == cell:
+            return None
+
+        if prev_cell is not None:
+            self._discard_from_cell(prev_cell, key)
+        self.cells.setdefault(cell, set()).add(key)
+        self.entry_cells[key] = cell
+        return prev_cell
+
+    def remove(self, key: str) -> bool:
+        """Remove an entry from the index"""
+        cell = self.entry_cells.pop(key, None)
+        if cell is None:
+            return False
+        self.positions.pop(key, None)
+        self._discard_from_cell(cell, key)
+        return True
+
+    def get(self, key: str) -> Optional[Tuple[float, float]]:
+        return self.positions.get(key)
+
+    def _discard_from_cell(self, cell: Tuple[int, int], key: str):
+        members = self.cells.get(cell)
+        if members is None:
+            return
+        members.discard(key)
+        if not members:
+            del self.cells[cell]
+
+    def _ring_span(self, lat: float, radius_km: float) -> Tuple[int, int]:
+        """Number of rows/cols a radius spans around a point's cell"""
+        rows = int(math.ceil(radius_km / self.cell_size_km))
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + rows * self.cell_size_deg, 89.9))), 1e-6)
+        cols = int(math.ceil(radius_km / (self.cell_size_km * cos_lat)))
+        return rows, cols
+
+    def cells_in_radius(self, lat: float, lng: float, radius_km: float) -> Iterator[Tuple[int, int]]:
+        """Yield populated cells that may contain points within radius_km"""
+        row, col = self.cell_for(lat, lng)
+        rows, cols = self._ring_span(lat, radius_km)
+        if (2 * rows + 1) * (2 * cols + 1) > len(self.cells):
+            # Sparse grid: cheaper to walk the populated cells directly
+            for cell in self.cells:
+                if abs(cell[0] - row) <= rows and abs(cell[1] - col) <= cols:
+                    yield cell
+            return
+        for r in range(row - rows, row + rows + 1):
+            for c in range(col - cols, col + cols + 1):
+                if (r, c) in self.cells:
+                    yield (r, c)
+
+    def candidates(self, lat: float, lng: float, radius_km: float) -> Iterator[str]:
+        """Yield keys in cells overlapping the radius (unfiltered by distance)"""
+        for cell in self.cells_in_radius(lat, lng, radius_km):
+            yield from self.cells[cell]
+
+    def candidates_in_bounds(self, south: float, west: float,
+                             north: float, east: float) -> Iterator[str]:
+        """Yield keys in cells overlapping a lat/lng box (unfiltered by position)"""
+        south_row, west_col = self.cell_for(south, west)
+        north_row, east_col = self.cell_for(north, east)
+        if (north_row - south_row + 1) * (east_col - west_col + 1) > len(self.cells):
+            for (r, c), members in self.cells.items():
+                if south_row <= r <= north_row and west_col <= c <= east_col:
+                    yield from members
+            return
+        for r in range(south_row, north_row + 1):
+            for c in range(west_col, east_col + 1):
+                members = self.cells.get((r, c))
+                if members:
+                    yield from members
+
+    def query_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[str, float]]:
+        """Return (key, distance_km) pairs within radius_km, nearest first"""
+        results = []
+        for key in self.candidates(lat, lng, radius_km):
+            p_lat, p_lng = self.positions[key]
+            distance = haversine_km(lat, lng, p_lat, p_lng)
+            if distance <= radius_km:
+                results.append((key, distance))
+        results.sort(key=lambda item: item[1])
+        return results
+
+    def nearest(self, lat: float, lng: float, k: int,
+                max_radius_km: float = 10.0) -> List[Tuple[str, float]]:
+        """
+        Return up to k (key, distance_km) pairs nearest to the point, searching
+        outward ring by ring and stopping once the k-th result is closer than
+        any unvisited ring could be.
+        """
+        if k <= 0 or not self.positions:
+            return []
+
+        row, col = self.cell_for(lat, lng)
+        max_ring = int(math.ceil(max_radius_km / self.cell_size_km))
+        _, max_cols = self._ring_span(lat, max_radius_km)
+        best: List[Tuple[float, str]] = []  # max-heap via negated distance
+
+        ring = 0
+        while ring <= max(max_ring, max_cols):
+            for cell in self._ring_cells(row, col, ring, max_ring, max_cols):
+                for key in self.cells.get(cell, ()):
+                    p_lat, p_lng = self.positions[key]
+                    distance = haversine_km(lat, lng, p_lat, p_lng)
+                    if distance > max_radius_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, key))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, key))
+
+            # Every point outside this ring is at least `ring` cells away
+            if len(best) >= k and -best[0][0] <= ring * self.cell_size_km * self._min_cos(lat, ring):
+                break
+            ring += 1
+
+        return sorted(((key, -neg) for neg, key in best), key=lambda item: item[1])
+
+    def _min_cos(self, lat: float, ring: int) -> float:
+        edge_lat = min(abs(lat) + ring * self.cell_size_deg, 89.9)
+        return max(math.cos(math.radians(edge_lat)), 1e-6)
+
+    def _ring_cells(self, row: int, col: int, ring: int,
+                    max_rows: int, max_cols: int) -> Iterator[Tuple[int, int]]:
+        """Yield cells on the square ring at Chebyshev distance `ring`"""
+        if ring == 0:
+            yield (row, col)
+            return
+        r_span = min(ring, max_rows)
+        c_span = min(ring, max_cols)
+        for r in range(row - r_span, row + r_span + 1):
+            for c in range(col - c_span, col + c_span + 1):
+                if max(abs(r - row), abs(c - col)) == ring:
+                    yield (r, c)
+
+
+class Viewport:
+    """A subscriber's area of interest: a lat/lng box, optionally a circle inside it"""
+
+    __slots__ = ("south", "west", "north", "east", "center", "radius_km")
+
+    def __init__(self, south: float, west: float, north: float, east: float,
+                 center: Optional[Tuple[float, float]] = None, radius_km: Optional[float] = None):
+        if south > north or west > east:
+            raise ValueError("Viewport bounds must satisfy south <= north and west <= east")
+        self.south = south
+        self.west = west
+        self.north = north
+        self.east = east
+        self.center = center
+        self.radius_km = radius_km
+
+    @classmethod
+    def from_bounds(cls, bounds: dict) -> "Viewport":
+        return cls(
+            float(bounds['south']), float(bounds['west']),
+            float(bounds['north']), float(bounds['east'])
+        )
+
+    @classmethod
+    def from_radius(cls, lat: float, lng: float, radius_km: float) -> "Viewport":
+        if radius_km <= 0:
+            raise ValueError("radius_km must be positive")
+        dlat = radius_km / KM_PER_DEGREE_LAT
+        dlng = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        return cls(lat - dlat, lng - dlng, lat + dlat, lng + dlng, center=(lat, lng), radius_km=radius_km)
+
+    def contains(self, lat: float, lng: float) -> bool:
+        if not (self.south <= lat <= self.north and self.west <= lng <= self.east):
+            return False
+        if self.center is None:
+            return True
+        return haversine_km(self.center[0], self.center[1], lat, lng) <= self.radius_km
+
+
+class ViewportSubscriptionIndex:
+    """
+    Maps grid buckets to the subscribers whose viewport overlaps them, so a
+    location update is only fanned out to connections that can see it.
+    """
+
+    def __init__(self, cell_size_km: float = 2.0, max_cells_per_viewport: int = 2500):
+        self.grid = SpatialGridIndex(cell_size_km=cell_size_km)
+        self.max_cells_per_viewport = max_cells_per_viewport
+        self.buckets: Dict[Tuple[int, int], Set[str]] = {}
+        self.viewports: Dict[str, Viewport] = {}
+        self.subscriber_cells: Dict[str, List[Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.viewports)
+
+    def __contains__(self, subscriber_id: str) -> bool:
+        return subscriber_id in self.viewports
+
+    def get(self, subscriber_id: str) -> Optional[Viewport]:
+        return self.viewports.get(subscriber_id)
+
+    def subscribe(self, subscriber_id: str, viewport: Viewport):
+        """Register or replace a subscriber's viewport"""
+        south_row, west_col = self.grid.cell_for(viewport.south, viewport.west)
+        north_row, east_col = self.grid.cell_for(viewport.north, viewport.east)
+        cell_count = (north_row - south_row + 1) * (east_col - west_col + 1)
+        if cell_count > self.max_cells_per_viewport:
+            raise ValueError("Viewport is too large; zoom in to receive driver locations")
+
+        self.unsubscribe(subscriber_id)
+        cells = [
+            (r, c)
+            for r in range(south_row, north_row + 1)
+            for c in range(west_col, east_col + 1)
+        ]
+        for cell in cells:
+            self.buckets.setdefault(cell, set()).add(subscriber_id)
+        self.viewports[subscriber_id] = viewport
+        self.subscriber_cells[subscriber_id] = cells
+
+    def unsubscribe(self, subscriber_id: str) -> bool:
+        cells = self.subscriber_cells.pop(subscriber_id, None)
+        if cells is None:
+            return False
+        del self.viewports[subscriber_id]
+        for cell in cells:
+            members = self.buckets.get(cell)
+            if members is None:
+                continue
+            members.discard(subscriber_id)
+            if not members:
+                del self.buckets[cell]
+        return True
+
+    def subscribers_at(self, lat: float, lng: float) -> Set[str]:
+        """Subscribers whose viewport contains the point"""
+        members = self.buckets.get(self.grid.cell_for(lat, lng))
+        if not members:
+            return set()
+        return {sid for sid in members if self.viewports[sid].contains(lat, lng)}
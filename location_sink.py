@@ -0,0 +1,160 @@
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+import asyncio
+import os
+import time
+
+from sqlalchemy import bindparam, update
+
+from database import SessionLocal
+from models import User
+
+# Dirty driver positions are written at least this often
+LOCATION_FLUSH_MS = int(os.getenv("LOCATION_FLUSH_MS", "2000"))
+# ...or as soon as this many drivers are waiting to be written
+LOCATION_FLUSH_MAX_DIRTY = int(os.getenv("LOCATION_FLUSH_MAX_DIRTY", "1000"))
+
+
+class LocationSink:
+    """
+    Write-behind persistence for driver positions. Pings only update the
+    latest position per driver in memory; dirty rows are written in one
+    executemany UPDATE per flush, every `flush_seconds` or once `max_dirty` drivers are
+    waiting. The write runs in a thread so the event loop never blocks on
+    the database. A failed flush puts its rows back unless newer ones have
+    arrived in the meantime. Ids with no users row (a deleted driver) match
+    nothing and are simply skipped, so they can't hold up the rest.
+    """
+
+    def __init__(self, session_factory=SessionLocal, flush_seconds: float = LOCATION_FLUSH_MS / 1000,
+                 max_dirty: int = LOCATION_FLUSH_MAX_DIRTY):
+        self.session_factory = session_factory
+        self.flush_seconds = flush_seconds
+        self.max_dirty = max_dirty
+        # Driver -> (lat, lng, wall-clock time of the ping, monotonic time first marked dirty)
+        self.dirty: Dict[str, Tuple[float, float, datetime, float]] = {}
+        self._flush_now = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.records = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    def record(self, driver_id: str, lat: float, lng: float, at: Optional[datetime] = None):
+        """Remember a driver's latest position; it is written on the next flush"""
+        entry = self.dirty.get(driver_id)
+        first_dirty = entry[3] if entry is not None else time.monotonic()
+        self.dirty[driver_id] = (lat, lng, at or datetime.now(timezone.utc), first_dirty)
+        self.records += 1
+        if len(self.dirty) >= self.max_dirty:
+            self._flush_now.set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f"Location sink started (flush every {self.flush_seconds * 1000:.0f} ms)")
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still dirty"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Write every dirty position in one batched UPDATE; returns positions written"""
+        async with self._lock:
+            if not self.dirty:
+                return 0
+            batch, self.dirty = self.dirty, {}
+            now = time.monotonic()
+            lag_ms = (now - min(entry[3] for entry in batch.values())) * 1000
+
+            started = time.perf_counter()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error flushing driver locations: {str(e)}")
+                # Retry on the next flush, keeping anything newer that arrived meanwhile
+                for driver_id, entry in batch.items():
+                    self.dirty.setdefault(driver_id, entry)
+                return 0
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.last_lag_ms = lag_ms
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            return len(batch)
+
+    def _write(self, batch: Dict[str, Tuple[float, float, datetime, float]]):
+        # Core UPDATE rather than bulk_update_mappings, which raises StaleDataError
+        # for the whole batch when one id has no row
+        users = User.__table__
+        statement = (
+            update(users)
+            .where(users.c.id == bindparam("driver_id"))
+            .values(
+                current_latitude=bindparam("lat"),
+                current_longitude=bindparam("lng"),
+                updated_at=bindparam("at")
+            )
+        )
+        db = self.session_factory()
+        try:
+            db.execute(statement, [
+                {"driver_id": driver_id, "lat": lat, "lng": lng, "at": at}
+                for driver_id, (lat, lng, at, _first_dirty) in batch.items()
+            ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            'flush_ms': self.flush_seconds * 1000,
+            'running': self.running,
+            'pending': len(self.dirty),
+            'records': self.records,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'coalesced': self.records - self.rows_written - len(self.dirty),
+            'errors': self.errors,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'last_lag_ms': round(self.last_lag_ms, 3),
+            'max_lag_ms': round(self.max_lag_ms, 3)
+        }
+
+
+# Shared sink used by the WebSocket endpoint
+location_sink = LocationSink()
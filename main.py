@@ -1,23 +1,41 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from models import UserType, RideStatus, User as DBUser, Ride as DBRide, Payment as DBPayment, Rating as DBRating
 from realtime_service import manager
+from outbound_queue import PRIORITY_RIDE, PRIORITY_REPLY
+from telemetry_protocol import (
+    PROTOCOL_JSON,
+    PROTOCOL_BINARY_V1,
+    SUPPORTED_TELEMETRY_PROTOCOLS,
+    RECORD_SIZE,
+    TelemetryDecodeError,
+    decode_records,
+)
+from geo_index import Viewport
+from location_sink import location_sink
+from track_store import points_to_dicts
+from frame_codec import encode_json
+from fare_quote import FARE_BATCH_MAX
 import json
 from datetime import timedelta, now, timezone
 import datetime
 import uuid
+from sqlalchemy import select, func, update
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from database import get_db, engine
+from database import get_db, get_async_db, engine, async_engine, report_database_settings
 from auth import (
     get_current_active_user,
     get_current_user,
+    get_current_active_user_async,
+    get_current_user_async,
     create_access_token,
-    get_password_hash,
-    verify_password,
+    password_hasher,
     ACCESS_TOKEN_EXPIRE_MINUTES,
 )
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
@@ -46,6 +64,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_realtime_service():
+    await report_database_settings()
+    manager.start()
+    location_sink.start()
+
+@app.on_event("shutdown")
+async def stop_realtime_service():
+    await manager.shutdown()
+    # Persist driver positions that have not been written yet
+    await location_sink.stop()
+    await async_engine.dispose()
+    password_hasher.shutdown()
+
+@app.get("/api/realtime/metrics")
+async def get_realtime_metrics():
+    """Realtime service counters: connections, broadcast tick latency and batch sizes"""
+    metrics = manager.get_metrics()
+    metrics['location_sink'] = location_sink.stats()
+    metrics['password_hashing'] = password_hasher.stats()
+    return {
+        "status": "success",
+        "metrics": metrics
+    }
+
+@app.get("/api/surge")
+async def get_surge(lat: float, lng: float):
+    """Surge multiplier for the pricing zone containing a point"""
+    return {
+        "status": "success",
+        "surge": manager.surge.quote(lat, lng)
+    }
+
+@app.get("/api/surge/zones")
+async def get_surging_zones():
+    """Zones currently priced above the base fare"""
+    return {
+        "status": "success",
+        "zones": manager.surge.surging_zones()
+    }
+
 # Global exception handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -58,7 +117,9 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             "code": exc.status_code,
             "message": exc.detail,
             "path": request.url.path
-        }
+        },
+        # Keep headers such as Retry-After and WWW-Authenticate
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(Exception)
@@ -89,6 +150,22 @@ def get_db():
     finally:
         db.close()
 
+def _store_trail(db_ride, summary):
+    """
+    Copy the server-measured route of a completed ride onto its row. Without
+    a measured route (no trail here, or no pings during the ride) the client's
+    values are kept.
+    """
+    if summary is None or not summary.measured:
+        return
+    db_ride.distance = summary.distance_km
+    db_ride.duration = summary.duration_minutes
+    db_ride.route_polyline = summary.polyline
+
+def _reply(user_id: str, data: dict):
+    """Answer a client's message through its outbound queue, so the writer task stays the socket's only sender"""
+    manager.send_to_user(user_id, data, priority=PRIORITY_REPLY)
+
 # Pydantic models for request/response
 class UserCreate(BaseModel):
     email: str
@@ -136,6 +213,37 @@ class NotificationResponse(BaseModel):
     offset: Optional[int] = 0
     unread_only: Optional[bool] = False
 
+class FareQuoteRequest(BaseModel):
+    pickup_lat: float
+    pickup_lng: float
+    dropoff_lat: float
+    dropoff_lng: float
+
+class FareQuoteBatch(BaseModel):
+    pairs: List[FareQuoteRequest]
+
+@app.get("/api/fares/quote")
+async def get_fare_quote(pickup_lat: float, pickup_lng: float, dropoff_lat: float, dropoff_lng: float):
+    """Fare, distance, duration and surge for one trip"""
+    return {
+        "status": "success",
+        "quote": manager.fares.quote(pickup_lat, pickup_lng, dropoff_lat, dropoff_lng)
+    }
+
+@app.post("/api/fares/quotes")
+async def get_fare_quotes(batch: FareQuoteBatch):
+    """Price many trips at once (booking screen alternatives, corporate bulk bookings)"""
+    if len(batch.pairs) > FARE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {FARE_BATCH_MAX} trips per batch")
+    quotes = manager.fares.quote_many([
+        (pair.pickup_lat, pair.pickup_lng, pair.dropoff_lat, pair.dropoff_lng)
+        for pair in batch.pairs
+    ])
+    return {
+        "status": "success",
+        "quotes": quotes
+    }
+
 @app.post("/register", response_model=Token)
 async def register(user: UserCreate, db: Session = Depends(get_db)):
     try:
@@ -162,7 +270,7 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 
         # Create new user with UUID
         user_id = str(uuid.uuid4())
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await password_hasher.hash(user.password)
 
         # Fix: Make sure all required fields are provided and match the DB model
         db_user = DBUser(
@@ -186,6 +294,9 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
         )
 
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()  # Rollback transaction on error
         print(f"Registration error: {str(e)}")  # Log the error
@@ -224,8 +335,10 @@ async def signup(user: UserCreate, db: Session = Depends(get_db)):
         
         # Ensure password is hashed properly with improved error handling
         try:
-            hashed_password = get_password_hash(user.password)
+            hashed_password = await password_hasher.hash(user.password)
             print(f"Password hashed successfully, length: {len(hashed_password)}")
+        except HTTPException:
+            raise
         except Exception as hash_error:
             print(f"Password hashing error: {str(hash_error)}")
             raise HTTPException(
@@ -296,9 +409,9 @@ async def signup(user: UserCreate, db: Session = Depends(get_db)):
         )
 
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    db_user = db.query(DBUser).filter(DBUser.email == form_data.username).first()
-    if not db_user or not verify_password(form_data.password, db_user.password_hash):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    db_user = await db.scalar(select(DBUser).where(DBUser.email == form_data.username))
+    if not db_user or not await password_hasher.verify(form_data.password, db_user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -313,10 +426,10 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 # Add API endpoint for frontend compatibility
 @app.post("/api/auth/login")
-async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
+async def login_api(user_login: UserLogin, db: AsyncSession = Depends(get_async_db)):
     try:
         # Check if user exists and password is correct
-        db_user = db.query(DBUser).filter(DBUser.email == user_login.email).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.email == user_login.email))
         if not db_user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -328,7 +441,7 @@ async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
         print(f"Attempting to verify password for user: {db_user.email}")
         print(f"Password hash in DB: {db_user.password_hash[:20]}...")
 
-        if not verify_password(user_login.password, db_user.password_hash):
+        if not await password_hasher.verify(user_login.password, db_user.password_hash):
             print("Password verification failed")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -374,7 +487,7 @@ async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
         )
 
 @app.get("/users/me", response_model=None)
-async def read_users_me(current_user: DBUser = Depends(get_current_active_user)):
+async def read_users_me(current_user: DBUser = Depends(get_current_active_user_async)):
     return {
         "id": current_user.id,
         "email": current_user.email,
@@ -386,7 +499,7 @@ async def read_users_me(current_user: DBUser = Depends(get_current_active_user))
 
 # Add API endpoint for frontend compatibility
 @app.get("/api/auth/me")
-async def get_current_user_api(current_user: DBUser = Depends(get_current_user)):
+async def get_current_user_api(current_user: DBUser = Depends(get_current_user_async)):
     """
     Get the current user's information.
     This endpoint is used by the frontend to check if the user is logged in.
@@ -447,8 +560,8 @@ async def redirect_based_on_user_type(request: Request, db: Session = Depends(ge
 @app.post("/rides", response_model=dict)
 async def create_ride(
     ride: RideCreate,
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     db_ride = DBRide(
         rider_id=current_user.id,
@@ -460,16 +573,16 @@ async def create_ride(
         dropoff_lng=ride.dropoff_lng
     )
     db.add(db_ride)
-    db.commit()
-    db.refresh(db_ride)
+    await db.commit()
+    await db.refresh(db_ride)
     return db_ride.__dict__
 
 @app.get("/rides", response_model=List[dict])
 async def get_rides(
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    rides = db.query(DBRide).filter(DBRide.rider_id == current_user.id).all()
+    rides = (await db.scalars(select(DBRide).where(DBRide.rider_id == current_user.id))).all()
     return [ride.__dict__ for ride in rides]
 
 @app.post("/users/", response_model=dict)
@@ -495,16 +608,16 @@ async def get_user(user_id: str, db: Session = Depends(get_db)):
     }
 
 @app.post("/rides/", response_model=dict)
-async def create_ride(ride: dict, db: Session = Depends(get_db)):
+async def create_ride(ride: dict, db: AsyncSession = Depends(get_async_db)):
     db_ride = DBRide(**ride)
     db.add(db_ride)
-    db.commit()
-    db.refresh(db_ride)
+    await db.commit()
+    await db.refresh(db_ride)
     return ride
 
 @app.get("/rides/{ride_id}", response_model=dict)
-async def get_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def get_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
     return {
@@ -521,23 +634,49 @@ async def get_ride(ride_id: str, db: Session = Depends(get_db)):
         "requested_at": db_ride.requested_at.isoformat() if db_ride.requested_at else None,
         "accepted_at": db_ride.accepted_at.isoformat() if db_ride.accepted_at else None,
         "started_at": db_ride.started_at.isoformat() if db_ride.started_at else None,
-        "completed_at": db_ride.completed_at.isoformat() if db_ride.completed_at else None
+        "completed_at": db_ride.completed_at.isoformat() if db_ride.completed_at else None,
+        "route_polyline": db_ride.route_polyline
     }
 
+@app.get("/rides/{ride_id}/track")
+async def get_ride_track(ride_id: str, format: str = "ndjson"):
+    """
+    Stream the GPS track recorded for a ride: one JSON point per line, or the
+    raw 24-byte track records with format=binary (layout in track_store).
+    Tracks are local to the worker that recorded them, so with several
+    workers this only finds rides driven by drivers connected to this one.
+    """
+    track_store = manager.track_store
+    ride_channel = f"ride_{ride_id}"
+    if track_store is None or not track_store.has_ride(ride_channel):
+        raise HTTPException(status_code=404, detail="No track recorded for this ride")
+
+    if format == "binary":
+        def chunks():
+            for points in track_store.iter_ride(ride_channel):
+                yield points.tobytes()
+        return StreamingResponse(chunks(), media_type="application/octet-stream")
+
+    def lines():
+        for points in track_store.iter_ride(ride_channel):
+            yield "".join(encode_json(point) + "\n" for point in points_to_dicts(points))
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @app.put("/rides/{ride_id}/accept")
-async def accept_ride(ride_id: str, driver_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def accept_ride(ride_id: str, driver_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    db_driver = db.query(DBUser).filter(DBUser.id == driver_id).first()
+    db_driver = await db.scalar(select(DBUser).where(DBUser.id == driver_id))
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
     db_ride.status = RideStatus.ACCEPTED
     db_ride.driver_id = driver_id
     db_ride.accepted_at = datetime.datetime.now()
-    db.commit()
+    await db.commit()
+    manager.assign_driver_to_ride(str(driver_id), f"ride_{ride_id}")
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_accepted",
@@ -558,14 +697,16 @@ async def accept_ride(ride_id: str, driver_id: str, db: Session = Depends(get_db
     return {"message": "Ride accepted successfully"}
 
 @app.put("/rides/{ride_id}/start")
-async def start_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def start_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
     db_ride.status = RideStatus.IN_PROGRESS
     db_ride.started_at = datetime.datetime.now()
-    db.commit()
+    await db.commit()
+    if db_ride.driver_id:
+        manager.start_trail(str(db_ride.driver_id))
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_started",
@@ -578,14 +719,18 @@ async def start_ride(ride_id: str, db: Session = Depends(get_db)):
     return {"message": "Ride started successfully"}
 
 @app.put("/rides/{ride_id}/complete")
-async def complete_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def complete_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
     db_ride.status = RideStatus.COMPLETED
     db_ride.completed_at = datetime.datetime.now()
-    db.commit()
+    if db_ride.driver_id:
+        _store_trail(db_ride, manager.finish_trail(str(db_ride.driver_id), ride_id))
+    await db.commit()
+    if db_ride.driver_id:
+        manager.release_driver_ride(str(db_ride.driver_id), f"ride_{ride_id}")
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_completed",
@@ -598,7 +743,7 @@ async def complete_ride(ride_id: str, db: Session = Depends(get_db)):
     return {"message": "Ride completed successfully"}
 
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, db: AsyncSession = Depends(get_async_db)):
     """
     WebSocket endpoint for real-time communication
     Message types:
@@ -607,6 +752,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
     - subscribe_to_rides: driver subscribes to receive ride requests
     - cancel_ride_request: cancel a ride request
     - subscribe_to_ride: subscribe to updates for a specific ride
+    - subscribe_to_driver_locations: receive driver locations inside a viewport or radius
+    - unsubscribe_from_driver_locations: stop receiving driver locations
+    - ack_driver_locations: acknowledge the last applied driver location frame
+    - driver_locations_resync: request a full driver location keyframe
+    - negotiate_protocol: switch driver telemetry to binary frames (see telemetry_protocol)
     - update_ride_status: update ride status
     """
     await manager.connect(websocket, user_id)
@@ -617,25 +767,60 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
         websocket.client_state["user_id"] = user_id
         
         # Check if user exists and is active
-        db_user = db.query(DBUser).filter(DBUser.id == user_id).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.id == user_id))
         if not db_user or not db_user.is_active:
-            await websocket.send_json({
+            _reply(user_id, {
                 "type": "error",
                 "message": "User not found or inactive"
             })
-            await websocket.close()
+            await manager.close_user(user_id)
             return
             
         # Send initial state
-        await websocket.send_json({
+        _reply(user_id, {
             "type": "connection_established",
             "user_id": user_id,
             "user_type": str(db_user.user_type.value)
         })
         
+        # Drivers may switch location pings to binary frames
+        telemetry_protocol = PROTOCOL_JSON
+
         # Main message loop
         while True:
-            data = await websocket.receive_text()
+            # End any transaction the last message began so an idle socket doesn't
+            # hold a pooled connection; commit rather than rollback so db_user stays loaded
+            if db.in_transaction():
+                await db.commit()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+
+            if frame.get("bytes") is not None:
+                # Binary telemetry: one or more fixed-width location records
+                if telemetry_protocol != PROTOCOL_BINARY_V1 or db_user.user_type != UserType.DRIVER:
+                    _reply(user_id, {
+                        "type": "error",
+                        "message": "Binary telemetry has not been negotiated"
+                    })
+                    continue
+
+                try:
+                    records = decode_records(frame["bytes"])
+                except TelemetryDecodeError as e:
+                    # Nothing from a bad frame is applied
+                    _reply(user_id, {
+                        "type": "error",
+                        "message": f"Invalid telemetry frame: {str(e)}"
+                    })
+                    continue
+
+                for lat, lng, heading, speed, _timestamp_ms in records:
+                    await manager.update_driver_position(user_id, lat, lng, heading, speed)
+                location_sink.record(user_id, *records[-1][:2])
+                continue
+
+            data = frame.get("text")
             try:
                 message = json.loads(data)
                 message_type = message.get("type", "")
@@ -644,7 +829,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                 if message_type == "driver_location":
                     # Update driver location
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can update location"
                         })
@@ -652,29 +837,42 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     location = message.get("location", {})
                     if not location or "lat" not in location or "lng" not in location:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Invalid location data"
                         })
                         continue
                         
-                    # Update in database
-                    db_user.current_latitude = location["lat"]
-                    db_user.current_longitude = location["lng"]
-                    db_user.updated_at = datetime.now(timezone.utc)
-                    db.commit()
+                    # Persisted in bulk by the write-behind location sink
+                    location_sink.record(user_id, location["lat"], location["lng"])
                     
                     # Update in real-time service
                     await manager.update_driver_location(user_id, location)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "location_updated"
                     })
                     
+                elif message_type == "negotiate_protocol":
+                    requested = message.get("telemetry", PROTOCOL_JSON)
+                    if requested not in SUPPORTED_TELEMETRY_PROTOCOLS:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": f"Unsupported telemetry protocol: {requested}"
+                        })
+                        continue
+
+                    telemetry_protocol = requested
+                    _reply(user_id, {
+                        "type": "protocol_negotiated",
+                        "telemetry": telemetry_protocol,
+                        "record_size": RECORD_SIZE
+                    })
+
                 elif message_type == "subscribe_to_rides":
                     # Driver subscribes to receive ride requests
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can subscribe to ride requests"
                         })
@@ -682,19 +880,19 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     # Update driver availability
                     db_user.is_available = True
-                    db.commit()
+                    await db.commit()
                     
                     # Subscribe to ride requests
                     await manager.subscribe_to_rides(user_id)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "subscribed_to_rides"
                     })
                     
                 elif message_type == "unsubscribe_from_rides":
                     # Driver unsubscribes from ride requests
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can unsubscribe from ride requests"
                         })
@@ -702,27 +900,75 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     # Update driver availability
                     db_user.is_available = False
-                    db.commit()
+                    await db.commit()
                     
                     # Handled by disconnect
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "unsubscribed_from_rides"
                     })
                     
+                elif message_type == "subscribe_to_driver_locations":
+                    # Client registers the map area it wants driver locations for
+                    try:
+                        if "viewport" in message:
+                            viewport = Viewport.from_bounds(message["viewport"])
+                        else:
+                            center = message["center"]
+                            viewport = Viewport.from_radius(
+                                float(center["lat"]), float(center["lng"]),
+                                float(message.get("radius_km", 5.0))
+                            )
+                    except (KeyError, TypeError, ValueError) as e:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": f"Invalid viewport: {str(e)}"
+                        })
+                        continue
+
+                    try:
+                        await manager.subscribe_to_driver_locations(user_id, viewport)
+                    except ValueError as e:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": str(e)
+                        })
+                        continue
+
+                    _reply(user_id, {
+                        "type": "subscribed_to_driver_locations"
+                    })
+
+                elif message_type == "unsubscribe_from_driver_locations":
+                    manager.unsubscribe_from_driver_locations(user_id)
+                    _reply(user_id, {
+                        "type": "unsubscribed_from_driver_locations"
+                    })
+
+                elif message_type == "ack_driver_locations":
+                    # No reply: acks arrive once per frame
+                    try:
+                        manager.ack_driver_locations(user_id, int(message.get("seq", 0)))
+                    except (TypeError, ValueError):
+                        pass
+
+                elif message_type == "driver_locations_resync":
+                    # Client detected a gap in the frame sequence
+                    await manager.resync_driver_locations(user_id)
+
                 elif message_type == "subscribe_to_ride":
                     # Subscribe to updates for a specific ride
                     ride_id = message.get("ride_id")
                     if not ride_id:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Missing ride_id"
                         })
                         continue
                         
                     # Check if user is part of this ride
-                    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+                    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
                     if not db_ride or (str(db_ride.rider_id) != user_id and str(db_ride.driver_id) != user_id):
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "You are not part of this ride"
                         })
@@ -731,8 +977,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     # Subscribe to ride updates
                     ride_channel = f"ride_{ride_id}"
                     await manager.subscribe_to_ride_updates(ride_channel, websocket)
+                    # Re-establish in-ride forwarding for a driver resuming an active ride
+                    if str(db_ride.driver_id) == user_id and db_ride.status in [RideStatus.ACCEPTED, RideStatus.IN_PROGRESS]:
+                        manager.assign_driver_to_ride(user_id, ride_channel)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "subscribed_to_ride",
                         "ride_id": ride_id
                     })
@@ -743,16 +992,16 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     status = message.get("status")
                     
                     if not ride_id or not status:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Missing ride_id or status"
                         })
                         continue
                         
                     # Check if driver is assigned to this ride
-                    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+                    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
                     if not db_ride or str(db_ride.driver_id) != user_id:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "You are not the driver of this ride"
                         })
@@ -761,7 +1010,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     # Update ride status
                     if status == "started":
                         if db_ride.status != RideStatus.ACCEPTED:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot start ride with status {db_ride.status}"
                             })
@@ -769,10 +1018,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                             
                         db_ride.status = RideStatus.IN_PROGRESS
                         db_ride.started_at = datetime.now(timezone.utc)
+                        manager.start_trail(user_id)
                         
                     elif status == "arrived":
                         if db_ride.status != RideStatus.ACCEPTED:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot mark arrival for ride with status {db_ride.status}"
                             })
@@ -782,7 +1032,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     elif status == "completed":
                         if db_ride.status != RideStatus.IN_PROGRESS:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot complete ride with status {db_ride.status}"
                             })
@@ -790,18 +1040,20 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                             
                         db_ride.status = RideStatus.COMPLETED
                         db_ride.completed_at = datetime.now(timezone.utc)
+                        _store_trail(db_ride, manager.finish_trail(user_id, ride_id))
                         
                         # Update driver's total rides
                         db_user.total_rides += 1
+                        manager.release_driver_ride(user_id, f"ride_{ride_id}")
                         
                     else:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": f"Invalid status: {status}"
                         })
                         continue
                         
-                    db.commit()
+                    await db.commit()
                     
                     # Broadcast to all ride subscribers
                     status_data = {
@@ -812,9 +1064,12 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     
                     # Add driver location for 'started' and 'arrived' events
                     if status in ["started", "arrived"]:
+                        # The DB row lags behind the live position by up to one sink flush
+                        live_position = manager.driver_locations.position(user_id)
+                        lat, lng = live_position or (db_user.current_latitude, db_user.current_longitude)
                         status_data["location"] = {
-                            "lat": db_user.current_latitude,
-                            "lng": db_user.current_longitude
+                            "lat": lat,
+                            "lng": lng
                         }
                         
                     await manager.broadcast_ride_update(f"ride_{ride_id}", status_data)
@@ -846,29 +1101,29 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         related_id=str(ride_id)
                     )
                     db.add(db_notification)
-                    db.commit()
+                    await db.commit()
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "ride_status_updated",
                         "ride_id": ride_id,
                         "status": status
                     })
                 
                 else:
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "error",
                         "message": f"Unknown message type: {message_type}"
                     })
                 
             except json.JSONDecodeError:
-                await websocket.send_json({
+                _reply(user_id, {
                     "type": "error",
                     "message": "Invalid JSON message"
                 })
                 
             except Exception as e:
                 print(f"Error processing WebSocket message: {str(e)}")
-                await websocket.send_json({
+                _reply(user_id, {
                     "type": "error",
                     "message": f"Error processing message: {str(e)}"
                 })
@@ -881,10 +1136,10 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
 
 # Add API endpoint for frontend compatibility
 @app.post("/api/auth/login")
-async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
+async def login_api(user_login: UserLogin, db: AsyncSession = Depends(get_async_db)):
     try:
         # Check if user exists and password is correct
-        db_user = db.query(DBUser).filter(DBUser.email == user_login.email).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.email == user_login.email))
         if not db_user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -896,7 +1151,7 @@ async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
         print(f"Attempting to verify password for user: {db_user.email}")
         print(f"Password hash in DB: {db_user.password_hash[:20]}...")
 
-        if not verify_password(user_login.password, db_user.password_hash):
+        if not await password_hasher.verify(user_login.password, db_user.password_hash):
             print("Password verification failed")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -942,7 +1197,7 @@ async def login_api(user_login: UserLogin, db: Session = Depends(get_db)):
         )
 
 @app.get("/users/me", response_model=None)
-async def read_users_me(current_user: DBUser = Depends(get_current_active_user)):
+async def read_users_me(current_user: DBUser = Depends(get_current_active_user_async)):
     return {
         "id": current_user.id,
         "email": current_user.email,
@@ -954,7 +1209,7 @@ async def read_users_me(current_user: DBUser = Depends(get_current_active_user))
 
 # Add API endpoint for frontend compatibility
 @app.get("/api/auth/me")
-async def get_current_user_api(current_user: DBUser = Depends(get_current_user)):
+async def get_current_user_api(current_user: DBUser = Depends(get_current_user_async)):
     """
     Get the current user's information.
     This endpoint is used by the frontend to check if the user is logged in.
@@ -1015,8 +1270,8 @@ async def redirect_based_on_user_type(request: Request, db: Session = Depends(ge
 @app.post("/rides", response_model=dict)
 async def create_ride(
     ride: RideCreate,
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     db_ride = DBRide(
         rider_id=current_user.id,
@@ -1028,16 +1283,16 @@ async def create_ride(
         dropoff_lng=ride.dropoff_lng
     )
     db.add(db_ride)
-    db.commit()
-    db.refresh(db_ride)
+    await db.commit()
+    await db.refresh(db_ride)
     return db_ride.__dict__
 
 @app.get("/rides", response_model=List[dict])
 async def get_rides(
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    rides = db.query(DBRide).filter(DBRide.rider_id == current_user.id).all()
+    rides = (await db.scalars(select(DBRide).where(DBRide.rider_id == current_user.id))).all()
     return [ride.__dict__ for ride in rides]
 
 @app.post("/users/", response_model=dict)
@@ -1063,16 +1318,16 @@ async def get_user(user_id: str, db: Session = Depends(get_db)):
     }
 
 @app.post("/rides/", response_model=dict)
-async def create_ride(ride: dict, db: Session = Depends(get_db)):
+async def create_ride(ride: dict, db: AsyncSession = Depends(get_async_db)):
     db_ride = DBRide(**ride)
     db.add(db_ride)
-    db.commit()
-    db.refresh(db_ride)
+    await db.commit()
+    await db.refresh(db_ride)
     return ride
 
 @app.get("/rides/{ride_id}", response_model=dict)
-async def get_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def get_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
     return {
@@ -1089,23 +1344,25 @@ async def get_ride(ride_id: str, db: Session = Depends(get_db)):
         "requested_at": db_ride.requested_at.isoformat() if db_ride.requested_at else None,
         "accepted_at": db_ride.accepted_at.isoformat() if db_ride.accepted_at else None,
         "started_at": db_ride.started_at.isoformat() if db_ride.started_at else None,
-        "completed_at": db_ride.completed_at.isoformat() if db_ride.completed_at else None
+        "completed_at": db_ride.completed_at.isoformat() if db_ride.completed_at else None,
+        "route_polyline": db_ride.route_polyline
     }
 
 @app.put("/rides/{ride_id}/accept")
-async def accept_ride(ride_id: str, driver_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def accept_ride(ride_id: str, driver_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    db_driver = db.query(DBUser).filter(DBUser.id == driver_id).first()
+    db_driver = await db.scalar(select(DBUser).where(DBUser.id == driver_id))
     if not db_driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
     db_ride.status = RideStatus.ACCEPTED
     db_ride.driver_id = driver_id
     db_ride.accepted_at = datetime.datetime.now()
-    db.commit()
+    await db.commit()
+    manager.assign_driver_to_ride(str(driver_id), f"ride_{ride_id}")
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_accepted",
@@ -1126,14 +1383,16 @@ async def accept_ride(ride_id: str, driver_id: str, db: Session = Depends(get_db
     return {"message": "Ride accepted successfully"}
 
 @app.put("/rides/{ride_id}/start")
-async def start_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def start_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
     db_ride.status = RideStatus.IN_PROGRESS
     db_ride.started_at = datetime.datetime.now()
-    db.commit()
+    await db.commit()
+    if db_ride.driver_id:
+        manager.start_trail(str(db_ride.driver_id))
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_started",
@@ -1146,14 +1405,18 @@ async def start_ride(ride_id: str, db: Session = Depends(get_db)):
     return {"message": "Ride started successfully"}
 
 @app.put("/rides/{ride_id}/complete")
-async def complete_ride(ride_id: str, db: Session = Depends(get_db)):
-    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+async def complete_ride(ride_id: str, db: AsyncSession = Depends(get_async_db)):
+    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
     if not db_ride:
         raise HTTPException(status_code=404, detail="Ride not found")
 
     db_ride.status = RideStatus.COMPLETED
     db_ride.completed_at = datetime.datetime.now()
-    db.commit()
+    if db_ride.driver_id:
+        _store_trail(db_ride, manager.finish_trail(str(db_ride.driver_id), ride_id))
+    await db.commit()
+    if db_ride.driver_id:
+        manager.release_driver_ride(str(db_ride.driver_id), f"ride_{ride_id}")
 
     await manager.broadcast_ride_update(ride_id, {
         "type": "ride_completed",
@@ -1166,7 +1429,7 @@ async def complete_ride(ride_id: str, db: Session = Depends(get_db)):
     return {"message": "Ride completed successfully"}
 
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, db: AsyncSession = Depends(get_async_db)):
     """
     WebSocket endpoint for real-time communication
     Message types:
@@ -1175,6 +1438,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
     - subscribe_to_rides: driver subscribes to receive ride requests
     - cancel_ride_request: cancel a ride request
     - subscribe_to_ride: subscribe to updates for a specific ride
+    - subscribe_to_driver_locations: receive driver locations inside a viewport or radius
+    - unsubscribe_from_driver_locations: stop receiving driver locations
+    - ack_driver_locations: acknowledge the last applied driver location frame
+    - driver_locations_resync: request a full driver location keyframe
+    - negotiate_protocol: switch driver telemetry to binary frames (see telemetry_protocol)
     - update_ride_status: update ride status
     """
     await manager.connect(websocket, user_id)
@@ -1185,25 +1453,60 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
         websocket.client_state["user_id"] = user_id
         
         # Check if user exists and is active
-        db_user = db.query(DBUser).filter(DBUser.id == user_id).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.id == user_id))
         if not db_user or not db_user.is_active:
-            await websocket.send_json({
+            _reply(user_id, {
                 "type": "error",
                 "message": "User not found or inactive"
             })
-            await websocket.close()
+            await manager.close_user(user_id)
             return
             
         # Send initial state
-        await websocket.send_json({
+        _reply(user_id, {
             "type": "connection_established",
             "user_id": user_id,
             "user_type": str(db_user.user_type.value)
         })
         
+        # Drivers may switch location pings to binary frames
+        telemetry_protocol = PROTOCOL_JSON
+
         # Main message loop
         while True:
-            data = await websocket.receive_text()
+            # End any transaction the last message began so an idle socket doesn't
+            # hold a pooled connection; commit rather than rollback so db_user stays loaded
+            if db.in_transaction():
+                await db.commit()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+
+            if frame.get("bytes") is not None:
+                # Binary telemetry: one or more fixed-width location records
+                if telemetry_protocol != PROTOCOL_BINARY_V1 or db_user.user_type != UserType.DRIVER:
+                    _reply(user_id, {
+                        "type": "error",
+                        "message": "Binary telemetry has not been negotiated"
+                    })
+                    continue
+
+                try:
+                    records = decode_records(frame["bytes"])
+                except TelemetryDecodeError as e:
+                    # Nothing from a bad frame is applied
+                    _reply(user_id, {
+                        "type": "error",
+                        "message": f"Invalid telemetry frame: {str(e)}"
+                    })
+                    continue
+
+                for lat, lng, heading, speed, _timestamp_ms in records:
+                    await manager.update_driver_position(user_id, lat, lng, heading, speed)
+                location_sink.record(user_id, *records[-1][:2])
+                continue
+
+            data = frame.get("text")
             try:
                 message = json.loads(data)
                 message_type = message.get("type", "")
@@ -1212,7 +1515,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                 if message_type == "driver_location":
                     # Update driver location
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can update location"
                         })
@@ -1220,29 +1523,42 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     location = message.get("location", {})
                     if not location or "lat" not in location or "lng" not in location:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Invalid location data"
                         })
                         continue
                         
-                    # Update in database
-                    db_user.current_latitude = location["lat"]
-                    db_user.current_longitude = location["lng"]
-                    db_user.updated_at = datetime.now(timezone.utc)
-                    db.commit()
+                    # Persisted in bulk by the write-behind location sink
+                    location_sink.record(user_id, location["lat"], location["lng"])
                     
                     # Update in real-time service
                     await manager.update_driver_location(user_id, location)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "location_updated"
                     })
                     
+                elif message_type == "negotiate_protocol":
+                    requested = message.get("telemetry", PROTOCOL_JSON)
+                    if requested not in SUPPORTED_TELEMETRY_PROTOCOLS:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": f"Unsupported telemetry protocol: {requested}"
+                        })
+                        continue
+
+                    telemetry_protocol = requested
+                    _reply(user_id, {
+                        "type": "protocol_negotiated",
+                        "telemetry": telemetry_protocol,
+                        "record_size": RECORD_SIZE
+                    })
+
                 elif message_type == "subscribe_to_rides":
                     # Driver subscribes to receive ride requests
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can subscribe to ride requests"
                         })
@@ -1250,19 +1566,19 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     # Update driver availability
                     db_user.is_available = True
-                    db.commit()
+                    await db.commit()
                     
                     # Subscribe to ride requests
                     await manager.subscribe_to_rides(user_id)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "subscribed_to_rides"
                     })
                     
                 elif message_type == "unsubscribe_from_rides":
                     # Driver unsubscribes from ride requests
                     if db_user.user_type != UserType.DRIVER:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Only drivers can unsubscribe from ride requests"
                         })
@@ -1270,27 +1586,75 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     # Update driver availability
                     db_user.is_available = False
-                    db.commit()
+                    await db.commit()
                     
                     # Handled by disconnect
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "unsubscribed_from_rides"
                     })
                     
+                elif message_type == "subscribe_to_driver_locations":
+                    # Client registers the map area it wants driver locations for
+                    try:
+                        if "viewport" in message:
+                            viewport = Viewport.from_bounds(message["viewport"])
+                        else:
+                            center = message["center"]
+                            viewport = Viewport.from_radius(
+                                float(center["lat"]), float(center["lng"]),
+                                float(message.get("radius_km", 5.0))
+                            )
+                    except (KeyError, TypeError, ValueError) as e:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": f"Invalid viewport: {str(e)}"
+                        })
+                        continue
+
+                    try:
+                        await manager.subscribe_to_driver_locations(user_id, viewport)
+                    except ValueError as e:
+                        _reply(user_id, {
+                            "type": "error",
+                            "message": str(e)
+                        })
+                        continue
+
+                    _reply(user_id, {
+                        "type": "subscribed_to_driver_locations"
+                    })
+
+                elif message_type == "unsubscribe_from_driver_locations":
+                    manager.unsubscribe_from_driver_locations(user_id)
+                    _reply(user_id, {
+                        "type": "unsubscribed_from_driver_locations"
+                    })
+
+                elif message_type == "ack_driver_locations":
+                    # No reply: acks arrive once per frame
+                    try:
+                        manager.ack_driver_locations(user_id, int(message.get("seq", 0)))
+                    except (TypeError, ValueError):
+                        pass
+
+                elif message_type == "driver_locations_resync":
+                    # Client detected a gap in the frame sequence
+                    await manager.resync_driver_locations(user_id)
+
                 elif message_type == "subscribe_to_ride":
                     # Subscribe to updates for a specific ride
                     ride_id = message.get("ride_id")
                     if not ride_id:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Missing ride_id"
                         })
                         continue
                         
                     # Check if user is part of this ride
-                    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+                    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
                     if not db_ride or (str(db_ride.rider_id) != user_id and str(db_ride.driver_id) != user_id):
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "You are not part of this ride"
                         })
@@ -1299,8 +1663,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     # Subscribe to ride updates
                     ride_channel = f"ride_{ride_id}"
                     await manager.subscribe_to_ride_updates(ride_channel, websocket)
+                    # Re-establish in-ride forwarding for a driver resuming an active ride
+                    if str(db_ride.driver_id) == user_id and db_ride.status in [RideStatus.ACCEPTED, RideStatus.IN_PROGRESS]:
+                        manager.assign_driver_to_ride(user_id, ride_channel)
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "subscribed_to_ride",
                         "ride_id": ride_id
                     })
@@ -1311,16 +1678,16 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     status = message.get("status")
                     
                     if not ride_id or not status:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "Missing ride_id or status"
                         })
                         continue
                         
                     # Check if driver is assigned to this ride
-                    db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+                    db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
                     if not db_ride or str(db_ride.driver_id) != user_id:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": "You are not the driver of this ride"
                         })
@@ -1329,7 +1696,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     # Update ride status
                     if status == "started":
                         if db_ride.status != RideStatus.ACCEPTED:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot start ride with status {db_ride.status}"
                             })
@@ -1337,10 +1704,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                             
                         db_ride.status = RideStatus.IN_PROGRESS
                         db_ride.started_at = datetime.now(timezone.utc)
+                        manager.start_trail(user_id)
                         
                     elif status == "arrived":
                         if db_ride.status != RideStatus.ACCEPTED:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot mark arrival for ride with status {db_ride.status}"
                             })
@@ -1350,7 +1718,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         
                     elif status == "completed":
                         if db_ride.status != RideStatus.IN_PROGRESS:
-                            await websocket.send_json({
+                            _reply(user_id, {
                                 "type": "error",
                                 "message": f"Cannot complete ride with status {db_ride.status}"
                             })
@@ -1358,18 +1726,20 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                             
                         db_ride.status = RideStatus.COMPLETED
                         db_ride.completed_at = datetime.now(timezone.utc)
+                        _store_trail(db_ride, manager.finish_trail(user_id, ride_id))
                         
                         # Update driver's total rides
                         db_user.total_rides += 1
+                        manager.release_driver_ride(user_id, f"ride_{ride_id}")
                         
                     else:
-                        await websocket.send_json({
+                        _reply(user_id, {
                             "type": "error",
                             "message": f"Invalid status: {status}"
                         })
                         continue
                         
-                    db.commit()
+                    await db.commit()
                     
                     # Broadcast to all ride subscribers
                     status_data = {
@@ -1380,9 +1750,12 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                     
                     # Add driver location for 'started' and 'arrived' events
                     if status in ["started", "arrived"]:
+                        # The DB row lags behind the live position by up to one sink flush
+                        live_position = manager.driver_locations.position(user_id)
+                        lat, lng = live_position or (db_user.current_latitude, db_user.current_longitude)
                         status_data["location"] = {
-                            "lat": db_user.current_latitude,
-                            "lng": db_user.current_longitude
+                            "lat": lat,
+                            "lng": lng
                         }
                         
                     await manager.broadcast_ride_update(f"ride_{ride_id}", status_data)
@@ -1414,29 +1787,29 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
                         related_id=str(ride_id)
                     )
                     db.add(db_notification)
-                    db.commit()
+                    await db.commit()
                     
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "ride_status_updated",
                         "ride_id": ride_id,
                         "status": status
                     })
                 
                 else:
-                    await websocket.send_json({
+                    _reply(user_id, {
                         "type": "error",
                         "message": f"Unknown message type: {message_type}"
                     })
                 
             except json.JSONDecodeError:
-                await websocket.send_json({
+                _reply(user_id, {
                     "type": "error",
                     "message": "Invalid JSON message"
                 })
                 
             except Exception as e:
                 print(f"Error processing WebSocket message: {str(e)}")
-                await websocket.send_json({
+                _reply(user_id, {
                     "type": "error",
                     "message": f"Error processing message: {str(e)}"
                 })
@@ -1452,7 +1825,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
     """
     try:
         # Get ride from DB
-        db_ride = db.query(DBRide).filter(DBRide.id == ride_id).first()
+        db_ride = await db.scalar(select(DBRide).where(DBRide.id == ride_id))
         if not db_ride:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -1478,17 +1851,19 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
         db_ride.cancelled_at = datetime.now(timezone.utc)
         db_ride.cancellation_reason = cancellation_reason
         db_ride.cancelled_by = "rider" if str(current_user.id) == str(db_ride.rider_id) else "driver"
-        db.commit()
+        await db.commit()
+        if db_ride.driver_id:
+            manager.release_driver_ride(str(db_ride.driver_id), f"ride_{ride_id}")
+            manager.discard_trail(str(db_ride.driver_id))
         
         # Notify other party
         other_user_id = str(db_ride.driver_id) if str(current_user.id) == str(db_ride.rider_id) else str(db_ride.rider_id)
-        if other_user_id in manager.active_connections:
-            await manager.active_connections[other_user_id].send_json({
-                'type': 'ride_cancelled',
-                'ride_id': ride_id,
-                'cancelled_by': db_ride.cancelled_by,
-                'reason': cancellation_reason
-            })
+        manager.send_to_user(other_user_id, {
+            'type': 'ride_cancelled',
+            'ride_id': ride_id,
+            'cancelled_by': db_ride.cancelled_by,
+            'reason': cancellation_reason
+        }, priority=PRIORITY_RIDE)
         
         # Create notification
         db_notification = Notification(
@@ -1499,7 +1874,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
             related_id=str(ride_id)
         )
         db.add(db_notification)
-        db.commit()
+        await db.commit()
         
         # Broadcast to all subscribers
         await manager.broadcast_ride_update(f"ride_{ride_id}", {
@@ -1516,7 +1891,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error cancelling ride: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1527,21 +1902,22 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = D
 @app.get("/api/notifications")
 async def get_notifications(
     params: NotificationResponse = Depends(),
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get user notifications
     """
     try:
-        query = db.query(Notification).filter(Notification.user_id == current_user.id)
+        query = select(Notification).where(Notification.user_id == current_user.id)
         if params.unread_only:
-            query = query.filter(Notification.is_read == False)
+            query = query.where(Notification.is_read == False)
         
-        total = query.count()
+        total = await db.scalar(select(func.count()).select_from(query.subquery()))
         
-        notifications = query.order_by(Notification.created_at.desc()) \
-            .offset(params.offset).limit(params.limit).all()
+        notifications = (await db.scalars(
+            query.order_by(Notification.created_at.desc()).offset(params.offset).limit(params.limit)
+        )).all()
         
         return {
             "status": "success",
@@ -1570,26 +1946,28 @@ async def get_notifications(
 @app.post("/api/notifications/read")
 async def mark_notifications_read(
     notification_ids: List[int],
-    current_user: DBUser = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_active_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Mark notifications as read
     """
     try:
         # Only update notifications belonging to the current user
-        db.query(Notification) \
-            .filter(Notification.user_id == current_user.id) \
-            .filter(Notification.id.in_(notification_ids)) \
-            .update({Notification.is_read: True}, synchronize_session=False)
-        db.commit()
+        await db.execute(
+            update(Notification)
+            .where(Notification.user_id == current_user.id)
+            .where(Notification.id.in_(notification_ids))
+            .values(is_read=True)
+        )
+        await db.commit()
         
         return {
             "status": "success",
             "message": f"Marked {len(notification_ids)} notifications as read"
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error marking notifications as read: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
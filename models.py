@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Enum, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Enum, ForeignKey, Float, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -115,6 +115,7 @@ class Ride(Base):
     fare = Column(Float)
     distance = Column(Float, nullable=True)  # in kilometers
     duration = Column(Integer, nullable=True)  # estimated duration in minutes
+    route_polyline = Column(Text, nullable=True)  # driven route, simplified, as an encoded polyline
     
     # Timestamps
     created_at = Column(DateTime, default=lambda: datetime.datetime.now(timezone.utc))
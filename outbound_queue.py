@@ -0,0 +1,140 @@
+from collections import deque
+from typing import Callable, Deque, List, Optional
+import asyncio
+
+from frame_codec import EncodedFrame
+
+# Priority lanes, drained in this order
+PRIORITY_RIDE = 0  # Ride lifecycle: offers, cancellations, status changes
+PRIORITY_MAP = 1   # Map updates: driver location frames
+# Replies to a client's own messages share the ride lane: never dropped, and
+# kept in order with the ride events around them
+PRIORITY_REPLY = PRIORITY_RIDE
+
+# What to do when a connection's queue is full
+POLICY_DROP_OLDEST = "drop_oldest"  # Drop the oldest queued map frame
+POLICY_DISCONNECT = "disconnect"    # Disconnect the slow consumer
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection outbound queue drained by its own writer task, so a
+    slow client only delays its own messages. Ride lifecycle messages always
+    go ahead of map updates. Messages are queued pre-encoded so a broadcast
+    is serialized once no matter how many queues it lands in.
+
+    When the queue is full under POLICY_DROP_OLDEST the oldest map frame is
+    discarded (`on_drop` is called so the sender can resync that client). If
+    there is no map frame to discard, or the policy is POLICY_DISCONNECT, the
+    connection is treated as a slow consumer and `on_overflow` is called.
+    A send that fails (usually a client that already went away) closes the
+    queue and calls `on_error` instead.
+    """
+
+    def __init__(self, websocket, user_id: str, max_size: int = 256,
+                 policy: str = POLICY_DROP_OLDEST,
+                 on_drop: Optional[Callable[[str, EncodedFrame], None]] = None,
+                 on_overflow: Optional[Callable[[str], None]] = None,
+                 on_error: Optional[Callable[[str], None]] = None):
+        if policy not in (POLICY_DROP_OLDEST, POLICY_DISCONNECT):
+            raise ValueError(f"Unknown outbound queue policy: {policy}")
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_size = max_size
+        self.policy = policy
+        self.on_drop = on_drop
+        self.on_overflow = on_overflow
+        self.on_error = on_error
+        self.lanes: List[Deque[EncodedFrame]] = [deque(), deque()]
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self) -> int:
+        return len(self.lanes[PRIORITY_RIDE]) + len(self.lanes[PRIORITY_MAP])
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._writer())
+
+    def close(self):
+        """Stop the writer and discard anything still queued"""
+        self.closed = True
+        for lane in self.lanes:
+            lane.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+        self._idle.set()
+
+    async def drain(self, timeout: float = 1.0) -> bool:
+        """Wait up to `timeout` seconds for everything queued so far to be sent"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self.closed
+
+    def put(self, frame: EncodedFrame, priority: int = PRIORITY_MAP) -> bool:
+        """Queue a message without waiting; returns False if it was not queued"""
+        if self.closed:
+            return False
+
+        if len(self) >= self.max_size:
+            map_lane = self.lanes[PRIORITY_MAP]
+            if self.policy == POLICY_DROP_OLDEST and map_lane:
+                dropped = map_lane.popleft()
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(self.user_id, dropped)
+            else:
+                print(f"Outbound queue full for user {self.user_id}; disconnecting slow consumer")
+                self.close()
+                if self.on_overflow is not None:
+                    self.on_overflow(self.user_id)
+                return False
+
+        self.lanes[priority].append(frame)
+        self.max_depth = max(self.max_depth, len(self))
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    def _pop(self) -> Optional[EncodedFrame]:
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    async def _writer(self):
+        while not self.closed:
+            if not len(self):
+                self._ready.clear()
+                self._idle.set()
+                await self._ready.wait()
+                continue
+            frame = self._pop()
+            try:
+                await self.websocket.send_text(frame.text)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error sending to user {self.user_id}: {str(e)}")
+                self.close()
+                if self.on_error is not None:
+                    self.on_error(self.user_id)
+
+    def stats(self) -> dict:
+        return {
+            'depth': len(self),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped
+        }
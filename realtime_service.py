@@ -1,128 +1,483 @@
 from fastapi import WebSocket
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 import json
 from datetime import datetime
 import math
 import asyncio
+import os
+import time
+import numpy as np
+from sqlalchemy import update
 from sqlalchemy.orm import Session
+from database import AsyncSessionLocal
+from models import Ride
+from geo_index import SpatialGridIndex, Viewport, ViewportSubscriptionIndex
+from driver_store import DriverLocationStore
+from broadcast_scheduler import BroadcastScheduler
+from dispatch_engine import DispatchEngine, DispatchBatch, DISPATCH_MAX_PICKUP_KM
+from expiry_scheduler import ExpiryScheduler, EXPIRE_DRIVER_LOCATION, EXPIRE_RIDE_REQUEST
+from delta_protocol import DeltaFrameProtocol, KEYFRAME_TYPE, DELTA_TYPE
+from outbound_queue import OutboundQueue, PRIORITY_MAP, PRIORITY_RIDE
+from frame_codec import EncodedFrame, encode_json
+from track_store import TrackStore
+from trail_processor import TrailProcessor, TrailSummary
+from routing_engine import RoadRouter, load_router
+from surge_engine import SurgeEngine
+from fare_quote import FareQuoteEngine
+from backplane import (
+    Backplane, create_backplane,
+    MSG_LOCATION, MSG_DRIVER_GONE, MSG_USER, MSG_RIDE, MSG_ASSIGN, MSG_RELEASE, MSG_DEMAND, MSG_TRAIL
+)
+
+# Drivers whose last update is older than this are evicted
+DRIVER_LOCATION_TTL_SECONDS = 300
+# Pending ride requests are offered to drivers for this long, then evicted
+RIDE_REQUEST_TTL_SECONDS = 300
+# Driver location changes are batched and sent to viewers once per tick
+DRIVER_BROADCAST_TICK_MS = int(os.getenv("DRIVER_BROADCAST_TICK_MS", "500"))
+# Per-connection outbound queue bound and full-queue policy (drop_oldest or disconnect)
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_QUEUE_POLICY = os.getenv("OUTBOUND_QUEUE_POLICY", "drop_oldest")
+# Minimum spacing of driver positions forwarded to the participants of an active ride
+RIDE_LOCATION_FORWARD_MS = int(os.getenv("RIDE_LOCATION_FORWARD_MS", "1000"))
 
 class ConnectionManager:
-    def __init__(self):
+    """
+    Realtime state for the connections on this process. With a backplane,
+    sockets, queues and subscriptions stay node-local; driver positions from
+    other nodes are kept as read-only replicas (in `remote_drivers`) so map
+    frames and nearby-driver lookups stay local, and messages for users,
+    ride channels and drivers connected elsewhere are published.
+    """
+
+    def __init__(self, backplane: Optional[Backplane] = None, track_store: Optional[TrackStore] = None,
+                 router: Optional[RoadRouter] = None):
         self.active_connections: Dict[str, WebSocket] = {}
-        self.driver_locations: Dict[str, dict] = {}
-        self.ride_subscriptions: Dict[str, List[WebSocket]] = {}
+        self.outbound_queues: Dict[str, OutboundQueue] = {}  # One writer task per connection
+        self.connection_users: Dict[WebSocket, str] = {}
+        self.slow_consumer_disconnects = 0
+        self.send_failures = 0
+        self.driver_locations = DriverLocationStore()  # Latest location per driver, array-backed
+        self.location_fragments: Dict[str, str] = {}  # Encoded driver snapshots, reused across frames
+        self.driver_index = SpatialGridIndex(cell_size_km=1.0)  # Grid over driver_locations
+        self.ride_subscriptions: Dict[str, Set[WebSocket]] = {}  # Ride channel -> subscribed sockets
+        self.user_channels: Dict[str, Set[str]] = {}  # User -> ride channels, the reverse of ride_subscriptions
+        self.driver_active_rides: Dict[str, str] = {}  # Driver -> channel of the ride they are driving
+        self.ride_forwarded_at: Dict[str, float] = {}  # Driver -> monotonic time of last in-ride forward
+        self.ride_locations_forwarded = 0
+        self.ride_locations_throttled = 0
         self.rider_requests: Dict[str, dict] = {}  # Rider requests with location info
         self.driver_subscriptions: Set[str] = set()  # Drivers looking for rides
+        self.request_offers: Dict[str, Set[str]] = {}  # Rider -> drivers offered their request
+        self.request_end_notices = 0
+        self.viewport_subscriptions = ViewportSubscriptionIndex()  # Map bucket -> watching users
+        self.frame_protocol = DeltaFrameProtocol()  # Per-viewer delta/keyframe sequencing
+        self.broadcast_scheduler = BroadcastScheduler(
+            self.broadcast_driver_updates,
+            tick_seconds=DRIVER_BROADCAST_TICK_MS / 1000
+        )
+        self.expiry = ExpiryScheduler(self._on_expire)  # Evicts stale drivers and requests
+        self.dispatch = DispatchEngine(self._build_dispatch_batch, self._offer_dispatched_ride,
+                                       router=router, on_lapse=self._withdraw_lapsed_offer)
+        self.backplane = backplane  # Links workers; None for a single process
+        self.track_store = track_store  # GPS history of local drivers; None to keep none
+        self.router = router  # Road-graph drive times; None for straight-line ETAs
+        self.surge = SurgeEngine()  # Per-zone open requests vs idle drivers
+        self.fares = FareQuoteEngine(self.surge, router)  # Cached server-side fare quotes
+        self.trails: Dict[str, TrailProcessor] = {}  # Driver -> trail of the ride in progress
+        self.remote_drivers: Set[str] = set()  # Drivers connected to other nodes
+        self.remote_available: Set[str] = set()  # Remote drivers taking ride requests
+        if backplane is not None:
+            backplane.set_handler(self._on_backplane_message)
+
+    def start(self):
+        """Start background tasks; safe to call more than once"""
+        self.broadcast_scheduler.start()
+        self.expiry.start()
+        self.dispatch.start()
+        if self.backplane is not None:
+            self.backplane.start()
+
+    async def shutdown(self):
+        """Stop background tasks and flush pending broadcasts"""
+        await self.dispatch.stop()
+        await self.expiry.stop()
+        await self.broadcast_scheduler.stop()
+        if self.backplane is not None:
+            await self.backplane.stop()
+        if self.track_store is not None:
+            self.track_store.close()
+
+    def get_metrics(self) -> dict:
+        """Counters for the realtime subsystems"""
+        return {
+            'active_connections': len(self.active_connections),
+            'tracked_drivers': len(self.driver_locations),
+            'remote_drivers': len(self.remote_drivers),
+            'pending_ride_requests': len(self.rider_requests),
+            'request_offer_sets': len(self.request_offers),
+            'request_end_notices': self.request_end_notices,
+            'ride_channels': len(self.ride_subscriptions),
+            'in_ride_forwarding': {
+                'active_rides': len(self.driver_active_rides),
+                'interval_ms': RIDE_LOCATION_FORWARD_MS,
+                'forwarded': self.ride_locations_forwarded,
+                'throttled': self.ride_locations_throttled
+            },
+            'viewport_subscribers': len(self.viewport_subscriptions),
+            'driver_broadcasts': self.broadcast_scheduler.stats(),
+            'driver_frames': self.frame_protocol.stats(),
+            'expiry': self.expiry.stats(),
+            'dispatch': self.dispatch.stats(),
+            'routing': self.router.stats() if self.router is not None else None,
+            'surge': self.surge.stats(),
+            'fare_quotes': self.fares.stats(),
+            'backplane': self.backplane.stats() if self.backplane is not None else None,
+            'tracks': self.track_store.stats() if self.track_store is not None else None,
+            'active_trails': len(self.trails),
+            'outbound': {
+                'queued': sum(len(q) for q in self.outbound_queues.values()),
+                'dropped_map_frames': sum(q.dropped for q in self.outbound_queues.values()),
+                'max_depth': max((q.max_depth for q in self.outbound_queues.values()), default=0),
+                'slow_consumer_disconnects': self.slow_consumer_disconnects,
+                'send_failures': self.send_failures
+            }
+        }
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
+
+        prev_queue = self.outbound_queues.pop(user_id, None)
+        if prev_queue is not None:
+            prev_queue.close()
+        prev_websocket = self.active_connections.get(user_id)
+        if prev_websocket is not None and prev_websocket is not websocket:
+            # A reconnect replaces the old socket; it must resubscribe to its rides
+            self.connection_users.pop(prev_websocket, None)
+            self._unsubscribe_user_channels(user_id, prev_websocket)
         self.active_connections[user_id] = websocket
+        self.connection_users[websocket] = user_id
+        queue = OutboundQueue(
+            websocket, user_id,
+            max_size=OUTBOUND_QUEUE_SIZE,
+            policy=OUTBOUND_QUEUE_POLICY,
+            on_drop=self._on_outbound_drop,
+            on_overflow=self._on_slow_consumer,
+            on_error=self._on_send_error
+        )
+        self.outbound_queues[user_id] = queue
+        queue.start()
+        self.start()
         print(f"User {user_id} connected. Total active connections: {len(self.active_connections)}")
 
     def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+        queue = self.outbound_queues.pop(user_id, None)
+        if queue is not None:
+            queue.close()
+
+        websocket = self.active_connections.pop(user_id, None)
+        if websocket is not None:
+            self.connection_users.pop(websocket, None)
             print(f"User {user_id} disconnected. Total active connections: {len(self.active_connections)}")
         
-        if user_id in self.driver_locations:
-            del self.driver_locations[user_id]
+        if self.unsubscribe_from_driver_locations(user_id):
+            print(f"User {user_id} unsubscribed from driver locations")
+
+        if user_id not in self.remote_drivers and self._drop_driver_position(user_id):
             print(f"Driver {user_id} location tracking stopped")
+            self._publish({'kind': MSG_DRIVER_GONE, 'driver_id': user_id})
         
+        self.dispatch.driver_gone(user_id)
         if user_id in self.driver_subscriptions:
             self.driver_subscriptions.remove(user_id)
+            self._sync_supply(user_id)
             print(f"Driver {user_id} unsubscribed from ride requests")
             
-        if user_id in self.rider_requests:
-            del self.rider_requests[user_id]
+        if self._remove_ride_request(user_id) is not None:
             print(f"Rider {user_id} request removed")
             
-        # Remove from ride subscriptions if present
-        for ride_id, websockets in list(self.ride_subscriptions.items()):
-            if user_id in [ws.client_state.get("user_id") for ws in websockets if hasattr(ws, "client_state")]:
-                self.ride_subscriptions[ride_id] = [
-                    ws for ws in websockets 
-                    if not hasattr(ws, "client_state") or ws.client_state.get("user_id") != user_id
-                ]
-                if not self.ride_subscriptions[ride_id]:
-                    del self.ride_subscriptions[ride_id]
-                print(f"User {user_id} unsubscribed from ride {ride_id}")
+        # Remove from ride subscriptions; only this user's channels are touched
+        for ride_id in self._unsubscribe_user_channels(user_id, websocket):
+            print(f"User {user_id} unsubscribed from ride {ride_id}")
+
+    def _unsubscribe_user_channels(self, user_id: str, websocket: Optional[WebSocket]) -> Set[str]:
+        """Drop a user's socket from every ride channel it joined; returns those channels"""
+        channels = self.user_channels.pop(user_id, set())
+        for ride_id in channels:
+            websockets = self.ride_subscriptions.get(ride_id)
+            if websockets is None:
+                continue
+            websockets.discard(websocket)
+            if not websockets:
+                del self.ride_subscriptions[ride_id]
+        return channels
 
     async def update_driver_location(self, driver_id: str, location: dict):
         """Update driver's location and notify relevant riders"""
-        prev_location = self.driver_locations.get(driver_id)
-        
-        self.driver_locations[driver_id] = {
-            "driver_id": driver_id,
-            "lat": location['lat'],
-            "lng": location['lng'],
-            "heading": location.get('heading', 0),
-            "speed": location.get('speed', 0),
-            "last_updated": datetime.utcnow().isoformat()
-        }
+        await self.update_driver_position(
+            driver_id, location['lat'], location['lng'],
+            location.get('heading', 0), location.get('speed', 0)
+        )
+
+    async def update_driver_position(self, driver_id: str, lat: float, lng: float,
+                                     heading: float = 0, speed: float = 0):
+        """Field-level form of update_driver_location, used by binary telemetry"""
+        was_remote = driver_id in self.remote_drivers
+        self.remote_drivers.discard(driver_id)
+        self.remote_available.discard(driver_id)
         
         # If driver is assigned to a ride, notify the rider
-        for ride_id, websockets in self.ride_subscriptions.items():
-            if ride_id.startswith(f"ride_{driver_id}_"):
-                await self._notify_ride_participants(ride_id, {
-                    'type': 'driver_location_update',
-                    'location': self.driver_locations[driver_id]
-                })
-        
-        # If significant movement (more than 100m), check for new ride matches
-        if prev_location and self._calculate_distance(
-            prev_location['lat'], prev_location['lng'],
-            location['lat'], location['lng']
-        ) > 0.1 and driver_id in self.driver_subscriptions:
-            await self._check_for_ride_matches(driver_id)
-
-        # Broadcast to all clients interested in driver locations
-        await self.broadcast_driver_updates()
-
-    async def _check_for_ride_matches(self, driver_id: str):
-        """Check if driver matches any pending ride requests"""
-        driver_location = self.driver_locations.get(driver_id)
-        if not driver_location:
+        ride_channel = self.driver_active_rides.get(driver_id)
+        await self._apply_driver_position(driver_id, lat, lng, heading, speed)
+        if was_remote:
+            # Moved here from another node: availability is now decided locally
+            self._sync_supply(driver_id)
+        if self.track_store is not None:
+            self.track_store.append(driver_id, lat, lng, heading, speed)
+        trail = self.trails.get(driver_id)
+        if trail is not None:
+            trail.add(lat, lng)
+        if ride_channel is not None:
+            await self._forward_ride_location(driver_id, ride_channel)
+        self._publish_driver_position(driver_id)
+
+    async def _apply_driver_position(self, driver_id: str, lat: float, lng: float,
+                                     heading: float, speed: float):
+        """Store a position (local or replicated) and schedule its broadcast"""
+        prev_position = self.driver_locations.upsert(driver_id, lat, lng, heading, speed)
+        self.location_fragments.pop(driver_id, None)
+        moved_from = self.driver_index.update(driver_id, lat, lng)
+        if prev_position is None or moved_from is not None:
+            # Surge zones only change when the driver appears or crosses a grid cell
+            self._sync_supply(driver_id)
+        self.expiry.schedule(EXPIRE_DRIVER_LOCATION, driver_id, time.monotonic() + DRIVER_LOCATION_TTL_SECONDS)
+
+        # Viewers of the old or new position get it on the next broadcast tick
+        self.broadcast_scheduler.mark_dirty(driver_id, prev_position)
+
+    def _drop_driver_position(self, driver_id: str) -> bool:
+        """Forget a driver's position; map viewers see the removal next tick"""
+        self.expiry.cancel(EXPIRE_DRIVER_LOCATION, driver_id)
+        last_position = self.driver_locations.pop(driver_id)
+        if last_position is None:
+            return False
+        self.location_fragments.pop(driver_id, None)
+        self.driver_index.remove(driver_id)
+        self.surge.driver_unavailable(driver_id)
+        self.broadcast_scheduler.mark_dirty(driver_id, last_position)
+        return True
+
+    def _takes_rides(self, driver_id: str) -> bool:
+        return driver_id in self.driver_subscriptions or driver_id in self.remote_available
+
+    def _is_idle(self, driver_id: str) -> bool:
+        """Taking requests, not driving a ride and not holding an offer"""
+        return (
+            self._takes_rides(driver_id)
+            and driver_id not in self.driver_active_rides
+            and not self.dispatch.is_offered(driver_id)
+        )
+
+    def _sync_supply(self, driver_id: str):
+        """Count the driver as surge supply while they take requests and are not on a ride"""
+        position = self.driver_index.get(driver_id)
+        if position is not None and self._takes_rides(driver_id) and driver_id not in self.driver_active_rides:
+            self.surge.driver_available(driver_id, *position)
+        else:
+            self.surge.driver_unavailable(driver_id)
+
+    def assign_driver_to_ride(self, driver_id: str, ride_channel: str, publish: bool = True):
+        """Forward the driver's location to this ride channel until it is released"""
+        self.driver_active_rides[driver_id] = ride_channel
+        self.ride_forwarded_at.pop(driver_id, None)
+        self._sync_supply(driver_id)
+        if self.track_store is not None:
+            self.track_store.begin_ride(ride_channel, driver_id)
+        print(f"Driver {driver_id} assigned to {ride_channel}")
+        # Accepting a ride fulfils the request the driver was offered
+        rider_id = self.dispatch.fulfil(driver_id)
+        if rider_id is not None:
+            self._remove_ride_request(rider_id)
+        # The driver's socket may live on another node
+        if publish:
+            self._publish({'kind': MSG_ASSIGN, 'driver_id': driver_id, 'channel': ride_channel})
+
+    def release_driver_ride(self, driver_id: str, ride_channel: Optional[str] = None, publish: bool = True):
+        """Stop in-ride forwarding; with a channel, only if it is still the driver's active ride"""
+        if publish:
+            self._publish({'kind': MSG_RELEASE, 'driver_id': driver_id, 'channel': ride_channel})
+        if ride_channel is not None and self.driver_active_rides.get(driver_id) != ride_channel:
             return
-            
-        for rider_id, request in self.rider_requests.items():
-            # Skip if request is older than 5 minutes
-            request_time = datetime.fromisoformat(request['timestamp'])
-            if (datetime.utcnow() - request_time).total_seconds() > 300:
+        ride_channel = self.driver_active_rides.pop(driver_id, None)
+        if ride_channel is not None:
+            self.ride_forwarded_at.pop(driver_id, None)
+            self._sync_supply(driver_id)
+            if self.track_store is not None:
+                self.track_store.end_ride(ride_channel)
+            print(f"Driver {driver_id} released from active ride")
+
+    def _trails_elsewhere(self, driver_id: str) -> bool:
+        """Whether the driver's pings (and so their trail) are handled by another node"""
+        return self.backplane is not None and driver_id not in self.active_connections
+
+    def start_trail(self, driver_id: str, publish: bool = True):
+        """
+        Start measuring the driver's route; called when a ride goes IN_PROGRESS.
+        The trail lives on the node holding the driver's socket.
+        """
+        if self._trails_elsewhere(driver_id):
+            if publish:
+                self._publish({'kind': MSG_TRAIL, 'action': 'start', 'driver_id': driver_id})
+            return
+        trail = TrailProcessor()
+        position = self.driver_locations.position(driver_id)
+        if position is not None:
+            trail.add(*position)
+        self.trails[driver_id] = trail
+
+    def finish_trail(self, driver_id: str, ride_id: str) -> Optional[TrailSummary]:
+        """
+        Distance, duration and simplified route of the ride that just completed.
+        If the trail is on another node, that node stores it on the ride and
+        this returns None.
+        """
+        trail = self.trails.pop(driver_id, None)
+        if trail is not None:
+            return trail.summary()
+        if self._trails_elsewhere(driver_id):
+            self._publish({'kind': MSG_TRAIL, 'action': 'finish', 'driver_id': driver_id, 'ride_id': ride_id})
+        return None
+
+    def discard_trail(self, driver_id: str):
+        if self.trails.pop(driver_id, None) is None and self._trails_elsewhere(driver_id):
+            self._publish({'kind': MSG_TRAIL, 'action': 'discard', 'driver_id': driver_id})
+
+    async def _save_trail(self, ride_id: str, summary: TrailSummary):
+        """Store a trail finished for a completion handled on another node"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(Ride).where(Ride.id == ride_id).values(
+                distance=summary.distance_km,
+                duration=summary.duration_minutes,
+                route_polyline=summary.polyline
+            ))
+            await db.commit()
+
+    async def _forward_ride_location(self, driver_id: str, ride_channel: str):
+        """Send the driver's position to the ride's participants, at most once per interval"""
+        now = time.monotonic()
+        last = self.ride_forwarded_at.get(driver_id)
+        if last is not None and (now - last) * 1000 < RIDE_LOCATION_FORWARD_MS:
+            self.ride_locations_throttled += 1
+            return
+        self.ride_forwarded_at[driver_id] = now
+        self.ride_locations_forwarded += 1
+        await self._notify_ride_participants(ride_channel, {
+            'type': 'driver_location_update',
+            'location': self.driver_locations.snapshot(driver_id)
+        })
+
+    def _build_dispatch_batch(self, rider_ids: List[str]) -> Optional[DispatchBatch]:
+        """
+        Candidate (request, idle driver, pickup km) pairs for a dispatch window,
+        with the coordinates the dispatch engine needs for road ETAs. Routing
+        is left to the engine so that large windows are routed off the event loop.
+        """
+        batch_riders: List[str] = []
+        pickups: List[Tuple[float, float]] = []
+        driver_slots: Dict[str, int] = {}
+        pair_req: List[int] = []
+        pair_drv: List[int] = []
+        pair_km: List[float] = []
+        for rider_id in rider_ids:
+            request = self.rider_requests.get(rider_id)
+            if request is None:
                 continue
-                
-            # Calculate distance to pickup
-            distance = self._calculate_distance(
-                driver_location['lat'], driver_location['lng'],
-                request['pickup_lat'], request['pickup_lng']
-            )
-            
-            # If driver is within 3km, notify them of the ride request
-            if distance <= 3.0:
-                if driver_id in self.active_connections:
-                    try:
-                        await self.active_connections[driver_id].send_json({
-                            'type': 'ride_request',
-                            'request_id': request['request_id'],
-                            'rider_id': rider_id,
-                            'pickup': {
-                                'lat': request['pickup_lat'],
-                                'lng': request['pickup_lng'],
-                                'address': request['pickup_address']
-                            },
-                            'dropoff': {
-                                'lat': request['dropoff_lat'],
-                                'lng': request['dropoff_lng'],
-                                'address': request['dropoff_address']
-                            },
-                            'distance_to_pickup': round(distance, 2),
-                            'estimated_fare': request['estimated_fare']
-                        })
-                    except Exception as e:
-                        print(f"Error sending ride request to driver {driver_id}: {str(e)}")
+            lat, lng = request['pickup_lat'], request['pickup_lng']
+            passed = self.dispatch.passed_by(rider_id)
+            candidates = [
+                driver_id for driver_id in self.driver_index.candidates(lat, lng, DISPATCH_MAX_PICKUP_KM)
+                if driver_id not in passed and self._is_idle(driver_id)
+            ]
+            slots = self.driver_locations.slots_for(candidates)
+            slots = slots[self.driver_locations.fresh_mask(slots, DRIVER_LOCATION_TTL_SECONDS)]
+            matches = self.driver_locations.query_radius(lat, lng, DISPATCH_MAX_PICKUP_KM, slots=slots)
+            if not matches:
+                continue
+            r = len(batch_riders)
+            batch_riders.append(rider_id)
+            pickups.append((lat, lng))
+            for driver_id, distance in matches:
+                pair_req.append(r)
+                pair_drv.append(driver_slots.setdefault(driver_id, len(driver_slots)))
+                pair_km.append(distance)
+        if not pair_req:
+            return None
+        driver_ids = list(driver_slots)
+        return DispatchBatch(
+            batch_riders, driver_ids,
+            np.array(pair_req, dtype=np.int64), np.array(pair_drv, dtype=np.int64),
+            np.array(pair_km, dtype=np.float64), np.array(pickups, dtype=np.float64),
+            np.array([self.driver_locations.position(driver_id) for driver_id in driver_ids], dtype=np.float64)
+        )
+
+    def _offer_dispatched_ride(self, driver_id: str, rider_id: str,
+                               distance_km: float, eta_minutes: float) -> bool:
+        request = self.rider_requests.get(rider_id)
+        if request is None:
+            return False
+        return self._send_ride_offer(driver_id, request, distance_km, eta_minutes)
+
+    def _send_ride_offer(self, driver_id: str, request: dict, distance: float,
+                         eta_minutes: Optional[float] = None) -> bool:
+        """Queue a ride request offer for a driver and remember who saw the request"""
+        sent = self.send_to_user(driver_id, {
+            'type': 'ride_request',
+            'request_id': request['request_id'],
+            'rider_id': request['rider_id'],
+            'pickup': {
+                'lat': request['pickup_lat'],
+                'lng': request['pickup_lng'],
+                'address': request['pickup_address']
+            },
+            'dropoff': {
+                'lat': request['dropoff_lat'],
+                'lng': request['dropoff_lng'],
+                'address': request['dropoff_address']
+            },
+            'distance_to_pickup': round(distance, 2),
+            'eta_minutes': round(eta_minutes, 1) if eta_minutes is not None else None,
+            'estimated_fare': request['estimated_fare']
+        }, priority=PRIORITY_RIDE)
+        if sent:
+            self.request_offers.setdefault(request['rider_id'], set()).add(driver_id)
+        return sent
+
+    def _withdraw_lapsed_offer(self, driver_id: str, rider_id: str):
+        """The driver let an offer time out; take it off their screen before it goes to someone else"""
+        request = self.rider_requests.get(rider_id)
+        offered = self.request_offers.get(rider_id)
+        if offered is not None:
+            offered.discard(driver_id)
+        if request is None:
+            return
+        self.send_to_user(driver_id, {
+            'type': 'ride_request_expired',
+            'rider_id': rider_id,
+            'request_id': request['request_id'],
+            'reason': 'offer_timeout'
+        }, priority=PRIORITY_RIDE)
 
     async def add_ride_request(self, rider_id: str, request_data: dict):
         """Add a new ride request from a rider"""
+        # A new request supersedes the rider's previous one
+        await self.cancel_ride_request(rider_id)
+
         request_id = f"request_{rider_id}_{datetime.utcnow().timestamp()}"
+        # The client's fare estimate is only kept if it agrees with our quote
+        quote = self.fares.quote(
+            request_data['pickup_lat'], request_data['pickup_lng'],
+            request_data['dropoff_lat'], request_data['dropoff_lng']
+        )
         self.rider_requests[rider_id] = {
             'request_id': request_id,
             'rider_id': rider_id,
@@ -132,94 +487,258 @@ class ConnectionManager:
             'dropoff_lat': request_data['dropoff_lat'],
             'dropoff_lng': request_data['dropoff_lng'],
             'dropoff_address': request_data.get('dropoff_address', ''),
-            'estimated_fare': request_data.get('estimated_fare', 0),
+            'estimated_fare': self.fares.checked_fare(request_data.get('estimated_fare'), quote),
+            'surge_multiplier': quote['surge_multiplier'],
             'timestamp': datetime.utcnow().isoformat()
         }
+        self.expiry.schedule(EXPIRE_RIDE_REQUEST, rider_id, time.monotonic() + RIDE_REQUEST_TTL_SECONDS)
+        self.surge.request_opened(rider_id, request_data['pickup_lat'], request_data['pickup_lng'])
+        self._publish({
+            'kind': MSG_DEMAND, 'rider_id': rider_id,
+            'lat': request_data['pickup_lat'], 'lng': request_data['pickup_lng']
+        })
         
-        # Find nearby drivers
-        nearby_drivers = self._get_nearby_drivers(
-            {
-                'lat': request_data['pickup_lat'], 
-                'lng': request_data['pickup_lng']
-            },
-            radius_km=5.0
+        # Only the count is reported back; dispatch does its own candidate search
+        nearby_drivers = self._count_nearby_drivers(
+            request_data['pickup_lat'], request_data['pickup_lng'], radius_km=5.0
         )
         
-        # Notify nearby drivers
-        for driver in nearby_drivers:
-            driver_id = driver['id']
-            if driver_id in self.active_connections and driver_id in self.driver_subscriptions:
-                try:
-                    await self.active_connections[driver_id].send_json({
-                        'type': 'ride_request',
-                        'request_id': request_id,
-                        'rider_id': rider_id,
-                        'pickup': {
-                            'lat': request_data['pickup_lat'],
-                            'lng': request_data['pickup_lng'],
-                            'address': request_data.get('pickup_address', '')
-                        },
-                        'dropoff': {
-                            'lat': request_data['dropoff_lat'],
-                            'lng': request_data['dropoff_lng'],
-                            'address': request_data.get('dropoff_address', '')
-                        },
-                        'distance_to_pickup': round(driver['distance'], 2),
-                        'estimated_fare': request_data.get('estimated_fare', 0)
-                    })
-                except Exception as e:
-                    print(f"Error sending ride request to driver {driver_id}: {str(e)}")
+        # One driver is offered the request in the next dispatch window
+        self.dispatch.submit(rider_id)
         
         return {
             'request_id': request_id,
-            'nearby_drivers': len(nearby_drivers)
+            'nearby_drivers': nearby_drivers,
+            'estimated_fare': self.rider_requests[rider_id]['estimated_fare']
         }
 
     async def subscribe_to_rides(self, driver_id: str):
         """Subscribe driver to receive ride requests"""
         self.driver_subscriptions.add(driver_id)
+        self._sync_supply(driver_id)
         print(f"Driver {driver_id} subscribed to ride requests")
-        
-        # Immediately check for existing ride requests
-        if driver_id in self.driver_locations:
-            await self._check_for_ride_matches(driver_id)
+        self._publish_driver_position(driver_id)
+        # Open requests reach the driver through the next dispatch window
 
     async def cancel_ride_request(self, rider_id: str):
         """Cancel a ride request"""
-        if rider_id in self.rider_requests:
-            del self.rider_requests[rider_id]
+        offered = self.request_offers.get(rider_id, ())
+        if self._remove_ride_request(rider_id) is not None:
             print(f"Rider {rider_id} cancelled request")
             
-            # Notify all drivers that the request is cancelled
-            for driver_id in self.driver_subscriptions:
-                if driver_id in self.active_connections:
-                    try:
-                        await self.active_connections[driver_id].send_json({
-                            'type': 'ride_request_cancelled',
-                            'rider_id': rider_id
-                        })
-                    except Exception as e:
-                        print(f"Error sending cancellation to driver {driver_id}: {str(e)}")
+            # Notify only the drivers who were offered the request
+            self._notify_offered_drivers(offered, {
+                'type': 'ride_request_cancelled',
+                'rider_id': rider_id
+            })
             
             return True
         return False
 
-    async def broadcast_driver_updates(self):
-        """Broadcast driver location updates to all connected clients"""
-        for connection in self.active_connections.values():
-            try:
-                await connection.send_json({
-                    'type': 'driver_locations_update',
-                    'drivers': list(self.driver_locations.values())
-                })
-            except Exception as e:
-                print(f"Error broadcasting driver updates: {str(e)}")
+    def _remove_ride_request(self, rider_id: str) -> Optional[dict]:
+        """Drop a pending request from the table, dispatch queue and expiry schedule"""
+        request = self.rider_requests.pop(rider_id, None)
+        self.request_offers.pop(rider_id, None)
+        if request is not None:
+            self.dispatch.withdraw(rider_id)
+            self.expiry.cancel(EXPIRE_RIDE_REQUEST, rider_id)
+            self.surge.request_closed(rider_id)
+            self._publish({'kind': MSG_DEMAND, 'rider_id': rider_id})
+        return request
+
+    def _on_expire(self, kind: str, key: str):
+        """Evict an entry whose TTL passed and tell the affected users"""
+        if kind == EXPIRE_DRIVER_LOCATION:
+            # The expiry entry is already gone, so only the position is dropped
+            if not self._drop_driver_position(key):
+                return
+            if key in self.remote_drivers:
+                # Its own node notifies the driver; we only drop our replica
+                self.remote_drivers.discard(key)
+                self.remote_available.discard(key)
+                return
+            print(f"Driver {key} location expired")
+            self._publish({'kind': MSG_DRIVER_GONE, 'driver_id': key})
+            self.send_to_user(key, {
+                'type': 'driver_location_expired',
+                'ttl_seconds': DRIVER_LOCATION_TTL_SECONDS
+            }, priority=PRIORITY_RIDE)
+
+        elif kind == EXPIRE_RIDE_REQUEST:
+            offered = self.request_offers.get(key, ())
+            request = self._remove_ride_request(key)
+            if request is None:
+                return
+            print(f"Rider {key} request expired")
+            self.send_to_user(key, {
+                'type': 'ride_request_expired',
+                'request_id': request['request_id']
+            }, priority=PRIORITY_RIDE)
+            self._notify_offered_drivers(offered, {
+                'type': 'ride_request_expired',
+                'rider_id': key,
+                'request_id': request['request_id']
+            })
+
+    def _notify_offered_drivers(self, driver_ids, data: dict):
+        """Tell the drivers who saw a request that it has ended"""
+        if driver_ids:
+            self.request_end_notices += self.broadcast_to_users(driver_ids, data, priority=PRIORITY_RIDE)
+
+    async def subscribe_to_driver_locations(self, user_id: str, viewport: Viewport):
+        """Subscribe a client to driver locations inside a map viewport"""
+        self.viewport_subscriptions.subscribe(user_id, viewport)
+        self.frame_protocol.register(user_id)
+        print(f"User {user_id} subscribed to driver locations")
+
+        # Start the client's frame sequence with a full keyframe
+        await self.resync_driver_locations(user_id)
+
+    def unsubscribe_from_driver_locations(self, user_id: str) -> bool:
+        """Stop sending driver locations to a client"""
+        self.frame_protocol.unregister(user_id)
+        return self.viewport_subscriptions.unsubscribe(user_id)
+
+    def ack_driver_locations(self, user_id: str, seq: int):
+        """Record the last driver location frame a client has applied"""
+        self.frame_protocol.ack(user_id, seq)
+
+    async def resync_driver_locations(self, user_id: str):
+        """Send a keyframe with every driver currently in the client's viewport"""
+        viewport = self.viewport_subscriptions.get(user_id)
+        if viewport is None:
+            return
+        frame = self.frame_protocol.keyframe(user_id, self._drivers_in_viewport(viewport))
+        self.send_encoded(user_id, frame)
+
+    def _drivers_in_viewport(self, viewport: Viewport) -> List[str]:
+        """Encoded location fragments for every driver inside a viewport"""
+        return [
+            self._location_fragment(driver_id)
+            for driver_id in self.driver_index.candidates_in_bounds(
+                viewport.south, viewport.west, viewport.north, viewport.east
+            )
+            if viewport.contains(*self.driver_index.get(driver_id))
+        ]
+
+    async def broadcast_driver_updates(self, changes: Dict[str, Optional[Tuple[float, float]]]) -> int:
+        """
+        Send one frame per subscriber covering every driver that changed
+        during the tick. `changes` maps driver_id to the (lat, lng) the driver
+        had when the tick started. Clients that could see that position but
+        not the current one get the driver in `removed`. Frames are deltas
+        unless the protocol calls for a keyframe.
+        """
+        upserts: Dict[str, Dict[str, str]] = {}
+        removed: Dict[str, List[str]] = {}
+
+        for driver_id, prev_position in changes.items():
+            position = self.driver_locations.position(driver_id)
+            viewers = set()
+            if position:
+                viewers = self.viewport_subscriptions.subscribers_at(*position)
+                if viewers:
+                    # Encoded once, shared by every viewer's frame
+                    fragment = self._location_fragment(driver_id)
+                    for user_id in viewers:
+                        upserts.setdefault(user_id, {})[driver_id] = fragment
+            if prev_position:
+                prev_viewers = self.viewport_subscriptions.subscribers_at(*prev_position)
+                for user_id in prev_viewers - viewers:
+                    removed.setdefault(user_id, []).append(driver_id)
+
+        recipients = set(upserts) | set(removed)
+        for user_id in recipients:
+            if self.frame_protocol.wants_keyframe(user_id):
+                viewport = self.viewport_subscriptions.get(user_id)
+                frame = self.frame_protocol.keyframe(user_id, self._drivers_in_viewport(viewport))
+            else:
+                frame = self.frame_protocol.delta(user_id, upserts.get(user_id, {}), removed.get(user_id, []))
+            self.send_encoded(user_id, frame)
+        return len(recipients)
+
+    def _location_fragment(self, driver_id: str) -> str:
+        fragment = self.location_fragments.get(driver_id)
+        if fragment is None:
+            fragment = encode_json(self.driver_locations.snapshot(driver_id))
+            self.location_fragments[driver_id] = fragment
+        return fragment
+
+    def send_to_user(self, user_id: str, data: dict, priority: int = PRIORITY_MAP) -> bool:
+        """Queue a message for a user's writer task without waiting on the socket"""
+        return self.send_encoded(user_id, EncodedFrame.from_message(data), priority)
+
+    def send_encoded(self, user_id: str, frame: EncodedFrame, priority: int = PRIORITY_MAP) -> bool:
+        """Queue an already-serialized message for a user, wherever they are connected"""
+        queue = self.outbound_queues.get(user_id)
+        if queue is not None:
+            return queue.put(frame, priority)
+        if self.backplane is None or frame.type in (KEYFRAME_TYPE, DELTA_TYPE):
+            # Map frames are per-node sequences; they are never routed
+            return False
+        self._publish({
+            'kind': MSG_USER, 'user_id': user_id,
+            'text': frame.text, 'frame_type': frame.type, 'priority': priority
+        })
+        return True
+
+    def _send_local(self, user_id: str, frame: EncodedFrame, priority: int) -> bool:
+        queue = self.outbound_queues.get(user_id)
+        return queue is not None and queue.put(frame, priority)
+
+    def broadcast_to_users(self, user_ids, data: dict, priority: int = PRIORITY_MAP) -> int:
+        """Serialize a message once and queue the same text for every user"""
+        frame = EncodedFrame.from_message(data)
+        sent = 0
+        for user_id in list(user_ids):
+            if self.send_encoded(user_id, frame, priority):
+                sent += 1
+        return sent
+
+    def _on_outbound_drop(self, user_id: str, frame: EncodedFrame):
+        # A dropped delta is covered by the next one (deltas run from the last ack);
+        # a dropped keyframe leaves the client without the base of later deltas
+        if frame.type == KEYFRAME_TYPE:
+            self.frame_protocol.request_keyframe(user_id)
+
+    def _on_slow_consumer(self, user_id: str):
+        websocket = self.active_connections.get(user_id)
+        self.slow_consumer_disconnects += 1
+        self.disconnect(user_id)
+        if websocket is not None:
+            asyncio.get_running_loop().create_task(self._close_quietly(websocket))
+
+    def _on_send_error(self, user_id: str):
+        """The socket failed under the writer (normally the client left); drop the connection"""
+        self.send_failures += 1
+        queue = self.outbound_queues.get(user_id)
+        if queue is not None and queue.closed:
+            # Still the failed connection, not a reconnect that replaced it
+            self.disconnect(user_id)
+
+    async def close_user(self, user_id: str, code: int = 1000):
+        """Let the writer send what is queued for the user, then close their socket"""
+        websocket = self.active_connections.get(user_id)
+        queue = self.outbound_queues.get(user_id)
+        if queue is not None:
+            await queue.drain()
+        if websocket is not None and self.active_connections.get(user_id) is websocket:
+            self.disconnect(user_id)
+        if websocket is not None:
+            await self._close_quietly(websocket, code)
+
+    async def _close_quietly(self, websocket: WebSocket, code: int = 1013):  # Try again later
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
 
     async def subscribe_to_ride_updates(self, ride_id: str, websocket: WebSocket):
         """Subscribe to updates for a specific ride"""
-        if ride_id not in self.ride_subscriptions:
-            self.ride_subscriptions[ride_id] = []
-        self.ride_subscriptions[ride_id].append(websocket)
+        self.ride_subscriptions.setdefault(ride_id, set()).add(websocket)
+        user_id = self.connection_users.get(websocket)
+        if user_id is not None:
+            self.user_channels.setdefault(user_id, set()).add(ride_id)
         print(f"Client subscribed to ride {ride_id}")
 
     async def broadcast_ride_update(self, ride_id: str, data: dict):
@@ -228,43 +747,135 @@ class ConnectionManager:
 
     async def _notify_ride_participants(self, ride_id: str, data: dict):
         """Send notification to all participants of a ride"""
-        if ride_id in self.ride_subscriptions:
-            for websocket in self.ride_subscriptions[ride_id]:
-                try:
-                    await websocket.send_json(data)
-                except Exception as e:
-                    print(f"Error sending ride update: {str(e)}")
-
-    def _get_nearby_drivers(self, location: dict, radius_km: float = 5.0) -> List[dict]:
-        """Get drivers near a specific location"""
-        nearby_drivers = []
-        for driver_id, driver_location in self.driver_locations.items():
-            # Skip if last update is older than 5 minutes
-            try:
-                last_updated = datetime.fromisoformat(driver_location['last_updated'])
-                if (datetime.utcnow() - last_updated).total_seconds() > 300:
-                    continue
-            except (ValueError, KeyError):
-                continue
-                
-            distance = self._calculate_distance(
-                location['lat'], location['lng'],
-                driver_location['lat'], driver_location['lng']
+        frame = EncodedFrame.from_message(data)
+        self._deliver_to_ride(ride_id, frame)
+        # Participants connected to other nodes
+        self._publish({'kind': MSG_RIDE, 'channel': ride_id, 'text': frame.text, 'frame_type': frame.type})
+
+    def _deliver_to_ride(self, ride_id: str, frame: EncodedFrame):
+        for websocket in self.ride_subscriptions.get(ride_id, ()):
+            user_id = self.connection_users.get(websocket)
+            if user_id is not None:
+                self._send_local(user_id, frame, PRIORITY_RIDE)
+
+    def _publish(self, message: dict, coalesce_key: Optional[str] = None):
+        if self.backplane is not None:
+            self.backplane.publish(message, coalesce_key)
+
+    def _publish_driver_position(self, driver_id: str):
+        """Share a local driver's position and availability with other nodes"""
+        if self.backplane is None:
+            return
+        snapshot = self.driver_locations.snapshot(driver_id)
+        if snapshot is None:
+            return
+        self.backplane.publish({
+            'kind': MSG_LOCATION,
+            'driver_id': driver_id,
+            'lat': snapshot['lat'],
+            'lng': snapshot['lng'],
+            'heading': snapshot['heading'],
+            'speed': snapshot['speed'],
+            'available': driver_id in self.driver_subscriptions
+        }, coalesce_key=f"location:{driver_id}")
+
+    async def _on_backplane_message(self, message: dict):
+        """Apply a message published by another node"""
+        kind = message.get('kind')
+        if kind == MSG_LOCATION:
+            driver_id = message['driver_id']
+            if driver_id in self.active_connections:
+                return  # Connected here now; our own updates win
+            self.remote_drivers.add(driver_id)
+            if message.get('available'):
+                self.remote_available.add(driver_id)
+            else:
+                self.remote_available.discard(driver_id)
+            await self._apply_driver_position(
+                driver_id, message['lat'], message['lng'], message['heading'], message['speed']
             )
-            if distance <= radius_km:
-                nearby_drivers.append({
-                    'id': driver_id,
-                    'lat': driver_location['lat'],
-                    'lng': driver_location['lng'],
-                    'distance': distance,
-                    'last_updated': driver_location['last_updated']
-                })
-        # Sort by distance
-        nearby_drivers.sort(key=lambda d: d['distance'])
-        return nearby_drivers
+            self._sync_supply(driver_id)
+
+        elif kind == MSG_DRIVER_GONE:
+            driver_id = message['driver_id']
+            if driver_id in self.remote_drivers:
+                self.remote_drivers.discard(driver_id)
+                self.remote_available.discard(driver_id)
+                self._drop_driver_position(driver_id)
+                self.dispatch.driver_gone(driver_id)
+
+        elif kind == MSG_USER:
+            frame = EncodedFrame(message['text'], message.get('frame_type'))
+            self._send_local(message['user_id'], frame, message.get('priority', PRIORITY_MAP))
+
+        elif kind == MSG_RIDE:
+            self._deliver_to_ride(message['channel'], EncodedFrame(message['text'], message.get('frame_type')))
+
+        elif kind == MSG_ASSIGN:
+            self.assign_driver_to_ride(message['driver_id'], message['channel'], publish=False)
+
+        elif kind == MSG_RELEASE:
+            self.release_driver_ride(message['driver_id'], message.get('channel'), publish=False)
+
+        elif kind == MSG_DEMAND:
+            # Requests stay on their node; only their surge zone is shared
+            if 'lat' in message:
+                self.surge.request_opened(message['rider_id'], message['lat'], message['lng'])
+            else:
+                self.surge.request_closed(message['rider_id'])
+
+        elif kind == MSG_TRAIL:
+            driver_id = message['driver_id']
+            if message['action'] == 'start':
+                if driver_id in self.active_connections:
+                    self.start_trail(driver_id, publish=False)
+            elif message['action'] == 'finish':
+                trail = self.trails.pop(driver_id, None)
+                if trail is not None:
+                    summary = trail.summary()
+                    if summary.measured:
+                        await self._save_trail(message['ride_id'], summary)
+            else:
+                self.trails.pop(driver_id, None)
+
+    def _count_nearby_drivers(self, lat: float, lng: float, radius_km: float = 5.0) -> int:
+        """Count fresh drivers near a point without building an entry per driver"""
+        candidates = self.driver_index.candidates(lat, lng, radius_km)
+        slots = self.driver_locations.slots_for(candidates)
+        # Skip drivers whose last update is older than 5 minutes
+        slots = slots[self.driver_locations.fresh_mask(slots, DRIVER_LOCATION_TTL_SECONDS)]
+        return self.driver_locations.count_within(lat, lng, radius_km, slots=slots)
+
+    def get_nearest_drivers(self, location: dict, k: int = 5, max_radius_km: float = 10.0) -> List[dict]:
+        """Get up to k drivers closest to a location, for dispatch"""
+        # Stale drivers may occupy some of the k slots, so widen k until filled
+        limit = k
+        while True:
+            matches = self.driver_index.nearest(location['lat'], location['lng'], limit, max_radius_km)
+            nearby_drivers = [
+                self._nearby_driver_entry(driver_id, distance)
+                for driver_id, distance in matches
+                if self.driver_locations.is_fresh(driver_id, DRIVER_LOCATION_TTL_SECONDS)
+            ]
+            if len(nearby_drivers) >= k or len(matches) < limit:
+                return nearby_drivers[:k]
+            limit *= 2
+
+    def _nearby_driver_entry(self, driver_id: str, distance: float) -> dict:
+        lat, lng = self.driver_locations.position(driver_id)
+        return {
+            'id': driver_id,
+            'lat': lat,
+            'lng': lng,
+            'distance': distance,
+            'last_updated': self.driver_locations.last_updated_iso(driver_id)
+        }
 
     def _calculate_distance(self, lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-        """Calculate distance between two points using Haversine formula"""
+        """
+        Calculate distance between two points using Haversine formula.
+        Scalar reference implementation; batch lookups go through distance_engine.
+        """
         R = 6371  # Earth's radius in kilometers
         dlat = math.radians(lat2 - lat1)
         dlon = math.radians(lon2 - lon1)
@@ -277,4 +888,4 @@ class ConnectionManager:
         return R * c
 
 # Initialize connection manager singleton
-manager = ConnectionManager() 
\ No newline at end of file
+manager = ConnectionManager(backplane=create_backplane(), track_store=TrackStore(), router=load_router()) 
\ No newline at end of file
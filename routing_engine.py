@@ -0,0 +1,367 @@
+"""
+Road-network routing for drive-time ETAs.
+
+Graphs are prepared offline and loaded from a compact binary file (path in
+ROUTING_GRAPH). Preparation contracts the graph into a contraction hierarchy:
+nodes are ranked by importance and shortcuts are added so that any shortest
+path goes up the ranking and then down again. Queries then only search the
+"upward" edges from each end and touch a few hundred nodes even on city-wide
+graphs.
+
+Build a graph from a road network exported as two CSV files (for example an
+OSM extract converted with osmium or pyrosm):
+
+    nodes.csv   id,lat,lng
+    edges.csv   source,target,length_m,speed_kmh,oneway
+
+    python routing_engine.py build nodes.csv edges.csv city.rgraph
+
+File layout (little-endian):
+
+    header      magic b"FMRG", version uint32, nodes uint32, up edges uint32, down edges uint32
+    lat, lng    int32[nodes], degrees * 1e7
+    up          first uint32[nodes + 1], target uint32[up], seconds float32[up]
+    down        first uint32[nodes + 1], target uint32[down], seconds float32[down]
+
+`up` holds each node's edges to higher-ranked nodes; `down` holds, for each
+node, the higher-ranked nodes with an edge into it (searched backwards from
+a destination).
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import csv
+import heapq
+import math
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+from geo_index import SpatialGridIndex, haversine_km
+from telemetry_protocol import COORD_SCALE
+
+ROUTING_GRAPH = os.getenv("ROUTING_GRAPH", "")
+# Points farther than this from the nearest road node are not routed
+ROUTING_MAX_SNAP_KM = float(os.getenv("ROUTING_MAX_SNAP_KM", "1.0"))
+# Speed assumed between a point and its nearest road node
+ROUTING_ACCESS_SPEED_KMH = float(os.getenv("ROUTING_ACCESS_SPEED_KMH", "15"))
+# Witness searches stop after settling this many nodes while contracting
+CONTRACT_WITNESS_LIMIT = 500
+
+GRAPH_MAGIC = b"FMRG"
+GRAPH_VERSION = 1
+HEADER = struct.Struct("<4sIIII")
+
+
+def contract_graph(n: int, sources: Sequence[int], targets: Sequence[int],
+                   seconds: Sequence[float]) -> Tuple[List[List[Tuple[int, float]]], List[List[Tuple[int, float]]]]:
+    """
+    Build a contraction hierarchy over a directed graph with n nodes.
+    Returns (up, down) adjacency lists as described in the module docstring.
+    """
+    out: List[Dict[int, float]] = [{} for _ in range(n)]
+    inc: List[Dict[int, float]] = [{} for _ in range(n)]
+    for u, w, c in zip(sources, targets, seconds):
+        if u != w and c < out[u].get(w, math.inf):
+            out[u][w] = c
+            inc[w][u] = c
+
+    def witness_distances(source: int, skip: int, limit: float) -> Dict[int, float]:
+        """Distances from source avoiding `skip`, searched up to `limit`"""
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        while heap:
+            d, x = heapq.heappop(heap)
+            if d > dist[x]:
+                continue
+            if d > limit or settled >= CONTRACT_WITNESS_LIMIT:
+                break
+            settled += 1
+            for y, c in out[x].items():
+                if y == skip:
+                    continue
+                nd = d + c
+                if nd < dist.get(y, math.inf):
+                    dist[y] = nd
+                    heapq.heappush(heap, (nd, y))
+        return dist
+
+    def shortcuts_for(v: int) -> List[Tuple[int, int, float]]:
+        needed = []
+        if not inc[v] or not out[v]:
+            return needed
+        max_out = max(out[v].values())
+        for u, cu in inc[v].items():
+            dist = witness_distances(u, v, cu + max_out)
+            for w, cw in out[v].items():
+                if w != u and dist.get(w, math.inf) > cu + cw:
+                    needed.append((u, w, cu + cw))
+        return needed
+
+    contracted_neighbours = [0] * n
+
+    def priority(v: int) -> int:
+        # Edge difference, plus a term that spreads contraction evenly over the graph
+        return len(shortcuts_for(v)) - len(inc[v]) - len(out[v]) + contracted_neighbours[v]
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+    done = [False] * n
+    up: List[List[Tuple[int, float]]] = [[] for _ in range(n)]
+    down: List[List[Tuple[int, float]]] = [[] for _ in range(n)]
+    while heap:
+        _prio, v = heapq.heappop(heap)
+        if done[v]:
+            continue
+        # Lazy update: re-rank v if it got worse since it was queued
+        current = priority(v)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, v))
+            continue
+
+        for u, w, c in shortcuts_for(v):
+            if c < out[u].get(w, math.inf):
+                out[u][w] = c
+                inc[w][u] = c
+        # Every remaining neighbour ranks above v
+        up[v] = list(out[v].items())
+        down[v] = list(inc[v].items())
+        for w in out[v]:
+            del inc[w][v]
+            contracted_neighbours[w] += 1
+        for u in inc[v]:
+            del out[u][v]
+            contracted_neighbours[u] += 1
+        out[v], inc[v] = {}, {}
+        done[v] = True
+    return up, down
+
+
+def _csr(adjacency: List[List[Tuple[int, float]]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    first = np.zeros(len(adjacency) + 1, dtype="<u4")
+    first[1:] = np.cumsum([len(edges) for edges in adjacency])
+    target = np.array([w for edges in adjacency for w, _ in edges], dtype="<u4")
+    seconds = np.array([c for edges in adjacency for _, c in edges], dtype="<f4")
+    return first, target, seconds
+
+
+def save_graph(path: str, lat: np.ndarray, lng: np.ndarray,
+               up: List[List[Tuple[int, float]]], down: List[List[Tuple[int, float]]]):
+    up_first, up_target, up_seconds = _csr(up)
+    down_first, down_target, down_seconds = _csr(down)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(lat), len(up_target), len(down_target)))
+        for array in (
+            np.round(np.asarray(lat) * COORD_SCALE).astype("<i4"),
+            np.round(np.asarray(lng) * COORD_SCALE).astype("<i4"),
+            up_first, up_target, up_seconds,
+            down_first, down_target, down_seconds
+        ):
+            f.write(array.tobytes())
+
+
+def build_graph(lat: np.ndarray, lng: np.ndarray, sources: Sequence[int], targets: Sequence[int],
+                seconds: Sequence[float], path: str):
+    """Contract a directed road graph (dense node ids) and write it to `path`"""
+    up, down = contract_graph(len(lat), sources, targets, seconds)
+    save_graph(path, lat, lng, up, down)
+
+
+def build_from_csv(nodes_path: str, edges_path: str, path: str):
+    """Read the nodes/edges CSV export described in the module docstring and build a graph file"""
+    dense: Dict[str, int] = {}
+    lat: List[float] = []
+    lng: List[float] = []
+    with open(nodes_path, newline="") as f:
+        for row in csv.DictReader(f):
+            dense[row["id"]] = len(lat)
+            lat.append(float(row["lat"]))
+            lng.append(float(row["lng"]))
+
+    sources: List[int] = []
+    targets: List[int] = []
+    seconds: List[float] = []
+    with open(edges_path, newline="") as f:
+        for row in csv.DictReader(f):
+            u, w = dense[row["source"]], dense[row["target"]]
+            length_km = (
+                float(row["length_m"]) / 1000 if row.get("length_m")
+                else haversine_km(lat[u], lng[u], lat[w], lng[w])
+            )
+            travel = length_km / max(float(row["speed_kmh"]), 1.0) * 3600
+            sources.append(u)
+            targets.append(w)
+            seconds.append(travel)
+            if row.get("oneway", "0") not in ("1", "true", "yes"):
+                sources.append(w)
+                targets.append(u)
+                seconds.append(travel)
+
+    build_graph(np.array(lat), np.array(lng), sources, targets, seconds, path)
+
+
+class RoadRouter:
+    """
+    Answers drive-time queries on a contracted road graph. Coordinates are
+    snapped to the nearest road node; the stretch between the point and the
+    node is added at ROUTING_ACCESS_SPEED_KMH. Queries return seconds, or
+    None when a point is off the map or the destination is unreachable.
+    """
+
+    def __init__(self, lat: np.ndarray, lng: np.ndarray,
+                 up: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                 down: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                 max_snap_km: float = ROUTING_MAX_SNAP_KM,
+                 access_speed_kmh: float = ROUTING_ACCESS_SPEED_KMH):
+        self.node_count = len(lat)
+        self.max_snap_km = max_snap_km
+        self.access_speed_kmh = access_speed_kmh
+        # Plain lists: the searches index them one element at a time
+        self.up_first, self.up_target, self.up_seconds = (a.tolist() for a in up)
+        self.down_first, self.down_target, self.down_seconds = (a.tolist() for a in down)
+        self.nodes = SpatialGridIndex(cell_size_km=0.25)
+        for node, (a, b) in enumerate(zip(lat.tolist(), lng.tolist())):
+            self.nodes.update(str(node), a, b)
+
+        self.queries = 0
+        self.unroutable = 0
+        self.total_query_ms = 0.0
+        self.max_query_ms = 0.0
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "RoadRouter":
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, nodes, up_edges, down_edges = HEADER.unpack_from(data)
+        if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+            raise ValueError(f"{path} is not a version {GRAPH_VERSION} road graph")
+        offset = HEADER.size
+
+        def take(dtype: str, count: int) -> np.ndarray:
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        lat = take("<i4", nodes) / COORD_SCALE
+        lng = take("<i4", nodes) / COORD_SCALE
+        up = (take("<u4", nodes + 1), take("<u4", up_edges), take("<f4", up_edges))
+        down = (take("<u4", nodes + 1), take("<u4", down_edges), take("<f4", down_edges))
+        return cls(lat, lng, up, down, **kwargs)
+
+    def snap(self, lat: float, lng: float) -> Optional[Tuple[int, float]]:
+        """Nearest road node and the access time to it in seconds"""
+        nearest = self.nodes.nearest(lat, lng, 1, max_radius_km=self.max_snap_km)
+        if not nearest:
+            return None
+        node, distance_km = nearest[0]
+        return int(node), distance_km / self.access_speed_kmh * 3600
+
+    def _search(self, start: int, first: List[int], target: List[int], seconds: List[float],
+                bound: float = math.inf, meet: Optional[Dict[int, float]] = None) -> Tuple[Dict[int, float], float]:
+        """
+        Upward Dijkstra from `start`. With `meet` (the other side's search
+        space) it also tracks the best meeting cost and prunes beyond it.
+        """
+        dist = {start: 0.0}
+        heap = [(0.0, start)]
+        best = bound
+        while heap:
+            d, x = heapq.heappop(heap)
+            if d >= best:
+                break
+            if d > dist[x]:
+                continue
+            if meet is not None and x in meet and d + meet[x] < best:
+                best = d + meet[x]
+            for k in range(first[x], first[x + 1]):
+                y = target[k]
+                nd = d + seconds[k]
+                if nd < dist.get(y, math.inf):
+                    dist[y] = nd
+                    heapq.heappush(heap, (nd, y))
+        return dist, best
+
+    def _backward_space(self, node: int) -> Dict[int, float]:
+        return self._search(node, self.down_first, self.down_target, self.down_seconds)[0]
+
+    def _forward_to(self, node: int, backward: Dict[int, float]) -> float:
+        return self._search(node, self.up_first, self.up_target, self.up_seconds, meet=backward)[1]
+
+    def node_seconds(self, source: int, target: int) -> float:
+        """Drive time between two road nodes (inf if unreachable)"""
+        if source == target:
+            return 0.0
+        return self._forward_to(source, self._backward_space(target))
+
+    def _record(self, started: float, results: List[Optional[float]]):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.queries += 1
+        self.unroutable += sum(1 for r in results if r is None)
+        self.total_query_ms += elapsed_ms
+        self.max_query_ms = max(self.max_query_ms, elapsed_ms)
+
+    def route_seconds(self, from_lat: float, from_lng: float,
+                      to_lat: float, to_lng: float) -> Optional[float]:
+        """Point-to-point drive time in seconds"""
+        return self.seconds_to(to_lat, to_lng, [(from_lat, from_lng)])[0]
+
+    def seconds_to(self, lat: float, lng: float,
+                   origins: Sequence[Tuple[float, float]]) -> List[Optional[float]]:
+        """
+        Drive time from each origin to one destination (drivers to a pickup).
+        The destination's backward search is done once and shared by every
+        origin's forward search.
+        """
+        started = time.perf_counter()
+        results: List[Optional[float]] = [None] * len(origins)
+        destination = self.snap(lat, lng)
+        if destination is not None:
+            target, target_access = destination
+            backward = self._backward_space(target)
+            for i, (o_lat, o_lng) in enumerate(origins):
+                origin = self.snap(o_lat, o_lng)
+                if origin is None:
+                    continue
+                source, source_access = origin
+                seconds = 0.0 if source == target else self._forward_to(source, backward)
+                if seconds < math.inf:
+                    results[i] = source_access + seconds + target_access
+        self._record(started, results)
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'nodes': self.node_count,
+            'up_edges': len(self.up_target),
+            'down_edges': len(self.down_target),
+            'queries': self.queries,
+            'unroutable': self.unroutable,
+            'avg_query_ms': round(self.total_query_ms / self.queries, 3) if self.queries else 0.0,
+            'max_query_ms': round(self.max_query_ms, 3)
+        }
+
+
+def load_router(path: str = ROUTING_GRAPH) -> Optional[RoadRouter]:
+    """Load the graph named by ROUTING_GRAPH; None (straight-line ETAs) if unset or unreadable"""
+    if not path:
+        return None
+    try:
+        started = time.perf_counter()
+        router = RoadRouter.load(path)
+        print(f"Road graph loaded from {path}: {router.node_count} nodes "
+              f"in {time.perf_counter() - started:.1f}s")
+        return router
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Road graph {path} not loaded, using straight-line ETAs: {str(e)}")
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] != "build":
+        print("Usage: python routing_engine.py build nodes.csv edges.csv output.rgraph")
+        sys.exit(1)
+    started = time.perf_counter()
+    build_from_csv(sys.argv[2], sys.argv[3], sys.argv[4])
+    print(f"Wrote {sys.argv[4]} in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,145 @@
+from typing import Dict, List, Optional, Tuple
+import math
+import os
+import time
+
+from geo_index import KM_PER_DEGREE_LAT
+
+# Side of a pricing zone in km
+SURGE_ZONE_KM = float(os.getenv("SURGE_ZONE_KM", "2.0"))
+# Time constant of the demand/supply smoothing; a step change is ~63% through after this long
+SURGE_SMOOTHING_SECONDS = float(os.getenv("SURGE_SMOOTHING_SECONDS", "120"))
+# (smoothed open requests per idle driver, multiplier), highest first; same steps as the fare calculator
+SURGE_STEPS: List[Tuple[float, float]] = [(0.8, 1.5), (0.6, 1.3), (0.4, 1.2)]
+
+Zone = Tuple[int, int]
+
+
+def multiplier_for(ratio: float) -> float:
+    for threshold, multiplier in SURGE_STEPS:
+        if ratio > threshold:
+            return multiplier
+    return 1.0
+
+
+class ZoneState:
+    __slots__ = ("demand", "supply", "smoothed", "updated_at")
+
+    def __init__(self, now: float):
+        self.demand = 0
+        self.supply = 0
+        self.smoothed = 0.0
+        self.updated_at = now
+
+    @property
+    def ratio(self) -> float:
+        return self.demand / max(self.supply, 1)
+
+
+class SurgeEngine:
+    """
+    Per-zone counts of open ride requests (demand) and idle drivers taking
+    requests (supply), kept up to date from the events that change them:
+    each request or driver remembers its zone, so opening, closing or moving
+    one adjusts two counters and nothing is ever rescanned.
+
+    The demand/supply ratio is smoothed with a continuous-time exponential
+    moving average, advanced whenever a zone's counts change or it is read,
+    so a burst of requests raises prices gradually rather than instantly.
+    """
+
+    def __init__(self, zone_km: float = SURGE_ZONE_KM, smoothing_seconds: float = SURGE_SMOOTHING_SECONDS):
+        self.zone_km = zone_km
+        self.zone_deg = zone_km / KM_PER_DEGREE_LAT
+        self.smoothing_seconds = smoothing_seconds
+        self.zones: Dict[Zone, ZoneState] = {}
+        self.request_zones: Dict[str, Zone] = {}  # Rider -> zone of their open request's pickup
+        self.driver_zones: Dict[str, Zone] = {}  # Idle driver -> zone they are in
+        self.zone_moves = 0
+
+    def zone_for(self, lat: float, lng: float) -> Zone:
+        return int(math.floor(lat / self.zone_deg)), int(math.floor(lng / self.zone_deg))
+
+    def _advance(self, zone: Zone, now: float) -> ZoneState:
+        """Bring a zone's smoothed ratio up to `now` using the ratio that held since its last change"""
+        state = self.zones.get(zone)
+        if state is None:
+            state = self.zones[zone] = ZoneState(now)
+            return state
+        elapsed = now - state.updated_at
+        if elapsed > 0:
+            alpha = 1 - math.exp(-elapsed / self.smoothing_seconds) if self.smoothing_seconds > 0 else 1.0
+            state.smoothed += alpha * (state.ratio - state.smoothed)
+            state.updated_at = now
+        return state
+
+    def _adjust(self, zone: Zone, demand: int = 0, supply: int = 0):
+        state = self._advance(zone, time.monotonic())
+        state.demand += demand
+        state.supply += supply
+        if not state.demand and not state.supply and state.smoothed < 0.01:
+            del self.zones[zone]
+
+    def _move(self, members: Dict[str, Zone], key: str, zone: Optional[Zone], demand: int, supply: int):
+        previous = members.get(key)
+        if previous == zone:
+            return
+        if previous is not None:
+            self._adjust(previous, -demand, -supply)
+            del members[key]
+        if zone is not None:
+            self._adjust(zone, demand, supply)
+            members[key] = zone
+        if previous is not None and zone is not None:
+            self.zone_moves += 1
+
+    # Demand
+
+    def request_opened(self, rider_id: str, lat: float, lng: float):
+        self._move(self.request_zones, rider_id, self.zone_for(lat, lng), 1, 0)
+
+    def request_closed(self, rider_id: str):
+        self._move(self.request_zones, rider_id, None, 1, 0)
+
+    # Supply
+
+    def driver_available(self, driver_id: str, lat: float, lng: float):
+        """Count an idle driver in the zone at (lat, lng), moving them if they were elsewhere"""
+        self._move(self.driver_zones, driver_id, self.zone_for(lat, lng), 0, 1)
+
+    def driver_unavailable(self, driver_id: str):
+        self._move(self.driver_zones, driver_id, None, 0, 1)
+
+    # Reads
+
+    def zone_snapshot(self, zone: Zone) -> dict:
+        state = self._advance(zone, time.monotonic()) if zone in self.zones else None
+        smoothed = state.smoothed if state is not None else 0.0
+        return {
+            'zone': f"{zone[0]}:{zone[1]}",
+            'open_requests': state.demand if state is not None else 0,
+            'idle_drivers': state.supply if state is not None else 0,
+            'demand_ratio': round(smoothed, 3),
+            'multiplier': multiplier_for(smoothed)
+        }
+
+    def quote(self, lat: float, lng: float) -> dict:
+        """Current surge for the zone containing a point"""
+        return self.zone_snapshot(self.zone_for(lat, lng))
+
+    def multiplier(self, lat: float, lng: float) -> float:
+        return self.quote(lat, lng)['multiplier']
+
+    def surging_zones(self) -> List[dict]:
+        snapshots = [self.zone_snapshot(zone) for zone in list(self.zones)]
+        return [snapshot for snapshot in snapshots if snapshot['multiplier'] > 1.0]
+
+    def stats(self) -> dict:
+        return {
+            'zone_km': self.zone_km,
+            'smoothing_seconds': self.smoothing_seconds,
+            'zones': len(self.zones),
+            'open_requests': len(self.request_zones),
+            'idle_drivers': len(self.driver_zones),
+            'zone_moves': self.zone_moves
+        }
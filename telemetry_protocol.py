@@ -0,0 +1,77 @@
+"""
+Compact binary frames for high-frequency driver telemetry.
+
+A connection opts in by sending the JSON message
+    {"type": "negotiate_protocol", "telemetry": "binary-v1"}
+after which the driver may send binary WebSocket frames holding one or more
+fixed-width little-endian records:
+
+    offset  size  field
+    0       1     version (1)
+    1       1     flags (reserved, 0)
+    2       4     latitude  int32, degrees * 1e7
+    6       4     longitude int32, degrees * 1e7
+    10      2     heading   uint16, degrees * 100 (0-35999)
+    12      2     speed     uint16, km/h * 100
+    14      8     timestamp uint64, milliseconds since the Unix epoch
+
+Records are read straight out of the frame with struct.iter_unpack over a
+memoryview, so decoding allocates no per-record dicts.
+"""
+from typing import List, Tuple
+import struct
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY_V1 = "binary-v1"
+SUPPORTED_TELEMETRY_PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_BINARY_V1)
+
+RECORD_VERSION = 1
+RECORD = struct.Struct("<BBiiHHQ")
+RECORD_SIZE = RECORD.size  # 22 bytes
+
+COORD_SCALE = 10_000_000
+HEADING_SCALE = 100
+SPEED_SCALE = 100
+MAX_RECORDS_PER_FRAME = 64
+
+
+class TelemetryDecodeError(ValueError):
+    """Raised for binary telemetry frames that cannot be decoded"""
+
+
+def encode_record(lat: float, lng: float, heading: float = 0.0, speed: float = 0.0,
+                  timestamp_ms: int = 0) -> bytes:
+    """Pack one telemetry record (used by clients, tools and tests)"""
+    return RECORD.pack(
+        RECORD_VERSION, 0,
+        int(round(lat * COORD_SCALE)),
+        int(round(lng * COORD_SCALE)),
+        int(round((heading % 360) * HEADING_SCALE)) % (360 * HEADING_SCALE),
+        min(int(round(max(speed, 0.0) * SPEED_SCALE)), 0xFFFF),
+        int(timestamp_ms)
+    )
+
+
+def decode_records(frame) -> List[Tuple[float, float, float, float, int]]:
+    """
+    Return (lat, lng, heading, speed, timestamp_ms) for every record in a
+    binary frame. The whole frame is checked before anything is returned, so
+    a frame with one bad record raises TelemetryDecodeError and none of its
+    records are applied.
+    """
+    view = memoryview(frame)
+    if len(view) == 0 or len(view) % RECORD_SIZE:
+        raise TelemetryDecodeError(f"Frame length {len(view)} is not a multiple of {RECORD_SIZE}")
+    if len(view) // RECORD_SIZE > MAX_RECORDS_PER_FRAME:
+        raise TelemetryDecodeError(f"Frame carries more than {MAX_RECORDS_PER_FRAME} records")
+
+    records = []
+    for version, _flags, lat_e7, lng_e7, heading, speed, timestamp_ms in RECORD.iter_unpack(view):
+        if version != RECORD_VERSION:
+            raise TelemetryDecodeError(f"Unsupported record version {version}")
+        lat = lat_e7 / COORD_SCALE
+        lng = lng_e7 / COORD_SCALE
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+            raise TelemetryDecodeError("Coordinates out of range")
+        records.append((lat, lng, heading / HEADING_SCALE, speed / SPEED_SCALE, timestamp_ms))
+    return records
@@ -0,0 +1,317 @@
+"""
+Append-only store of driver GPS history.
+
+Every location update is appended as a fixed-width little-endian record to
+the current segment file under TRACK_STORE_DIR:
+
+    offset  size  field
+    0       4     driver slot   uint32 (line number in drivers.txt)
+    4       8     timestamp     int64, milliseconds since the Unix epoch
+    12      4     latitude      int32, degrees * 1e7
+    16      4     longitude     int32, degrees * 1e7
+    20      2     speed         uint16, km/h * 100
+    22      2     heading       uint16, degrees * 100
+
+Segments roll over at TRACK_SEGMENT_BYTES. rides.idx records, per ride, the
+driver slot and the (segment, offset) positions where the ride started and
+ended, so a replay only scans that stretch. Reads mmap the segments and view
+them as numpy record arrays; filtering happens on whole chunks, never point
+by point.
+
+The directory belongs to one process, enforced with an exclusive lock on
+its LOCK file: a second process pointed at the same directory records
+nothing and says so on first use. With several workers give each its own
+TRACK_STORE_DIR; a ride's track can then only be read from the worker that
+recorded it.
+"""
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, so one worker per directory is on trust
+    fcntl = None
+
+from telemetry_protocol import COORD_SCALE, HEADING_SCALE, SPEED_SCALE
+
+TRACK_STORE_DIR = os.getenv("TRACK_STORE_DIR", "./tracks")
+TRACK_SEGMENT_BYTES = int(os.getenv("TRACK_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+
+RECORD = struct.Struct("<IqiiHH")
+RECORD_SIZE = RECORD.size  # 24 bytes
+RECORD_DTYPE = np.dtype([
+    ("driver", "<u4"),
+    ("ts_ms", "<i8"),
+    ("lat", "<i4"),
+    ("lng", "<i4"),
+    ("speed", "<u2"),
+    ("heading", "<u2")
+])
+
+# Records per numpy chunk handed to readers
+READ_CHUNK_RECORDS = 65536
+
+Position = Tuple[int, int]  # (segment number, byte offset)
+
+
+class RideSpan:
+    __slots__ = ("driver_slot", "start", "end")
+
+    def __init__(self, driver_slot: int, start: Position, end: Optional[Position] = None):
+        self.driver_slot = driver_slot
+        self.start = start
+        self.end = end
+
+
+class TrackStore:
+    def __init__(self, directory: str = TRACK_STORE_DIR, segment_bytes: int = TRACK_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes - segment_bytes % RECORD_SIZE
+        self.driver_slots: Dict[str, int] = {}
+        self.rides: Dict[str, RideSpan] = {}
+        self.segment_no = 0
+        self.segment_size = 0
+        self._segment = None
+        self._drivers_file = None
+        self._rides_file = None
+        self._lock_file = None
+        self.disabled = False  # Another process holds the directory
+
+        self.records_appended = 0
+
+    # Files
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _segment_path(self, segment_no: int) -> str:
+        return self._path(f"segment-{segment_no:08d}.trk")
+
+    def _lock(self) -> bool:
+        """Take the directory for this process; False if another process has it"""
+        self._lock_file = open(self._path("LOCK"), "a")
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        return True
+
+    def _open(self) -> bool:
+        """Load the indexes and reopen the newest segment on first use; False if disabled"""
+        if self._segment is not None:
+            return True
+        if self.disabled:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        if not self._lock():
+            self.disabled = True
+            print(f"Track store {self.directory} is locked by another process; not recording tracks "
+                  f"in this one (give each worker its own TRACK_STORE_DIR)")
+            return False
+
+        if os.path.exists(self._path("drivers.txt")):
+            with open(self._path("drivers.txt")) as f:
+                for slot, line in enumerate(f):
+                    self.driver_slots[line.rstrip("\n")] = slot
+        if os.path.exists(self._path("rides.idx")):
+            with open(self._path("rides.idx")) as f:
+                for line in f:
+                    self._apply_ride_event(json.loads(line))
+
+        segments = sorted(
+            int(name[len("segment-"):-len(".trk")])
+            for name in os.listdir(self.directory)
+            if name.startswith("segment-") and name.endswith(".trk")
+        )
+        self.segment_no = segments[-1] if segments else 0
+        path = self._segment_path(self.segment_no)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size % RECORD_SIZE:
+            # Drop a record torn by a crash mid-write
+            size -= size % RECORD_SIZE
+            os.truncate(path, size)
+        self.segment_size = size
+        self._segment = open(path, "ab", buffering=1024 * 1024)
+        self._drivers_file = open(self._path("drivers.txt"), "a")
+        self._rides_file = open(self._path("rides.idx"), "a")
+        return True
+
+    def _roll_segment(self):
+        self._segment.close()
+        self.segment_no += 1
+        self.segment_size = 0
+        self._segment = open(self._segment_path(self.segment_no), "ab", buffering=1024 * 1024)
+
+    def flush(self):
+        """Push buffered records to the OS so readers see them"""
+        if self._segment is not None:
+            self._segment.flush()
+            self._drivers_file.flush()
+            self._rides_file.flush()
+
+    def close(self):
+        if self._segment is not None:
+            self.flush()
+            self._segment.close()
+            self._drivers_file.close()
+            self._rides_file.close()
+            self._segment = None
+        if self._lock_file is not None:
+            self._lock_file.close()  # Releases the lock
+            self._lock_file = None
+
+    # Writes
+
+    def driver_slot(self, driver_id: str) -> int:
+        self._open()
+        slot = self.driver_slots.get(driver_id)
+        if slot is None:
+            slot = len(self.driver_slots)
+            self.driver_slots[driver_id] = slot
+            self._drivers_file.write(driver_id + "\n")
+        return slot
+
+    def position(self) -> Position:
+        self._open()
+        return self.segment_no, self.segment_size
+
+    def append(self, driver_id: str, lat: float, lng: float, heading: float = 0.0,
+               speed: float = 0.0, timestamp_ms: Optional[int] = None):
+        if not self._open():
+            return
+        slot = self.driver_slot(driver_id)
+        if self.segment_size + RECORD_SIZE > self.segment_bytes:
+            self._roll_segment()
+        self._segment.write(RECORD.pack(
+            slot,
+            int(time.time() * 1000) if timestamp_ms is None else int(timestamp_ms),
+            int(round(lat * COORD_SCALE)),
+            int(round(lng * COORD_SCALE)),
+            min(int(round(max(speed, 0.0) * SPEED_SCALE)), 0xFFFF),
+            int(round((heading % 360) * HEADING_SCALE)) % (360 * HEADING_SCALE)
+        ))
+        self.segment_size += RECORD_SIZE
+        self.records_appended += 1
+
+    def _apply_ride_event(self, event: dict):
+        if event["event"] == "begin":
+            self.rides[event["ride_id"]] = RideSpan(event["driver_slot"], tuple(event["position"]))
+        elif event["event"] == "end":
+            span = self.rides.get(event["ride_id"])
+            if span is not None:
+                span.end = tuple(event["position"])
+
+    def _log_ride_event(self, event: dict):
+        self._rides_file.write(json.dumps(event) + "\n")
+        self._apply_ride_event(event)
+
+    def begin_ride(self, ride_id: str, driver_id: str):
+        """Mark where a ride's track starts; a ride already in progress keeps its start"""
+        if not self._open():
+            return
+        span = self.rides.get(ride_id)
+        if span is not None and span.end is None:
+            return
+        self._log_ride_event({
+            "event": "begin", "ride_id": ride_id,
+            "driver_slot": self.driver_slot(driver_id), "position": self.position()
+        })
+
+    def end_ride(self, ride_id: str):
+        if not self._open():
+            return
+        span = self.rides.get(ride_id)
+        if span is not None and span.end is None:
+            self._log_ride_event({"event": "end", "ride_id": ride_id, "position": self.position()})
+
+    # Reads
+
+    def _scan(self, start: Position, end: Optional[Position],
+              select: Callable[[np.ndarray], np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Apply `select` to chunked views of [start, end) across segments and
+        yield the non-empty results. `select` must return a copy (a boolean
+        index does), since the views die with the mapping.
+        """
+        self.flush()
+        end = end or self.position()
+        for segment_no in range(start[0], end[0] + 1):
+            path = self._segment_path(segment_no)
+            if not os.path.exists(path):
+                continue
+            first = start[1] if segment_no == start[0] else 0
+            last = end[1] if segment_no == end[0] else os.path.getsize(path)
+            last -= last % RECORD_SIZE
+            if last <= first:
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(first, last, READ_CHUNK_RECORDS * RECORD_SIZE):
+                    count = min(READ_CHUNK_RECORDS, (last - offset) // RECORD_SIZE)
+                    view = np.frombuffer(mm, dtype=RECORD_DTYPE, count=count, offset=offset)
+                    points = select(view)
+                    del view
+                    if len(points):
+                        yield points
+
+    def has_ride(self, ride_id: str) -> bool:
+        return self._open() and ride_id in self.rides
+
+    def iter_ride(self, ride_id: str) -> Iterator[np.ndarray]:
+        """Chunks of the ride driver's records between the ride's start and end"""
+        if not self._open():
+            return
+        span = self.rides.get(ride_id)
+        if span is None:
+            return
+        yield from self._scan(span.start, span.end, lambda view: view[view["driver"] == span.driver_slot])
+
+    def iter_driver(self, driver_id: str, since_ms: int = 0,
+                    until_ms: Optional[int] = None) -> Iterator[np.ndarray]:
+        """Chunks of a driver's records in a time range (audit queries)"""
+        if not self._open():
+            return
+        slot = self.driver_slots.get(driver_id)
+        if slot is None:
+            return
+        until_ms = until_ms if until_ms is not None else 2 ** 62
+
+        def select(view: np.ndarray) -> np.ndarray:
+            # Records are appended in time order, so whole chunks can be skipped
+            if view["ts_ms"][-1] < since_ms or view["ts_ms"][0] > until_ms:
+                return view[:0].copy()
+            ts = view["ts_ms"]
+            return view[(view["driver"] == slot) & (ts >= since_ms) & (ts <= until_ms)]
+
+        yield from self._scan((0, 0), None, select)
+
+    def stats(self) -> dict:
+        return {
+            'directory': self.directory,
+            'disabled': self.disabled,
+            'segment': self.segment_no,
+            'segment_bytes': self.segment_size,
+            'drivers': len(self.driver_slots),
+            'rides_indexed': len(self.rides),
+            'records_appended': self.records_appended
+        }
+
+
+def points_to_dicts(points: np.ndarray) -> List[dict]:
+    """Decode a chunk of records into the JSON shape served by the track API"""
+    lat = points["lat"] / COORD_SCALE
+    lng = points["lng"] / COORD_SCALE
+    speed = points["speed"] / SPEED_SCALE
+    heading = points["heading"] / HEADING_SCALE
+    return [
+        {"t": int(t), "lat": float(a), "lng": float(b), "speed": float(s), "heading": float(h)}
+        for t, a, b, s, h in zip(points["ts_ms"], lat, lng, speed, heading)
+    ]
@@ -0,0 +1,205 @@
+from typing import List, Optional, Tuple
+import heapq
+import math
+import os
+import time
+
+from geo_index import haversine_km, KM_PER_DEGREE_LAT
+
+# Most points kept per simplified trail; the least significant point is dropped beyond this
+TRAIL_MAX_POINTS = int(os.getenv("TRAIL_MAX_POINTS", "500"))
+# Moves shorter than this are treated as GPS jitter and not added to the distance
+TRAIL_MIN_STEP_METERS = float(os.getenv("TRAIL_MIN_STEP_METERS", "5"))
+# Points whose triangle with their neighbours is smaller than this (m^2) add no shape and are dropped
+TRAIL_MIN_AREA_M2 = float(os.getenv("TRAIL_MIN_AREA_M2", "25"))
+
+
+def encode_polyline(points: List[Tuple[float, float]], precision: int = 5) -> str:
+    """Encode (lat, lng) points with Google's encoded polyline algorithm"""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        ilat = int(round(lat * factor))
+        ilng = int(round(lng * factor))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(out)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Tuple[float, float]]:
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+class TrailSummary:
+    __slots__ = ("distance_km", "duration_minutes", "polyline", "points")
+
+    def __init__(self, distance_km: float, duration_minutes: int, polyline: str, points: int):
+        self.distance_km = distance_km
+        self.duration_minutes = duration_minutes
+        self.polyline = polyline
+        self.points = points
+
+    @property
+    def measured(self) -> bool:
+        """Whether any route was seen; without two points there is nothing to store"""
+        return self.points >= 2
+
+
+class TrailProcessor:
+    """
+    Follows one ride's GPS trail as the driver reports it. Distance is summed
+    incrementally from the raw points; the stored shape is simplified online
+    with Visvalingam-Whyatt: interior points whose triangle with their
+    neighbours is smaller than `min_area_m2` are dropped as they arrive, and
+    beyond `max_points` the smallest-area point goes, so memory is bounded
+    however long the ride is.
+
+    Points live in arrays linked by prev/next indices, and candidate areas in
+    a min-heap with lazy invalidation, so each point costs O(log n).
+    """
+
+    def __init__(self, max_points: int = TRAIL_MAX_POINTS, min_step_meters: float = TRAIL_MIN_STEP_METERS,
+                 min_area_m2: float = TRAIL_MIN_AREA_M2):
+        self.max_points = max(max_points, 2)
+        self.min_step_km = min_step_meters / 1000
+        self.min_area_km2 = min_area_m2 / 1e6
+        self.lat: List[float] = []
+        self.lng: List[float] = []
+        self.prev: List[int] = []
+        self.next: List[int] = []
+        self.alive: List[bool] = []
+        self.version: List[int] = []
+        self.heap: List[Tuple[float, int, int]] = []
+        self.head = -1
+        self.tail = -1
+        self.count = 0
+        self.distance_km = 0.0
+        self.started_at = time.monotonic()
+        self._last_lat: Optional[float] = None
+        self._last_lng: Optional[float] = None
+        self._cos_lat = 1.0
+
+    def add(self, lat: float, lng: float):
+        if self._last_lat is not None:
+            step = haversine_km(self._last_lat, self._last_lng, lat, lng)
+            if step < self.min_step_km:
+                return
+            self.distance_km += step
+        else:
+            self._cos_lat = math.cos(math.radians(lat))
+        self._last_lat, self._last_lng = lat, lng
+
+        i = len(self.lat)
+        self.lat.append(lat)
+        self.lng.append(lng)
+        self.prev.append(self.tail)
+        self.next.append(-1)
+        self.alive.append(True)
+        self.version.append(0)
+        if self.tail >= 0:
+            self.next[self.tail] = i
+        else:
+            self.head = i
+        self.tail = i
+        self.count += 1
+
+        # The previous tail now has two neighbours and can be ranked
+        self._rank(self.prev[i])
+        while self.count > self.max_points or self._smallest_area() < self.min_area_km2:
+            self._drop_least_significant()
+        if len(self.lat) > 4 * self.max_points:
+            self._compact()
+
+    def _area(self, i: int) -> float:
+        """Triangle area (km^2) of point i with its neighbours, on a local flat projection"""
+        a, b = self.prev[i], self.next[i]
+        kx = KM_PER_DEGREE_LAT * self._cos_lat
+        ky = KM_PER_DEGREE_LAT
+        ax, ay = self.lng[a] * kx, self.lat[a] * ky
+        bx, by = self.lng[i] * kx, self.lat[i] * ky
+        cx, cy = self.lng[b] * kx, self.lat[b] * ky
+        return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2
+
+    def _rank(self, i: int):
+        if i < 0 or self.prev[i] < 0 or self.next[i] < 0:
+            return  # Endpoints are always kept
+        self.version[i] += 1
+        heapq.heappush(self.heap, (self._area(i), i, self.version[i]))
+
+    def _smallest_area(self) -> float:
+        # Discard stale heap entries so the top is a live candidate
+        while self.heap:
+            _area, i, version = self.heap[0]
+            if self.alive[i] and version == self.version[i]:
+                return _area
+            heapq.heappop(self.heap)
+        return math.inf
+
+    def _drop_least_significant(self):
+        while self.heap:
+            _area, i, version = heapq.heappop(self.heap)
+            if not self.alive[i] or version != self.version[i]:
+                continue
+            a, b = self.prev[i], self.next[i]
+            self.next[a] = b
+            self.prev[b] = a
+            self.alive[i] = False
+            self.count -= 1
+            self._rank(a)
+            self._rank(b)
+            return
+
+    def _compact(self):
+        """Rebuild the arrays from the surviving points so dropped ones are freed"""
+        points = self.points()
+        self.lat, self.lng = [p[0] for p in points], [p[1] for p in points]
+        n = len(points)
+        self.prev = list(range(-1, n - 1))
+        self.next = list(range(1, n)) + [-1]
+        self.alive = [True] * n
+        self.version = [0] * n
+        self.heap = []
+        self.head, self.tail = (0, n - 1) if n else (-1, -1)
+        for i in range(n):
+            self._rank(i)
+
+    def points(self) -> List[Tuple[float, float]]:
+        out = []
+        i = self.head
+        while i >= 0:
+            out.append((self.lat[i], self.lng[i]))
+            i = self.next[i]
+        return out
+
+    def summary(self) -> TrailSummary:
+        points = self.points()
+        return TrailSummary(
+            distance_km=round(self.distance_km, 3),
+            duration_minutes=int(round((time.monotonic() - self.started_at) / 60)),
+            polyline=encode_polyline(points),
+            points=len(points)
+        )